@@ -15,7 +15,7 @@
 import hmac
 import json
 from django.test import TestCase, Client
-from conductor.core.models import Project, LAVABackend, LAVADeviceType, LAVADevice, Build, Run
+from conductor.core.models import Project, LAVABackend, LAVADeviceType, LAVADevice, LAVAJob, Build, Run
 from conductor.core.utils import ISO8601_JSONEncoder
 from unittest.mock import MagicMock, patch
 
@@ -400,3 +400,40 @@ class ApiViewTest(TestCase):
             f"/api/context/{self.project.name}/{self.build.build_id}/foo/"
         )
         self.assertEqual(response.status_code, 404)
+
+    @patch("conductor.core.tasks.process_testjob_notification.delay")
+    def test_lava_notification(self, process_mock):
+        self.lavabackend1.callback_token = "callbacktoken"
+        self.lavabackend1.save()
+        LAVAJob.objects.create(job_id=123, definition="", project=self.project)
+        response = self.client.post(
+            "/api/lavajob/123/",
+            {"id": 123, "state": "Finished", "health": "Complete", "actual_device_id": "device1"},
+            content_type="application/json",
+            HTTP_AUTHORIZATION="callbacktoken"
+        )
+        self.assertEqual(response.status_code, 200)
+        process_mock.assert_called_with(
+            {"job": "123", "device": "device1", "state": "Finished", "health": "Complete"},
+            self.lavabackend1.id
+        )
+
+    @patch("conductor.core.tasks.process_testjob_notification.delay")
+    def test_lava_notification_incorrect_token(self, process_mock):
+        self.lavabackend1.callback_token = "callbacktoken"
+        self.lavabackend1.save()
+        LAVAJob.objects.create(job_id=123, definition="", project=self.project)
+        response = self.client.post(
+            "/api/lavajob/123/",
+            {"id": 123, "state": "Finished", "health": "Complete"},
+            content_type="application/json",
+            HTTP_AUTHORIZATION="foo"
+        )
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(
+            "/api/lavajob/123/",
+            {"id": 123, "state": "Finished", "health": "Complete"},
+            content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 403)
+        process_mock.assert_not_called()
@@ -21,6 +21,6 @@ urlpatterns = [
     path('jobserv/', views.process_jobserv_webhook),
     path('device/', views.process_device_webhook),
     path('lmp/', views.process_lmp_build),
-    path('lavajob/([0-9]+)/(?:Submitted|Running|Canceling|Complete|Incomplete|Canceled)', views.process_lava_notification),
+    path('lavajob/<int:job_id>/', views.process_lava_notification),
     path('context/<slug:project_name>/<int:build_version>/<slug:device_type_name>/', views.generate_context)
 ]
@@ -28,16 +28,54 @@ from django.http import (
 )
 from django.views.decorators.csrf import csrf_exempt
 
-from conductor.core.models import Project, Build, LAVADevice, Run
-from conductor.core.tasks import create_build_run, merge_lmp_manifest, update_build_commit_id, check_device_ota_completed
+from conductor.core.models import Project, Build, LAVADevice, LAVAJob, Run
+from conductor.core.tasks import (
+    create_build_run,
+    merge_lmp_manifest,
+    update_build_commit_id,
+    check_device_ota_completed,
+    process_testjob_notification
+)
 from conductor.core.utils import ISO8601_JSONEncoder
 
 
 logger = logging.getLogger()
 
 
-def process_lava_notification(request, job_id, job_status):
-    pass
+@csrf_exempt
+def process_lava_notification(request, job_id):
+    """
+    Receives LAVA job notify callback. LAVA sends the value of
+    the submitter's token in the Authorization header.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(["POST"])
+    token = request.headers.get("Authorization")
+    if not token:
+        return HttpResponseForbidden()
+    lava_job = None
+    for job in LAVAJob.objects.filter(
+            job_id=job_id,
+            project__lava_backend__callback_token__isnull=False).select_related("project__lava_backend"):
+        if hmac.compare_digest(job.project.lava_backend.callback_token, token):
+            lava_job = job
+            break
+    if lava_job is None:
+        logger.warning(f"Incorrect callback token for LAVA job: {job_id}")
+        return HttpResponseForbidden()
+    try:
+        request_body_json = json.loads(request.body)
+    except json.decoder.JSONDecodeError:
+        return HttpResponseBadRequest()
+    # same data as in the websocket testjob event
+    event_data = {
+        "job": str(job_id),
+        "device": request_body_json.get("actual_device_id"),
+        "state": request_body_json.get("state"),
+        "health": request_body_json.get("health"),
+    }
+    process_testjob_notification.delay(event_data, lava_job.project.lava_backend_id)
+    return HttpResponse("OK")
 
 
 def __verify_header_auth(request, header_name="X-JobServ-Sig"):
@@ -27,6 +27,10 @@ class ProjectAdmin(admin.ModelAdmin):
     models = models.Project
 
 
+class ManifestCommitAdmin(admin.ModelAdmin):
+    models = models.ManifestCommit
+
+
 class BuildAdmin(admin.ModelAdmin):
     models = models.Build
 
@@ -35,6 +39,10 @@ class RunAdmin(admin.ModelAdmin):
     models = models.Run
 
 
+class PendingRunAdmin(admin.ModelAdmin):
+    models = models.PendingRun
+
+
 class LAVADeviceTypeAdmin(admin.ModelAdmin):
     models = models.LAVADeviceType
 
@@ -51,12 +59,20 @@ class PDUAgentAdmin(admin.ModelAdmin):
     models = models.PDUAgent
     list_display = ['__str__', 'state']
 
+
+class PDUAgentCommandAdmin(admin.ModelAdmin):
+    models = models.PDUAgentCommand
+    list_display = ['__str__', 'created', 'acked']
+
 admin.site.register(models.LAVABackend, LAVABackendAdmin)
 admin.site.register(models.SQUADBackend, SQUADBackendAdmin)
 admin.site.register(models.Project, ProjectAdmin)
+admin.site.register(models.ManifestCommit, ManifestCommitAdmin)
 admin.site.register(models.Build, BuildAdmin)
 admin.site.register(models.Run, RunAdmin)
+admin.site.register(models.PendingRun, PendingRunAdmin)
 admin.site.register(models.LAVADeviceType, LAVADeviceTypeAdmin)
 admin.site.register(models.LAVADevice, LAVADeviceAdmin)
 admin.site.register(models.LAVAJob, LAVAJobAdmin)
 admin.site.register(models.PDUAgent, PDUAgentAdmin)
+admin.site.register(models.PDUAgentCommand, PDUAgentCommandAdmin)
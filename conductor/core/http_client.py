@@ -0,0 +1,116 @@
+# Copyright 2021 Foundries.io
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DEFAULT_TIMEOUT = 60
+
+__session__ = None
+__session_lock__ = threading.Lock()
+
+
+def __reset_session():
+    # sockets must not be shared between forked worker processes
+    global __session__
+    __session__ = None
+
+
+os.register_at_fork(after_in_child=__reset_session)
+
+
+def get_session():
+    # single session per process. The adapter keeps a pool of
+    # keep-alive connections for every host it talks to.
+    global __session__
+    if __session__ is None:
+        with __session_lock__:
+            if __session__ is None:
+                retries = getattr(settings, "HTTP_RETRIES", 3)
+                retry = Retry(
+                    total=retries,
+                    # each read retry can wait for the full timeout
+                    read=getattr(settings, "HTTP_READ_RETRIES", 1),
+                    connect=retries,
+                    backoff_factor=getattr(settings, "HTTP_BACKOFF_FACTOR", 1.0),
+                    status_forcelist=(500, 502, 503, 504),
+                    # callers check status_code of the last response
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=getattr(settings, "HTTP_POOL_CONNECTIONS", 10),
+                    pool_maxsize=getattr(settings, "HTTP_POOL_MAXSIZE", 10),
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                __session__ = session
+    return __session__
+
+
+class Client(object):
+    """
+    Thin wrapper around the shared session. Adds authentication
+    headers of a single backend and the default timeout to every call.
+    POST requests are not retried on failed status by urllib3.
+    """
+
+    def __init__(self, headers=None, timeout=None):
+        self.headers = headers or {}
+        self.timeout = timeout or getattr(settings, "HTTP_TIMEOUT", DEFAULT_TIMEOUT)
+
+    def __prepare(self, kwargs):
+        headers = dict(self.headers)
+        headers.update(kwargs.pop("headers", None) or {})
+        kwargs["headers"] = headers
+        kwargs.setdefault("timeout", self.timeout)
+        return kwargs
+
+    def get(self, url, **kwargs):
+        return get_session().get(url, **self.__prepare(kwargs))
+
+    def post(self, url, **kwargs):
+        return get_session().post(url, **self.__prepare(kwargs))
+
+    def put(self, url, **kwargs):
+        return get_session().put(url, **self.__prepare(kwargs))
+
+    def delete(self, url, **kwargs):
+        return get_session().delete(url, **self.__prepare(kwargs))
+
+
+def lava_client(backend):
+    return Client(headers={
+        "Authorization": f"Token {backend.lava_api_token}",
+    })
+
+
+def squad_client(backend):
+    # watchjob API uses Auth-Token, REST API uses Authorization
+    return Client(headers={
+        "Auth-Token": backend.squad_token,
+        "Authorization": f"Token {backend.squad_token}",
+    })
+
+
+def fio_client():
+    return Client(headers={
+        "OSF-TOKEN": getattr(settings, "FIO_API_TOKEN", None),
+    })
@@ -0,0 +1,210 @@
+# Copyright 2021 Foundries.io
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import os
+import re
+import shutil
+import tempfile
+import time
+from conductor.core.models import (
+    Build,
+    LAVADevice,
+    LAVADeviceType,
+    LAVAJob,
+    Project,
+    Run,
+)
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+
+PROJECT_PREFIX = "benchmark-"
+TAGS = ["master", "devel", "main"]
+DEVICE_TYPES = ["imx8mmevk", "raspberrypi4-64", "intel-corei7-64"]
+BATCH_SIZE = 10000
+BENCHMARK_DATABASE = "benchmark"
+
+# table scans and sorts not served by an index. SQLite reports
+# "SCAN core_build" and "USE TEMP B-TREE FOR ORDER BY",
+# PostgreSQL "Seq Scan on core_build"
+NOT_INDEXED = re.compile(r"(^|\s)SCAN \w+$|USE TEMP B-TREE|Seq Scan", re.MULTILINE)
+
+
+def hot_queries(project, build, device, job_id, using=DEFAULT_DB_ALIAS):
+    """
+    Lookups done for every build, LAVA event or callback.
+    Returns (name, queryset) pairs.
+    """
+    return [
+        ("previous build", Build.objects.using(using).filter(
+            project=project, tag=build.tag, build_id__lt=build.build_id).order_by("-build_id")[:1]),
+        ("previous build any tag", Build.objects.using(using).filter(
+            project=project, build_id__lt=build.build_id).order_by("-build_id")[:1]),
+        ("build run", Run.objects.using(using).filter(build=build, run_name=DEVICE_TYPES[0])),
+        ("job", LAVAJob.objects.using(using).filter(job_id=job_id)),
+        ("device by name", LAVADevice.objects.using(using).filter(name=device.name, project=project)),
+        ("device by auto register name", LAVADevice.objects.using(using).filter(
+            auto_register_name=device.auto_register_name, project=project)),
+    ]
+
+
+def is_indexed(plan):
+    return NOT_INDEXED.search(plan) is None
+
+
+@contextlib.contextmanager
+def temporary_database():
+    """
+    Registers SQLite database in a temporary file and creates
+    tables of the current models in it. Yields the database alias.
+    """
+    # migrations aren't applied as data migrations
+    # use the default database
+    directory = tempfile.mkdtemp(prefix="conductor-benchmark-")
+    connections.settings[BENCHMARK_DATABASE] = connections.configure_settings({
+        DEFAULT_DB_ALIAS: {},
+        BENCHMARK_DATABASE: {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.path.join(directory, "benchmark.sqlite3"),
+        },
+    })[BENCHMARK_DATABASE]
+    try:
+        with connections[BENCHMARK_DATABASE].schema_editor() as editor:
+            for model in apps.get_app_config("core").get_models():
+                editor.create_model(model)
+        yield BENCHMARK_DATABASE
+    finally:
+        connections[BENCHMARK_DATABASE].close()
+        del connections[BENCHMARK_DATABASE]
+        del connections.settings[BENCHMARK_DATABASE]
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def seed(projects, builds, devices, jobs, using=DEFAULT_DB_ALIAS):
+    Project.objects.using(using).bulk_create([
+        Project(name=f"{PROJECT_PREFIX}{index}", secret="benchmark")
+        for index in range(projects)
+    ])
+    # bulk_create doesn't set IDs on all backends
+    project_objects = list(Project.objects.using(using).filter(name__startswith=PROJECT_PREFIX).order_by("id"))
+
+    LAVADeviceType.objects.using(using).bulk_create([
+        LAVADeviceType(name=name, net_interface="eth0", project=project)
+        for project in project_objects
+        for name in DEVICE_TYPES
+    ])
+    device_types = list(LAVADeviceType.objects.using(using).filter(project__in=project_objects).order_by("id"))
+    LAVADevice.objects.using(using).bulk_create([
+        LAVADevice(
+            device_type=device_types[index % len(device_types)],
+            project=device_types[index % len(device_types)].project,
+            name=f"{device_types[index % len(device_types)].name}-{index:05d}",
+            auto_register_name=f"ota_{index:05d}",
+        )
+        for index in range(devices)
+    ], batch_size=BATCH_SIZE)
+
+    for start in range(0, builds, BATCH_SIZE):
+        Build.objects.using(using).bulk_create([
+            Build(
+                url=f"https://example.com/builds/{index}/",
+                project=project_objects[index % projects],
+                build_id=index // projects + 1,
+                tag=TAGS[index % len(TAGS)],
+            )
+            for index in range(start, min(start + BATCH_SIZE, builds))
+        ])
+    build_ids = list(Build.objects.using(using).filter(project__in=project_objects).values_list("id", flat=True))
+    for start in range(0, len(build_ids), BATCH_SIZE):
+        Run.objects.using(using).bulk_create([
+            Run(build_id=build_id, device_type=name, ostree_hash="0" * 64, run_name=name)
+            for build_id in build_ids[start:start + BATCH_SIZE]
+            for name in DEVICE_TYPES
+        ])
+    for start in range(0, jobs, BATCH_SIZE):
+        LAVAJob.objects.using(using).bulk_create([
+            LAVAJob(
+                job_id=index + 1,
+                definition="benchmark",
+                project=project_objects[index % projects],
+            )
+            for index in range(start, min(start + BATCH_SIZE, jobs))
+        ])
+    return project_objects
+
+
+class Command(BaseCommand):
+    help = "Checks that hot lookups use indexes on realistic data volumes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--projects", default=10, type=int, help="Number of projects")
+        parser.add_argument("--builds", default=100000, type=int, help="Number of builds")
+        parser.add_argument("--devices", default=1000, type=int, help="Number of LAVA devices")
+        parser.add_argument("--jobs", default=1000000, type=int, help="Number of LAVA jobs")
+        parser.add_argument("--repeat", default=100, type=int, help="Executions of each query")
+        parser.add_argument(
+            "--database",
+            default=None,
+            help="Alias of the database to seed. "
+                 "Temporary SQLite database is used when omitted"
+        )
+        parser.add_argument(
+            "--use-default-database",
+            action="store_true",
+            help="Allow seeding the default database"
+        )
+
+    def handle(self, *args, **options):
+        database = options["database"]
+        if database is None:
+            with temporary_database() as database:
+                self.benchmark(database, options)
+            return
+        if database not in connections:
+            raise CommandError(f"Unknown database {database}")
+        if database == DEFAULT_DB_ALIAS and not options["use_default_database"]:
+            raise CommandError(
+                "Seeding locks the default database until the benchmark ends. "
+                "Use --use-default-database to run it anyway"
+            )
+        self.benchmark(database, options)
+
+    def benchmark(self, database, options):
+        # seeded data never leaves the transaction
+        not_indexed = []
+        with transaction.atomic(using=database):
+            start = time.monotonic()
+            projects = seed(options["projects"], options["builds"], options["devices"], options["jobs"], using=database)
+            self.stdout.write(f"Seeded {options['builds']} builds and {options['jobs']} jobs in {time.monotonic() - start:.1f}s")
+
+            project = projects[-1]
+            build = Build.objects.using(database).filter(project=project).order_by("-build_id").first()
+            device = LAVADevice.objects.using(database).filter(project=project).last()
+            job_id = options["jobs"] // 2
+            for name, queryset in hot_queries(project, build, device, job_id, using=database):
+                plan = queryset.explain()
+                start = time.monotonic()
+                for _ in range(options["repeat"]):
+                    list(queryset.all())
+                duration = (time.monotonic() - start) * 1000 / options["repeat"]
+                self.stdout.write(f"{name}: {duration:.3f}ms")
+                for line in plan.splitlines():
+                    self.stdout.write(f"  {line}")
+                if not is_indexed(plan):
+                    not_indexed.append(name)
+            transaction.set_rollback(True, using=database)
+        if not_indexed:
+            raise CommandError(f"Queries not using indexes: {', '.join(not_indexed)}")
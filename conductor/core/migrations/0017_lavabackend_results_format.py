@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_squad_backend'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lavabackend',
+            name='results_format',
+            field=models.CharField(choices=[('paged', 'Paged REST API'), ('csv', 'CSV export'), ('yaml', 'YAML export')], default='paged', max_length=16),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_lavabackend_results_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lavajob',
+            name='expected_tests',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
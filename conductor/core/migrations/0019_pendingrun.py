@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_lavajob_expected_tests'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_name', models.CharField(max_length=32)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('build', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.build')),
+            ],
+            options={
+                'unique_together': {('build', 'run_name')},
+            },
+        ),
+    ]
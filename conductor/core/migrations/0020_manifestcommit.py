@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_pendingrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManifestCommit',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha', models.CharField(max_length=40)),
+                ('message', models.CharField(max_length=128)),
+                ('tags', models.CharField(blank=True, max_length=128, null=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.project')),
+            ],
+            options={
+                'unique_together': {('project', 'sha')},
+            },
+        ),
+    ]
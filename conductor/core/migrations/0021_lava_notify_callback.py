@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_manifestcommit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lavabackend',
+            name='callback_token',
+            field=models.CharField(blank=True, max_length=128, null=True),
+        ),
+        migrations.AddField(
+            model_name='lavajob',
+            name='state',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_lava_notify_callback'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PDUAgentCommand',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('acked', models.DateTimeField(blank=True, null=True)),
+                ('agent', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.pduagent')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
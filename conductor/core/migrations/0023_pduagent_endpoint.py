@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_pduagentcommand'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pduagent',
+            name='endpoint',
+            field=models.CharField(blank=True, max_length=128, null=True),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:25
+
+from django.db import migrations, models
+
+
+def remove_duplicate_runs(apps, schema_editor):
+    # unique (build, run_name) can't be added with duplicates in place.
+    # Run with ostree hash filled in and the highest ID is kept
+    Run = apps.get_model('core', 'Run')
+    db_alias = schema_editor.connection.alias
+    duplicates = Run.objects.using(db_alias).values('build', 'run_name') \
+        .annotate(count=models.Count('id')) \
+        .filter(count__gt=1)
+    for duplicate in duplicates:
+        runs = Run.objects.using(db_alias).filter(build=duplicate['build'], run_name=duplicate['run_name'])
+        keep = runs.exclude(ostree_hash='').order_by('-id').first() or runs.order_by('-id').first()
+        runs.exclude(pk=keep.pk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_pduagent_endpoint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='lavajob',
+            name='job_id',
+            field=models.IntegerField(db_index=True),
+        ),
+        migrations.RunPython(remove_duplicate_runs, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='run',
+            unique_together={('build', 'run_name')},
+        ),
+        migrations.AddIndex(
+            model_name='build',
+            index=models.Index(fields=['project', 'tag', 'build_id'], name='core_build_project_627d7c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='build',
+            index=models.Index(fields=['project', 'build_id'], name='core_build_project_f855ee_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lavadevice',
+            index=models.Index(fields=['auto_register_name', 'project'], name='core_lavade_auto_re_8c3dfb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lavadevice',
+            index=models.Index(fields=['name', 'project'], name='core_lavade_name_034f0b_idx'),
+        ),
+    ]
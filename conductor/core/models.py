@@ -13,15 +13,15 @@
 # limitations under the License.
 
 import logging
-import requests
 import yaml
+from conductor.core.http_client import lava_client, squad_client, fio_client
+from datetime import timedelta
 from django.conf import settings
 from django.db import models
 from django.utils import timezone
 from urllib.parse import urljoin
 
 
-DEFAULT_TIMEOUT=60
 logger = logging.getLogger()
 
 
@@ -37,22 +37,98 @@ def yaml_validator(value):
         raise ValidationError(e)
 
 
-class LAVABackend(models.Model):
+def expected_test_names(job_definition):
+    # todo: check if tests exist and they come with definitions
+    # this is only correct for some test jobs
+    expected_test_list = []
+    for action in job_definition.get('actions') or []:
+        if 'test' in action.keys() and 'definitions' in action['test'].keys():
+            for expected_test in action['test']['definitions']:
+                expected_test_list.append(expected_test['name'])
+    return expected_test_list
+
+
+class TrackedFieldsMixin(object):
+    """
+    Remembers values of tracked_fields as they were loaded from
+    or last saved to the database. post_save handlers use
+    get_changed_fields() to skip work when nothing they depend
+    on was changed. All tracked fields of a new instance are
+    reported as changed.
+    """
+    tracked_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.__reset_tracked_fields()
+        return instance
+
+    def __reset_tracked_fields(self, fields=None):
+        saved = self.__dict__.setdefault("__saved_values__", {})
+        for name in self.tracked_fields:
+            attname = self._meta.get_field(name).attname
+            # deferred fields are not loaded to compare them
+            if (fields is None or name in fields) and attname in self.__dict__:
+                saved[name] = self.__dict__[attname]
+
+    def get_changed_fields(self):
+        saved = self.__dict__.get("__saved_values__", {})
+        changed = []
+        for name in self.tracked_fields:
+            attname = self._meta.get_field(name).attname
+            if name not in saved or saved[name] != self.__dict__.get(attname):
+                changed.append(name)
+        return changed
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # post_save handlers already run with the changes
+        update_fields = kwargs.get("update_fields")
+        self.__reset_tracked_fields(update_fields)
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.__reset_tracked_fields(kwargs.get("fields"))
+
+
+class LAVABackend(TrackedFieldsMixin, models.Model):
     name = models.CharField(max_length=32)
     lava_url = models.URLField()
     websocket_url = models.URLField(blank=True, null=True)
     lava_api_token = models.CharField(max_length=128)
 
+    # how test results are retrieved once the job is finished.
+    # Bulk exports fetch all results of a job in one request
+    # and fall back to paged REST API when export fails.
+    RESULTS_PAGED = "paged"
+    RESULTS_CSV = "csv"
+    RESULTS_YAML = "yaml"
+    RESULTS_CHOICES = [
+        (RESULTS_PAGED, "Paged REST API"),
+        (RESULTS_CSV, "CSV export"),
+        (RESULTS_YAML, "YAML export")
+    ]
+    results_format = models.CharField(
+        max_length=16,
+        choices=RESULTS_CHOICES,
+        default=RESULTS_PAGED
+    )
+    # value of the token LAVA sends with job notify callbacks.
+    # Callbacks are not requested when empty.
+    callback_token = models.CharField(max_length=128, blank=True, null=True)
+
+    # listener reconnects when these change
+    tracked_fields = ("lava_url", "websocket_url", "lava_api_token")
+
+    @property
+    def client(self):
+        return lava_client(self)
+
     def submit_lava_job(self, definition):
-        # authentication headers
-        authentication = {
-            "Authorization": "Token %s" % self.lava_api_token,
-        }
-        response = requests.post(
+        response = self.client.post(
             urljoin(self.lava_url, "jobs/"),
-            headers=authentication,
-            data={"definition": definition},
-            timeout=DEFAULT_TIMEOUT
+            data={"definition": definition}
         )
         if response.status_code == 201:
             return response.json()['job_ids']
@@ -67,43 +143,37 @@ class SQUADBackend(models.Model):
     squad_url = models.URLField()
     squad_token = models.CharField(max_length=128)
 
+    @property
+    def client(self):
+        return squad_client(self)
+
     def watch_lava_job(self, 
             group,
             project,
             build,
             environment,
             job_id):
-        # authentication headers
-        authentication = {
-            "Auth-Token": self.squad_token,
-        }
-        return requests.post(
+        return self.client.post(
             urljoin(self.squad_url, f"api/watchjob/{group}/{project}/{build}/{environment}"),
-            headers=authentication,
             data={"testjob_id": job_id,
-                  "backend": self.name},
-            timeout=DEFAULT_TIMEOUT
+                  "backend": self.name}
         )
 
     def update_testjob(self, squad_job_id, name, job_definition):
-        headers = {
-            "Authorization": f"Token {self.squad_token}"
-        }
         testjob_api_url = urljoin(self.squad_url, f"api/testjobs/{squad_job_id}")
-        job_details_request = requests.get(testjob_api_url, headers=headers)
+        job_details_request = self.client.get(testjob_api_url)
         if job_details_request.status_code == 200:
             # prepare PUT to update definition
             job_details = job_details_request.json()
             job_details.update({"definition": job_definition, "name": name})
-            return requests.put(
+            return self.client.put(
                 testjob_api_url,
-                data=job_details,
-                headers=headers
+                data=job_details
             )
         return None
 
 
-class Project(models.Model):
+class Project(TrackedFieldsMixin, models.Model):
     name = models.CharField(max_length=32)
     # secret stored in a factory and passed in webhook
     # request POST header
@@ -120,6 +190,9 @@ class Project(models.Model):
         blank=True)
     squad_group = models.CharField(max_length=16, null=True, blank=True)
 
+    # manifest repository is checked out again when these change
+    tracked_fields = ("name", "secret")
+
     def watch_qa_reports_job(self, build, environment, job_id):
         if self.squad_backend:
             return self.squad_backend.watch_lava_job(
@@ -139,6 +212,23 @@ class Project(models.Model):
         return self.name
 
 
+class ManifestCommit(models.Model):
+    # index of the project manifest repository commits. Used
+    # to find build reason without touching the repository
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    sha = models.CharField(max_length=40)
+    # beginning of the commit message
+    message = models.CharField(max_length=128)
+    # comma separated list of tags pointing to the commit
+    tags = models.CharField(max_length=128, blank=True, null=True)
+
+    class Meta:
+        unique_together = ('project', 'sha')
+
+    def __str__(self):
+        return f"{self.sha} ({self.project.name})"
+
+
 class Build(models.Model):
     url = models.URLField()
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
@@ -157,6 +247,13 @@ class Build(models.Model):
     # these are builds that are used for update/rollback testing
     schedule_tests = models.BooleanField(default=True)
 
+    class Meta:
+        indexes = [
+            # previous build lookups ordered by build_id
+            models.Index(fields=["project", "tag", "build_id"]),
+            models.Index(fields=["project", "build_id"]),
+        ]
+
     def __str__(self):
         return f"{self.build_id} ({self.project.name})"
 
@@ -178,11 +275,28 @@ class Run(models.Model):
     ostree_hash = models.CharField(max_length=64)
     run_name = models.CharField(max_length=32)
 
+    class Meta:
+        unique_together = ('build', 'run_name')
+
+    def __str__(self):
+        return "%s (%s)" % (self.run_name, self.build.build_id)
+
+
+class PendingRun(models.Model):
+    # run of the build waiting for the build reason. It's released
+    # as soon as update_build_reason fills the reason in
+    build = models.ForeignKey(Build, on_delete=models.CASCADE)
+    run_name = models.CharField(max_length=32)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('build', 'run_name')
+
     def __str__(self):
         return "%s (%s)" % (self.run_name, self.build.build_id)
 
 
-class PDUAgent(models.Model):
+class PDUAgent(TrackedFieldsMixin, models.Model):
     name = models.CharField(max_length=32)
 
     STATE_ONLINE = "Online"
@@ -200,10 +314,42 @@ class PDUAgent(models.Model):
     version = models.CharField(max_length=32)
     token = models.CharField(max_length=64)
     message = models.TextField(blank=True, null=True)
+    # ZMQ endpoint of the pduserver instance the agent is connected to
+    endpoint = models.CharField(max_length=128, blank=True, null=True)
+
+    tracked_fields = ("message",)
 
     def __str__(self):
         return self.name
 
+    def is_alive(self):
+        """
+        Agent is connected and answered a ping recently. last_ping
+        is written by pduserver in batches, the timeout covers
+        the heartbeat and the flush intervals.
+        """
+        if self.state != PDUAgent.STATE_ONLINE or self.last_ping is None:
+            return False
+        timeout = timedelta(seconds=getattr(settings, "PDUAGENT_PING_TIMEOUT", 150))
+        return timezone.now() - self.last_ping < timeout
+
+
+class PDUAgentCommand(models.Model):
+    """
+    Command queued for the PDU agent. ID is used as the sequence
+    number the agent acknowledges.
+    """
+    agent = models.ForeignKey(PDUAgent, on_delete=models.CASCADE)
+    command = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    acked = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return f"{self.agent.name}: {self.id} {self.command}"
+
 
 class LAVADeviceType(models.Model):
     name = models.CharField(max_length=32)
@@ -247,22 +393,28 @@ class LAVADevice(models.Model):
         default=CONTROL_LAVA
     )
 
+    class Meta:
+        indexes = [
+            # devices are found by the names used in LAVA events
+            # and in the Foundries factory
+            models.Index(fields=["auto_register_name", "project"]),
+            models.Index(fields=["name", "project"]),
+        ]
+
     def __str__(self):
         return f"{self.name} ({self.project.name})"
 
     def __request_state(self, state):
-        auth = {
-            "Authorization": f"Token {self.project.lava_backend.lava_api_token}"
-        }
+        client = self.project.lava_backend.client
         device_url = urljoin(self.project.lava_backend.lava_url, "/".join(["devices", self.name]))
         if not device_url.endswith("/"):
             device_url = device_url + "/"
-        device_request = requests.get(device_url, headers=auth)
+        device_request = client.get(device_url)
         if device_request.status_code == 200:
             device_json = device_request.json()
             device_json['health'] = state
             logger.info(device_json)
-            device_put_request = requests.put(device_url, json=device_json, headers=auth)
+            device_put_request = client.put(device_url, json=device_json)
             if device_put_request.status_code == 200:
                 logger.info(f"Requested state: {state} for device: {self.name}")
                 return True
@@ -288,13 +440,9 @@ class LAVADevice(models.Model):
 
     def get_current_target(self):
         # checks the current target reported by FIO API
-        token = getattr(settings, "FIO_API_TOKEN", None)
-        authentication = {
-            "OSF-TOKEN": token,
-        }
         if self.auto_register_name:
             url = f"https://api.foundries.io/ota/devices/{self.auto_register_name}/"
-            device_details_request = requests.get(url, headers=authentication)
+            device_details_request = fio_client().get(url)
             if device_details_request.status_code == 200:
                 return device_details_request.json()
             else:
@@ -303,20 +451,17 @@ class LAVADevice(models.Model):
         return {}
 
     def remove_from_factory(self):
-        token = getattr(settings, "FIO_API_TOKEN", None)
-        authentication = {
-            "OSF-TOKEN": token,
-        }
         if self.auto_register_name:
             url = f"https://api.foundries.io/ota/devices/{self.auto_register_name}/"
-            device_remove_request = requests.delete(url, headers=authentication)
+            device_remove_request = fio_client().delete(url)
             if device_remove_request.status_code == 200:
                 return device_remove_request.json()
         return {}
 
 
 class LAVAJob(models.Model):
-    job_id = models.IntegerField()
+    # looked up on every listener event and callback
+    job_id = models.IntegerField(db_index=True)
     # actual device can is filled once LAVA assigns it
     device = models.ForeignKey(LAVADevice, null=True, blank=True, on_delete=models.CASCADE)
     definition = models.TextField()
@@ -333,6 +478,21 @@ class LAVAJob(models.Model):
         choices=JOB_CHOICES,
         default=JOB_LAVA
     )
+    # newline separated names of test definitions from the job
+    # definition. Filled in when the job is submitted
+    expected_tests = models.TextField(blank=True, null=True)
+    # last processed LAVA job state. The same state can be
+    # reported by the listener and the notify callback.
+    state = models.CharField(max_length=16, blank=True, null=True)
+    # LAVA job states in the order they are reached. Events
+    # replayed after the job moved on are not processed again
+    STATES = ["Submitted", "Scheduling", "Scheduled", "Running", "Canceling", "Finished"]
+
+    def get_expected_tests(self):
+        if self.expected_tests is None:
+            # jobs submitted before expected tests were stored
+            return expected_test_names(yaml.safe_load(self.definition) or {})
+        return [name for name in self.expected_tests.split("\n") if name]
 
     def __str__(self):
         return f"{self.job_id} ({self.device})"
@@ -0,0 +1,224 @@
+# Copyright 2021 Foundries.io
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import fcntl
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from git import GitCommandError, Repo
+from urllib.parse import urlsplit
+
+
+logger = logging.getLogger()
+
+STATUS_CLONED = "cloned"
+STATUS_UNCHANGED = "unchanged"
+STATUS_MERGED = "merged"
+STATUS_COMMITTED = "committed"
+STATUS_FETCHED = "fetched"
+STATUS_SKIPPED = "skipped"
+STATUS_FAILED = "failed"
+
+BRANCH = "master"
+
+# open repository handles. Each handle keeps its git cat-file
+# processes running between tasks. Handles are keyed with the pid
+# so forked workers never use (or close) handles of the parent.
+__repositories__ = {}
+__repositories_lock__ = threading.Lock()
+
+
+def get_repository(path):
+    key = (os.getpid(), os.path.normpath(path))
+    with __repositories_lock__:
+        repository = __repositories__.get(key)
+        if repository is not None and not os.path.isdir(repository.git_dir):
+            # repository was removed from disk
+            repository.close()
+            repository = None
+        if repository is None:
+            repository = Repo(path)
+            __repositories__[key] = repository
+    return repository
+
+
+def forget_repository(path):
+    key = (os.getpid(), os.path.normpath(path))
+    with __repositories_lock__:
+        repository = __repositories__.pop(key, None)
+    if repository is not None:
+        repository.close()
+
+
+@contextmanager
+def lock(name):
+    # serializes operations on a single repository
+    # between worker processes
+    # created by concurrent workers at the same time
+    os.makedirs(settings.FIO_REPOSITORY_HOME, exist_ok=True)
+    lock_path = os.path.join(settings.FIO_REPOSITORY_HOME, f"{name}.lock")
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def _operation(path, name):
+    # collects outcome and duration of a single operation.
+    # git errors are logged and reported in the result.
+    result = {
+        "repository": os.path.basename(os.path.normpath(path)),
+        "operation": name,
+        "status": STATUS_SKIPPED,
+        "duration": 0.0,
+        "error": None,
+    }
+    start = time.monotonic()
+    try:
+        yield result
+    except GitCommandError as e:
+        result["status"] = STATUS_FAILED
+        result["error"] = (e.stderr or str(e)).strip()
+        logger.warning(f"{name} of {result['repository']} failed: {result['error']}")
+    finally:
+        result["duration"] = round(time.monotonic() - start, 2)
+
+
+def _link_reference(repository, reference):
+    # objects present in the reference repository are not downloaded again
+    alternates_path = os.path.join(repository.git_dir, "objects", "info", "alternates")
+    if reference and not os.path.exists(alternates_path):
+        os.makedirs(os.path.dirname(alternates_path), exist_ok=True)
+        with open(alternates_path, "w") as alternates:
+            alternates.write(os.path.join(reference, "objects") + "\n")
+
+
+def _set_remote(repository, name, url):
+    if name in [remote.name for remote in repository.remotes]:
+        remote = repository.remote(name=name)
+        if remote.url != url:
+            remote.set_url(url)
+        return remote
+    return repository.create_remote(name, url)
+
+
+def _remote_url(repository, name):
+    if name not in [remote.name for remote in repository.remotes]:
+        return None
+    return repository.remote(name=name).url
+
+
+def update_reference(path, lmp_remote, lmp_url, initial=False):
+    """
+    Fetches LmP manifest into the bare reference repository.
+    With initial=True existing reference is not fetched again.
+    """
+    with _operation(path, "reference") as result:
+        if os.path.isdir(path):
+            if initial:
+                return result
+            repository = get_repository(path)
+        else:
+            repository = Repo.init(path, bare=True)
+        _set_remote(repository, lmp_remote, lmp_url)
+        repository.remote(name=lmp_remote).fetch()
+        result["status"] = STATUS_FETCHED
+    return result
+
+
+def checkout(path, url, token, remote, lmp_remote, lmp_url, reference=None, partial_filter=None):
+    """
+    Clones project manifest repository and adds LmP manifest remote.
+    Existing repository with matching remotes is left untouched.
+    """
+    with _operation(path, "checkout") as result:
+        if os.path.isdir(os.path.join(path, ".git")):
+            repository = get_repository(path)
+            _link_reference(repository, reference)
+            if _remote_url(repository, remote) == url and \
+                    _remote_url(repository, lmp_remote) == lmp_url and \
+                    f"{remote}/{BRANCH}" in [ref.name for ref in repository.remote(name=remote).refs]:
+                result["status"] = STATUS_UNCHANGED
+                return result
+        else:
+            forget_repository(path)
+            repository = Repo.init(path)
+            _link_reference(repository, reference)
+            # keep handle of the new repository
+            repository.close()
+            repository = get_repository(path)
+
+        server = urlsplit(url)
+        auth = base64.b64encode((token or "").encode()).decode()
+        with repository.config_writer() as config:
+            config.set_value(f'http "{server.scheme}://{server.netloc}"', "extraheader", f"Authorization: basic {auth}")
+            config.set_value("user", "email", "testbot@foundries.io")
+            config.set_value("user", "name", "Testbot")
+            if partial_filter:
+                # partial clone, missing objects are fetched on demand
+                config.set_value(f'remote "{remote}"', "promisor", "true")
+                config.set_value(f'remote "{remote}"', "partialclonefilter", partial_filter)
+        _set_remote(repository, remote, url).fetch(BRANCH)
+        repository.git.checkout("-B", BRANCH, f"{remote}/{BRANCH}")
+        _set_remote(repository, lmp_remote, lmp_url)
+        result["status"] = STATUS_CLONED
+    return result
+
+
+def merge(path, remote, lmp_remote, message):
+    """
+    Merges LmP master into project master and pushes the result.
+    """
+    with _operation(path, "merge") as result:
+        repository = get_repository(path)
+        repository.remote(name=remote).fetch()
+        repository.remote(name=lmp_remote).fetch()
+        # local master isn't pulled on every build
+        repository.git.checkout("-B", BRANCH, f"{remote}/{BRANCH}")
+        repository.git.reset("--hard", f"{remote}/{BRANCH}")
+        try:
+            repository.git.merge("-X", "theirs", "--no-edit", "-m", message, f"{lmp_remote}/{BRANCH}")
+        except GitCommandError:
+            # merge error is reported even when there's nothing to abort
+            try:
+                repository.git.merge("--abort")
+            except GitCommandError as e:
+                logger.warning(f"Aborting merge of {os.path.basename(os.path.normpath(path))} failed: {e}")
+            raise
+        repository.git.push(remote, BRANCH)
+        result["status"] = STATUS_MERGED
+    return result
+
+
+def create_empty_commit(path, remote, message):
+    """
+    Adds empty commit on top of remote master and pushes it.
+    """
+    with _operation(path, "commit") as result:
+        repository = get_repository(path)
+        repository.remote(name=remote).fetch(BRANCH)
+        repository.git.checkout("-B", BRANCH, f"{remote}/{BRANCH}")
+        repository.git.reset("--hard", f"{remote}/{BRANCH}")
+        commit = repository.index.commit(message)
+        repository.git.push(remote, BRANCH)
+        result["status"] = STATUS_COMMITTED
+        result["commit"] = commit.hexsha
+    return result
@@ -12,60 +12,217 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
 import datetime
 import json
 import logging
+import os
+import queue
+import threading
 import time
 import uuid
 import zmq
-from conductor.core.models import PDUAgent, Project
+from celery.signals import worker_process_shutdown
+from conductor.core.models import LAVABackend, PDUAgent, PDUAgentCommand, Project
 from conductor.core.tasks import create_project_repository
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from zmq.utils.monitor import recv_monitor_message
 from zmq.utils.strtypes import b
 
 
 logger = logging.getLogger()
 
 
-def send_message(topic, data):
-    context = zmq.Context.instance()
-    socket = context.socket(zmq.PUSH)
-    socket.connect(settings.INTERNAL_ZMQ_SOCKET)
+class MessageSender(object):
+    """
+    Keeps a PUSH socket connected to a single endpoint. Messages are
+    queued locally and sent by a background thread that owns the socket,
+    so callers never wait for the receiver. Messages still queued when
+    the process exits are sent by close().
+    """
 
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.queue = queue.Queue(maxsize=getattr(settings, "INTERNAL_ZMQ_QUEUE_SIZE", 1000))
+        self.closing = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run,
+            name=f"zmq-sender-{endpoint}",
+            daemon=True
+        )
+        self.thread.start()
+
+    def send(self, topic, msg):
+        try:
+            self.queue.put_nowait((topic, msg, time.monotonic()))
+            return True
+        except queue.Full:
+            logger.error(f"Message {topic} dropped, {self.endpoint} queue is full")
+            return False
+
+    def close(self, timeout):
+        # sends the queued messages and waits at most timeout seconds
+        self.closing.set()
+        try:
+            # wakes up the thread waiting for messages
+            self.queue.put_nowait((None, None, None))
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logger.error(f"{self.queue.qsize()} messages to {self.endpoint} not sent before exit")
+
+    def run(self):
+        timeout = settings.INTERNAL_ZMQ_TIMEOUT
+        # own context, terminating it waits until the messages
+        # left in the socket are sent (at most LINGER)
+        context = zmq.Context()
+        socket = context.socket(zmq.PUSH)
+        socket.setsockopt(zmq.SNDHWM, getattr(settings, "INTERNAL_ZMQ_HWM", 1000))
+        socket.setsockopt(zmq.SNDTIMEO, int(timeout * 1000))
+        socket.setsockopt(zmq.LINGER, int(timeout * 1000))
+        # ZMQ doesn't confirm delivery. Connection events tell
+        # if messages go to the receiver or wait in the socket.
+        monitor = socket.get_monitor_socket(zmq.EVENT_CONNECTED | zmq.EVENT_DISCONNECTED)
+        socket.connect(self.endpoint)
+        connected = False
+        while not (self.closing.is_set() and self.queue.empty()):
+            try:
+                (topic, msg, queued) = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                (topic, msg, queued) = (None, None, None)
+            connected = self.__update_connection(monitor, connected)
+            if msg is None:
+                continue
+            try:
+                socket.send_multipart(msg)
+                latency = (time.monotonic() - queued) * 1000
+                if connected:
+                    logger.debug(f"Message {topic} sent to {self.endpoint} in {latency:.1f}ms")
+                else:
+                    logger.warning(f"Message {topic} queued, {self.endpoint} is not connected")
+            except zmq.error.Again:
+                logger.error(f"Message {topic} dropped, {self.endpoint} is not receiving")
+            except zmq.ZMQError:
+                logger.error("Message sending failed %s" % topic)
+        socket.disable_monitor()
+        monitor.close()
+        socket.close()
+        context.term()
+
+    def __update_connection(self, monitor, connected):
+        while monitor.poll(0):
+            event = recv_monitor_message(monitor)
+            connected = event["event"] == zmq.EVENT_CONNECTED
+            logger.debug(f"Receiver at {self.endpoint} {'connected' if connected else 'disconnected'}")
+        return connected
+
+
+__senders__ = {}
+__senders_lock__ = threading.Lock()
+
+
+def __reset_senders():
+    # sender threads don't survive fork
+    global __senders__
+    __senders__ = {}
+
+
+os.register_at_fork(after_in_child=__reset_senders)
+
+
+def __close_senders(**kwargs):
+    # daemon sender threads are killed at exit with the messages
+    # still queued. All senders share INTERNAL_ZMQ_TIMEOUT
+    deadline = time.monotonic() + settings.INTERNAL_ZMQ_TIMEOUT
+    for sender in list(__senders__.values()):
+        sender.close(max(0, deadline - time.monotonic()))
+
+
+atexit.register(__close_senders)
+# celery pool processes exit without running atexit handlers
+worker_process_shutdown.connect(__close_senders, weak=False)
+
+
+def get_sender(endpoint):
+    sender = __senders__.get(endpoint)
+    if sender is None:
+        with __senders_lock__:
+            sender = __senders__.get(endpoint)
+            if sender is None:
+                sender = MessageSender(endpoint)
+                __senders__[endpoint] = sender
+    return sender
+
+
+def send_message(topic, data, endpoint=None):
+    endpoint = endpoint or settings.INTERNAL_ZMQ_SOCKET
     try:
         msg = [
             b(str(uuid.uuid1())),
             b(datetime.datetime.utcnow().isoformat()),
             b(json.dumps(data)),
         ]
-        logger.debug(f"Sending message {data} to {settings.INTERNAL_ZMQ_SOCKET}")
-        tracker = socket.send_multipart(msg, zmq.DONTWAIT, copy=False, track=True)
-        while not tracker.done:
-            logger.debug("Waiting for tracker")
-            time.sleep(1)
-
-        logger.debug("Message sent")
-    except (TypeError, ValueError, zmq.ZMQError):
-        logger.error("Message sending failed %s" % (settings.EVENT_TOPIC + topic))
+    except (TypeError, ValueError):
+        logger.error("Message sending failed %s" % topic)
+        return False
+    logger.debug(f"Sending message {data} to {endpoint}")
+    return get_sender(endpoint).send(topic, msg)
 
 
 @receiver(post_save, sender=PDUAgent)
 def on_pduagent_save(sender, instance, created, **kwargs):
-    if instance.message:
-        data = {
-            "agent": str(instance.name),
-            "cmd": str(instance.message),
-        }
-        logger.debug(f"Sending message with data {data}")
-        send_message(".pduagent", data)
+    if instance.message and "message" in instance.get_changed_fields():
+        # message set manually is queued as a regular command
+        PDUAgentCommand.objects.create(agent=instance, command=instance.message)
+        PDUAgent.objects.filter(pk=instance.pk).update(message=None)
         instance.message = None
-        instance.save()
+
+
+@receiver(post_save, sender=PDUAgentCommand)
+def on_pduagentcommand_save(sender, instance, created, **kwargs):
+    if not created:
+        return
+    data = {
+        "agent": str(instance.agent.name),
+        "cmd": str(instance.command),
+        "seq": instance.id,
+    }
+    # agent instance might be loaded before it connected
+    endpoint = PDUAgent.objects.filter(pk=instance.agent_id).values_list("endpoint", flat=True).first()
+    if not endpoint:
+        # agent is offline, command is sent when it connects
+        logger.debug(f"Agent {instance.agent.name} is not connected")
+        return
+    logger.debug(f"Sending message with data {data} to {endpoint}")
+    transaction.on_commit(lambda: send_message(".pduagent", data, endpoint))
 
 
 @receiver(post_save, sender=Project)
 def on_project_save(sender, instance, created, **kwargs):
-    #if created:
-    #    create_project_repository.delay(instance.id)
-    create_project_repository.delay(instance.id)
+    # unrelated changes (e.g. backends edited in admin)
+    # don't touch the repository
+    if created or instance.get_changed_fields():
+        create_project_repository.delay(instance.id)
+
+
+def notify_listener(backend_id):
+    # listener reconnects to the backend after the change is committed
+    data = {"backend": backend_id}
+    transaction.on_commit(
+        lambda: send_message(".lavabackend", data, settings.LISTENER_ZMQ_SOCKET)
+    )
+
+
+@receiver(post_save, sender=LAVABackend)
+def on_lavabackend_save(sender, instance, created, **kwargs):
+    if created or instance.get_changed_fields():
+        notify_listener(instance.id)
+
+
+@receiver(post_delete, sender=LAVABackend)
+def on_lavabackend_delete(sender, instance, **kwargs):
+    notify_listener(instance.id)
@@ -12,27 +12,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import csv
 import gitdb
 import os
-import requests
-import subprocess
+import time
 import yaml
 from conductor.celery import app as celery
+from conductor.core import repository as git_repository
 from celery.utils.log import get_task_logger
-from conductor.core.models import Run, Build, LAVADeviceType, LAVADevice, LAVAJob, Project
+from conductor.core.http_client import fio_client
+from conductor.core.models import (
+    Run,
+    Build,
+    LAVABackend,
+    LAVADeviceType,
+    LAVADevice,
+    LAVAJob,
+    ManifestCommit,
+    PDUAgentCommand,
+    PendingRun,
+    Project,
+    expected_test_names
+)
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from django.conf import settings
 from django.db import transaction
 from django.template.loader import get_template
 from django.utils import timezone
-from git import Repo
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+from git.exc import GitCommandError, InvalidGitRepositoryError, NoSuchPathError
+from requests.exceptions import RequestException
 from urllib.parse import urljoin
 
 
 logger = get_task_logger(__name__)
-DEFAULT_TIMEOUT = 30
+
+# transient network errors or repository not cloned yet.
+# Tasks reading the project repository are retried
+REPOSITORY_ERRORS = (GitCommandError, InvalidGitRepositoryError, NoSuchPathError)
 
 translate_result = {
     "pass": "PASSED",
@@ -41,43 +58,65 @@ translate_result = {
     "unknown": "SKIPPED"
 }
 
-def requests_retry_session(
-    retries=3,
-    backoff_factor=1.0,
-    status_forcelist=(500, ),
-    session=None,
-):
-    session = session or requests.Session()
-    retry = Retry(
-        total=retries,
-        read=retries,
-        connect=retries,
-        backoff_factor=backoff_factor,
-        status_forcelist=status_forcelist,
-    )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
-
-
 def _get_os_tree_hash(url, project):
     logger.debug("Retrieving ostree hash with base url: %s" % url)
-    # ToDo: add headers for authentication
-    token = getattr(settings, "FIO_API_TOKEN", None)
-    authentication = {
-        "OSF-TOKEN": token,
-    }
-    session = requests.Session()
-    session.headers.update(authentication)
-    os_tree_hash_request = requests_retry_session(session=session).get(urljoin(url, "other/ostree.sha.txt"))
+    os_tree_hash_request = fio_client().get(urljoin(url, "other/ostree.sha.txt"))
     if os_tree_hash_request.status_code == 200:
         return os_tree_hash_request.text.strip()
     return None
 
 
-@celery.task(bind=True)
-def create_build_run(self, build_id, run_name):
+def _get_build_run(build, run_name, device_type):
+    # ostree hash of a run never changes. Check the value stored
+    # by other templates, runs or retries before asking FIO API
+    run = build.run_set.filter(run_name=run_name).exclude(ostree_hash="").first()
+    if run is not None:
+        return run
+    ostree_hash = _get_os_tree_hash(f"{build.url}runs/{run_name}/", build.project)
+    if not ostree_hash:
+        return None
+    run, _ = Run.objects.update_or_create(
+        build=build,
+        run_name=run_name,
+        defaults={
+            "device_type": device_type,
+            "ostree_hash": ostree_hash
+        }
+    )
+    return run
+
+
+def _run_concurrently(function, args_list, max_workers):
+    # returns results in the order of args_list
+    if not args_list:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(function, *args) for args in args_list]
+        return [future.result() for future in futures]
+
+
+def _submit_lava_job(project, definition):
+    try:
+        return project.submit_lava_job(definition)
+    except RequestException as e:
+        logger.error(f"LAVA job submission failed: {e}")
+    return []
+
+
+def _watch_qa_reports_job(project, build, run_name, job_id, job_name, definition):
+    try:
+        # returns HTTPResponse object or None
+        watch_response = project.watch_qa_reports_job(build, run_name, job_id)
+        if watch_response and watch_response.status_code == 201:
+            # update the testjob object in SQUAD
+            squad_job_id = watch_response.text
+            project.squad_backend.update_testjob(squad_job_id, job_name, definition)
+    except RequestException as e:
+        logger.error(f"Watching job {job_id} in SQUAD failed: {e}")
+
+
+@celery.task
+def create_build_run(build_id, run_name):
     logger.debug("Received task for build: %s" % build_id)
     build = None
     try:
@@ -86,9 +125,18 @@ def create_build_run(self, build_id, run_name):
         return None
 
     if not build.build_reason:
-        update_build_reason.delay(build.id)
-        # retry the same task in 1 minute
-        raise self.retry(countdown=60)
+        # park the run until the build reason is known.
+        # update_build_reason schedules it again
+        PendingRun.objects.get_or_create(build=build, run_name=run_name)
+        build.refresh_from_db()
+        if not build.build_reason:
+            update_build_reason.delay(build.id)
+            return None
+        # reason was saved in the meantime. Continue only if
+        # the pending run wasn't released already
+        deleted, _ = PendingRun.objects.filter(build=build, run_name=run_name).delete()
+        if not deleted:
+            return None
 
     previous_builds = build.project.build_set.filter(build_id__lt=build.build_id, tag=build.tag).order_by('-build_id')
     previous_build = None
@@ -100,6 +148,9 @@ def create_build_run(self, build_id, run_name):
     except LAVADeviceType.DoesNotExist:
         return None
 
+    # Run objects (and their ostree hashes) keyed by build ID
+    runs = {}
+    submissions = []
     templates = []
     if build.build_reason and build.schedule_tests:
         # only schedule tests when build_reason is present
@@ -142,33 +193,26 @@ def create_build_run(self, build_id, run_name):
                      "build": previous_build}
                 )
         # also create Run objects for checking the OTA status
-        run_url = f"{build.url}runs/{run_name}/"
-        ostree_hash=_get_os_tree_hash(run_url, build.project)
-        if ostree_hash:
-            run, _ = Run.objects.get_or_create(
-                build=build,
-                device_type=device_type,
-                ostree_hash=ostree_hash,
-                run_name=run_name
-            )
+        runs[build.pk] = _get_build_run(build, run_name, device_type)
+
+    callback_url = None
+    lava_backend = build.project.lava_backend
+    if settings.LAVA_CALLBACK_BASE_URL and lava_backend is not None and lava_backend.callback_token:
+        # LAVA replaces {ID} with the job ID
+        callback_url = urljoin(settings.LAVA_CALLBACK_BASE_URL, "lavajob/{ID}/")
 
     for template in templates:
         lcl_build = template.get("build")
         if not lcl_build:
             continue
         run_url = f"{lcl_build.url}runs/{run_name}/"
-        ostree_hash=_get_os_tree_hash(run_url, build.project)
-        if not ostree_hash:
+        if lcl_build.pk not in runs:
+            runs[lcl_build.pk] = _get_build_run(lcl_build, run_name, device_type)
+        run = runs[lcl_build.pk]
+        if run is None:
             logger.error("OSTree hash missing")
             continue
 
-        run, _ = Run.objects.get_or_create(
-            build=lcl_build,
-            device_type=device_type,
-            ostree_hash=ostree_hash,
-            run_name=run_name
-        )
-
         context = {
             "device_type": run_name,
             "build_url": lcl_build.url,
@@ -181,6 +225,8 @@ def create_build_run(self, build_id, run_name):
             "net_interface": device_type.net_interface,
             "os_tree_hash": run.ostree_hash,
             "target": lcl_build.build_id,
+            "callback_url": callback_url,
+            "callback_token_name": settings.LAVA_CALLBACK_TOKEN_NAME,
         }
         if run_name == "raspberrypi4-64":
             context["BOOTLOADER_URL"] = "%sother/u-boot-%s.bin" % (run_url, run_name)
@@ -196,41 +242,183 @@ def create_build_run(self, build_id, run_name):
                 pass
 
         lava_job_definition = get_template(template["name"]).render(context)
-        job_ids = build.project.submit_lava_job(lava_job_definition)
-        job_type=template.get("job_type")
+        job_definition_yaml = yaml.safe_load(lava_job_definition)
+        submissions.append({
+            "definition": lava_job_definition,
+            "job_name": job_definition_yaml.get('job_name'),
+            "expected_tests": "\n".join(expected_test_names(job_definition_yaml)),
+            "job_type": template.get("job_type"),
+            "build": lcl_build,
+        })
+
+    if not submissions:
+        return None
+    # make sure related backends are loaded before the
+    # objects are shared with submission threads
+    project = build.project
+    if project.lava_backend is None:
+        return None
+    project.squad_backend
+
+    max_workers = getattr(settings, "BACKEND_MAX_CONCURRENCY", 4)
+    submitted = _run_concurrently(
+        _submit_lava_job,
+        [(project, submission["definition"]) for submission in submissions],
+        max_workers
+    )
+    lava_jobs = []
+    watch_args = []
+    for submission, job_ids in zip(submissions, submitted):
         logger.debug(job_ids)
         for job in job_ids:
-            LAVAJob.objects.create(
+            lava_jobs.append(LAVAJob(
                 job_id=job,
-                definition=lava_job_definition,
-                project=build.project,
-                job_type=job_type,
+                definition=submission["definition"],
+                project=project,
+                job_type=submission["job_type"],
+                expected_tests=submission["expected_tests"],
+            ))
+            if submission["job_type"] == LAVAJob.JOB_LAVA:
+                watch_args.append((project, submission["build"], run_name, job, submission["job_name"], submission["definition"]))
+    LAVAJob.objects.bulk_create(lava_jobs)
+    _notify_listener(project.lava_backend, [lava_job.job_id for lava_job in lava_jobs])
+    _run_concurrently(_watch_qa_reports_job, watch_args, max_workers)
+
+
+def _notify_listener(backend, job_ids):
+    # listener drops events of jobs it doesn't know about
+    if not job_ids:
+        return
+    # signals module imports tasks
+    from conductor.core.signals import send_message
+    data = {"backend": backend.id, "jobs": [str(job_id) for job_id in job_ids]}
+    transaction.on_commit(
+        lambda: send_message(".lavajob", data, settings.LISTENER_ZMQ_SOCKET)
+    )
+
+
+def _release_pending_runs(build):
+    for pending_run in build.pendingrun_set.all():
+        # removing the row claims the run. It might have been
+        # picked up by create_build_run in the meantime
+        deleted, _ = PendingRun.objects.filter(pk=pending_run.pk).delete()
+        if deleted:
+            logger.info(f"Releasing run {pending_run.run_name} of build {build.build_id}")
+            transaction.on_commit(
+                lambda run_name=pending_run.run_name: create_build_run.delay(build.id, run_name)
             )
-            if job_type == LAVAJob.JOB_LAVA:
-                # returns HTTPResponse object or None
-                watch_response = build.project.watch_qa_reports_job(lcl_build, run_name, job)
-                if watch_response and watch_response.status_code == 201:
-                    # update the testjob object in SQUAD
-                    squad_job_id = watch_response.text
-                    job_definition_yaml = yaml.safe_load(lava_job_definition)
-                    job_name = job_definition_yaml.get('job_name')
-                    build.project.squad_backend.update_testjob(squad_job_id, job_name, lava_job_definition)
+
+
+def _project_repository_path(project):
+    return os.path.join(settings.FIO_REPOSITORY_HOME, project.name)
+
+
+def _project_repository_lock(project):
+    return git_repository.lock(project.name)
+
+
+def _update_reference_repository(initial=False):
+    # LmP objects are fetched once into the reference repository.
+    # Project repositories borrow them through git alternates.
+    # With initial=True the reference is only fetched when it
+    # doesn't exist yet.
+    reference_path = settings.FIO_REPOSITORY_REFERENCE
+    if not reference_path:
+        return None
+    with git_repository.lock(os.path.basename(os.path.normpath(reference_path))):
+        return git_repository.update_reference(
+            reference_path,
+            settings.FIO_BASE_REMOTE_NAME,
+            settings.FIO_BASE_MANIFEST,
+            initial=initial
+        )
+
+
+def _local_commit(repository, rev):
+    try:
+        return repository.commit(rev=rev)
+    except (ValueError, gitdb.exc.BadName, gitdb.exc.BadObject):
+        return None
+
+
+def _index_commits(project, repository, old_head, new_head):
+    # add commits received with the last fetch to the index
+    if new_head is None or new_head == old_head:
+        return
+    rev = new_head
+    if old_head is not None:
+        rev = f"{old_head}..{new_head}"
+    tags = {}
+    for tag in repository.tags:
+        try:
+            tags.setdefault(tag.commit.hexsha, []).append(tag.name)
+        except ValueError:
+            # tag doesn't point to a commit
+            pass
+    commits = [
+        ManifestCommit(
+            project=project,
+            sha=commit.hexsha,
+            message=commit.message[:127],
+            tags=",".join(tags.get(commit.hexsha, []))[:128]
+        )
+        for commit in repository.iter_commits(rev, max_count=settings.FIO_COMMIT_INDEX_DEPTH)
+    ]
+    ManifestCommit.objects.bulk_create(commits, ignore_conflicts=True)
+
+
+def _fetch_project_repository(project, repository, sha):
+    with _project_repository_lock(project):
+        # concurrent build of the same project might have
+        # fetched the commit while this one was waiting
+        if _local_commit(repository, sha) is not None:
+            return
+        remote = repository.remote(name=settings.FIO_REPOSITORY_REMOTE_NAME)
+        remote_head = f"{settings.FIO_REPOSITORY_REMOTE_NAME}/master"
+        old_head = _local_commit(repository, remote_head)
+        logger.info(f"Fetching {project.name} repository")
+        remote.fetch()
+        new_head = _local_commit(repository, remote_head)
+        _index_commits(
+            project,
+            repository,
+            old_head.hexsha if old_head is not None else None,
+            new_head.hexsha if new_head is not None else None
+        )
+
+
+def _get_commit_message(project, sha):
+    # index lookup first, then local object database.
+    # Remote is only fetched when the commit is unknown.
+    # Raises ValueError if the commit doesn't exist.
+    indexed_commit = ManifestCommit.objects.filter(project=project, sha=sha).first()
+    if indexed_commit is not None:
+        return indexed_commit.message
+    repository = git_repository.get_repository(_project_repository_path(project))
+    commit = _local_commit(repository, sha)
+    if commit is None:
+        _fetch_project_repository(project, repository, sha)
+        commit = repository.commit(rev=sha)
+    ManifestCommit.objects.get_or_create(
+        project=project,
+        sha=sha,
+        defaults={"message": commit.message[:127]}
+    )
+    return commit.message
 
 
 def _update_build_reason(build):
     if build.build_reason:
+        # runs parked after the reason was saved
+        _release_pending_runs(build)
         return None
-    repository_path = os.path.join(settings.FIO_REPOSITORY_HOME, build.project.name)
-    repository = Repo(repository_path)
     try:
-        remote = repository.remote(name=settings.FIO_REPOSITORY_REMOTE_NAME)
-        remote.pull(refspec="master")
         if build.commit_id:
             try:
-                commit = repository.commit(rev=build.commit_id)
+                message = _get_commit_message(build.project, build.commit_id)
                 logger.debug(f"Commit: {build.commit_id}")
-                logger.debug(f"Commit message: {commit.message}")
-                build.build_reason = commit.message[:127]
+                logger.debug(f"Commit message: {message}")
+                build.build_reason = message[:127]
             except ValueError:
                 # commit was not found in the repository
                 # this usually means build was triggered from meta-sub
@@ -239,18 +427,14 @@ def _update_build_reason(build):
                 build.schedule_tests = False
 
             build.save()
+            _release_pending_runs(build)
     except gitdb.exc.BadName:
         logger.warning(f"Commit {build.commit_id} not found in {build.project.name}")
-        logger.info("fetching remote objects")
 
 
-@celery.task
+@celery.task(autoretry_for=REPOSITORY_ERRORS, retry_backoff=True, max_retries=5)
 def update_build_commit_id(build_id, run_url):
-    token = getattr(settings, "FIO_API_TOKEN", None)
-    authentication = {
-        "OSF-TOKEN": token,
-    }
-    run_json_request = requests.get(urljoin(run_url, ".rundef.json"), headers=authentication)
+    run_json_request = fio_client().get(urljoin(run_url, ".rundef.json"))
     if run_json_request.status_code == 200:
         with transaction.atomic():
             build = None
@@ -269,7 +453,7 @@ def update_build_commit_id(build_id, run_url):
                 create_upgrade_commit.delay(build_id)
 
 
-@celery.task
+@celery.task(autoretry_for=REPOSITORY_ERRORS, retry_backoff=True, max_retries=5)
 def update_build_reason(build_id):
     build = None
     try:
@@ -277,7 +461,31 @@ def update_build_reason(build_id):
     except Build.DoesNotExist:
         return None
 
-    _update_build_reason(build)
+    try:
+        _update_build_reason(build)
+    except REPOSITORY_ERRORS as e:
+        logger.warning(f"Reading build reason of {build.build_id} ({build.project.name}) failed: {e}")
+        raise
+
+
+@celery.task
+def release_pending_runs():
+    # runs still waiting for the build reason, i.e. when all
+    # update_build_reason retries failed
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.PENDING_RUN_STALE)
+    expired = now - timedelta(seconds=settings.PENDING_RUN_EXPIRE)
+    for build in Build.objects.filter(pendingrun__created__lt=stale).distinct():
+        if build.build_reason:
+            _release_pending_runs(build)
+            continue
+        runs = build.pendingrun_set.filter(created__lt=expired)
+        for pending_run in runs:
+            logger.error(f"Dropping run {pending_run.run_name} of build {build.build_id} ({build.project.name}) without build reason")
+        runs.delete()
+        if build.pendingrun_set.exists():
+            logger.warning(f"Build {build.build_id} ({build.project.name}) has no reason yet, retrying")
+            update_build_reason.delay(build.id)
 
 
 class ProjectMisconfiguredError(Exception):
@@ -306,20 +514,17 @@ def create_upgrade_commit(build_id):
         # do nothing if build is not found
         return
     # check if repository DIR already exists
-    repository_path = os.path.join(settings.FIO_REPOSITORY_HOME, project.name)
     if not __project_repository_exists(project):
         logger.error(f"Repository for {project} missing!")
         return
-    # call shell script create empty commit
-    cmd = [os.path.join(settings.FIO_REPOSITORY_SCRIPT_PATH_PREFIX, "upgrade_commit.sh"),
-           "-d", repository_path,
-           "-r", settings.FIO_REPOSITORY_REMOTE_NAME,
-           "-m", settings.FIO_UPGRADE_ROLLBACK_MESSAGE]
-    print(cmd)
-    try:
-        subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError:
-        pass
+    with _project_repository_lock(project):
+        result = git_repository.create_empty_commit(
+            _project_repository_path(project),
+            settings.FIO_REPOSITORY_REMOTE_NAME,
+            settings.FIO_UPGRADE_ROLLBACK_MESSAGE
+        )
+    logger.info(f"Upgrade commit {project.name}: {result['status']} in {result['duration']}s")
+    return result
 
 
 @celery.task
@@ -330,24 +535,51 @@ def create_project_repository(project_id):
     except Project.DoesNotExist:
         # do nothing if project is not found
         return
-    # check if repository DIR already exists
-    repository_path = os.path.join(settings.FIO_REPOSITORY_HOME, project.name)
+    _update_reference_repository(initial=True)
+    # ProjectMisconfiguredError is raised when a file is in the way
+    __project_repository_exists(project)
+    with _project_repository_lock(project):
+        result = git_repository.checkout(
+            _project_repository_path(project),
+            "%s/%s/lmp-manifest.git" % (settings.FIO_REPOSITORY_BASE, project.name),
+            settings.FIO_REPOSITORY_TOKEN,
+            settings.FIO_REPOSITORY_REMOTE_NAME,
+            settings.FIO_BASE_REMOTE_NAME,
+            settings.FIO_BASE_MANIFEST,
+            reference=settings.FIO_REPOSITORY_REFERENCE,
+            partial_filter=settings.FIO_REPOSITORY_FILTER
+        )
+    logger.info(f"Checkout {project.name}: {result['status']} in {result['duration']}s")
+    return result
+
+
+def __merge_project_manifest(project):
+    # returns outcome of the merge for the summary
     if not __project_repository_exists(project):
-        # create repository DIR
-        os.makedirs(repository_path)
-    # call shell script to clone and configure repository
-    cmd = [os.path.join(settings.FIO_REPOSITORY_SCRIPT_PATH_PREFIX, "checkout_repository.sh"),
-           "-d", repository_path,
-           "-r", settings.FIO_REPOSITORY_REMOTE_NAME,
-           "-u", "%s/%s/lmp-manifest.git" % (settings.FIO_REPOSITORY_BASE, project.name),
-           "-l", settings.FIO_BASE_REMOTE_NAME,
-           "-w", settings.FIO_BASE_MANIFEST,
-           "-t", settings.FIO_REPOSITORY_TOKEN]
-    print(cmd)
+        # ignore project with no repository
+        return {"project": project.name, "status": git_repository.STATUS_SKIPPED, "duration": 0.0}
+    start = time.monotonic()
     try:
-        subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError:
-        pass
+        with _project_repository_lock(project):
+            result = git_repository.merge(
+                _project_repository_path(project),
+                settings.FIO_REPOSITORY_REMOTE_NAME,
+                settings.FIO_BASE_REMOTE_NAME,
+                "update-manifest: merge LmP master"
+            )
+    except Exception as e:
+        # i.e. file system errors. Remaining projects are merged
+        # and the failure is reported in the summary
+        logger.exception(f"LmP merge of {project.name} failed")
+        result = {
+            "repository": project.name,
+            "operation": "merge",
+            "status": git_repository.STATUS_FAILED,
+            "duration": round(time.monotonic() - start, 2),
+            "error": str(e),
+        }
+    result["project"] = project.name
+    return result
 
 
 @celery.task
@@ -355,23 +587,19 @@ def merge_lmp_manifest():
     # merge LmP manifest into all project manifest repositories
     # don't touch LmP manifest itself. Project named 'lmp' is
     # a fake project that only keeps the API password.
-    projects = Project.objects.all().exclude(name="lmp")
-    for project in projects:
-        repository_path = os.path.join(settings.FIO_REPOSITORY_HOME, project.name)
-        if not __project_repository_exists(project):
-            # ignore project with no repository
-            continue
-        # call shell script to merge manifests
-        cmd = [os.path.join(settings.FIO_REPOSITORY_SCRIPT_PATH_PREFIX,"merge_manifest.sh"),
-               "-d", repository_path,
-               "-r", settings.FIO_REPOSITORY_REMOTE_NAME,
-               "-l", settings.FIO_BASE_REMOTE_NAME]
-        logger.info("Calling merge_manifest.sh script")
-        logger.info(" ".join(cmd))
-        try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError:
-            pass
+    # Projects are merged in parallel so a slow push doesn't
+    # hold the remaining projects.
+    projects = list(Project.objects.all().exclude(name="lmp"))
+    # LmP objects are downloaded once for all projects
+    _update_reference_repository()
+    summary = _run_concurrently(
+        __merge_project_manifest,
+        [(project,) for project in projects],
+        settings.FIO_MERGE_CONCURRENCY
+    )
+    for result in summary:
+        logger.info(f"LmP merge {result['project']}: {result['status']} in {result['duration']}s")
+    return summary
 
 
 #@celery.task
@@ -390,10 +618,7 @@ def device_pdu_action(device_id, power_on=True):
         return
     # get device dictionary
     device_dict_url = urljoin(lava_device.project.lava_backend.lava_url, f"devices/{lava_device.name}/dictionary?render=true")
-    auth = {
-        "Authorization": f"Token {lava_device.project.lava_backend.lava_api_token}"
-    }
-    device_request = requests.get(device_dict_url, headers=auth)
+    device_request = lava_device.project.lava_backend.client.get(device_dict_url)
     device_dict = None
     if device_request.status_code == 200:
         device_dict = yaml.load(device_request.text, Loader=yaml.SafeLoader)
@@ -405,11 +630,106 @@ def device_pdu_action(device_id, power_on=True):
         cmds = device_dict['commands']['power_off']
     if not isinstance(cmds, list):
         cmds = [cmds]
-    # use PDUAgent to run command(s) remotely
+    # use PDUAgent to run command(s) remotely.
+    # Commands are delivered in order of creation.
     if lava_device.pduagent:
+        if not lava_device.pduagent.is_alive():
+            # commands are sent when the agent connects again
+            logger.warning(f"PDU agent {lava_device.pduagent.name} of {lava_device.name} is not responding")
         for cmd in cmds:
-            lava_device.pduagent.message = cmd
-            lava_device.pduagent.save()
+            PDUAgentCommand.objects.create(agent=lava_device.pduagent, command=cmd)
+
+
+def __get_suite_tests__(client, tests_url):
+    results = []
+    tests_resp = client.get(tests_url)
+    while tests_resp.status_code == 200:
+        tests_content = tests_resp.json()
+        for test_result in tests_content['results']:
+            #metadata = yaml.load(test_result['metadata'], Loader=yaml.SafeLoader)
+            results.append(
+                {
+                    "name": test_result['name'],
+                    "status": translate_result[test_result['result']],
+                    "local_ts": 0
+                }
+            )
+        if tests_content['next']:
+            tests_resp = client.get(tests_content['next'])
+        else:
+            break
+    return results
+
+
+def __get_paged_results__(client, lava_url, job_id):
+    # returns test results keyed by LAVA suite name
+    suites = []
+    suites_resp = client.get(urljoin(lava_url, f"jobs/{job_id}/suites/"))
+    while suites_resp.status_code == 200:
+        suites_content = suites_resp.json()
+        suites = suites + [suite for suite in suites_content['results'] if suite['name'] != 'lava']
+        if suites_content['next']:
+            suites_resp = client.get(suites_content['next'])
+        else:
+            break
+
+    # test pages of all suites are retrieved in parallel
+    suites_tests = _run_concurrently(
+        __get_suite_tests__,
+        [(client, urljoin(lava_url, f"jobs/{job_id}/suites/{suite['id']}/tests")) for suite in suites],
+        getattr(settings, "BACKEND_MAX_CONCURRENCY", 4)
+    )
+    return {suite['name']: suite_tests for suite, suite_tests in zip(suites, suites_tests)}
+
+
+def __iter_yaml_sequence__(stream):
+    # yields items of the top level YAML sequence one at a time,
+    # the export of large jobs is never held in memory as a whole
+    loader = yaml.SafeLoader(stream)
+    try:
+        loader.get_event()
+        if loader.check_event(yaml.StreamEndEvent):
+            return
+        loader.get_event()
+        if not loader.check_event(yaml.SequenceStartEvent):
+            # not a list, i.e. empty document
+            yield from loader.construct_document(loader.compose_node(None, None)) or []
+            return
+        loader.get_event()
+        while not loader.check_event(yaml.SequenceEndEvent):
+            yield loader.construct_document(loader.compose_node(None, None))
+    finally:
+        loader.dispose()
+
+
+def __get_exported_results__(client, lava_url, job_id, results_format):
+    # returns test results keyed by LAVA suite name or None
+    # when the export can't be retrieved or parsed
+    results = {}
+    try:
+        with client.get(urljoin(lava_url, f"jobs/{job_id}/{results_format}/"), stream=True) as response:
+            if response.status_code != 200:
+                return None
+            if results_format == LAVABackend.RESULTS_CSV:
+                response.encoding = response.encoding or "utf-8"
+                test_results = csv.DictReader(response.iter_lines(decode_unicode=True))
+            else:
+                response.raw.decode_content = True
+                test_results = __iter_yaml_sequence__(response.raw)
+            for test_result in test_results:
+                if test_result['suite'] == 'lava':
+                    continue
+                results.setdefault(test_result['suite'], []).append(
+                    {
+                        "name": test_result['name'],
+                        "status": translate_result[test_result['result']],
+                        "local_ts": 0
+                    }
+                )
+    except (RequestException, csv.Error, yaml.YAMLError, KeyError, TypeError) as e:
+        logger.error(f"Invalid results export for job {job_id}: {e}")
+        return None
+    return results
 
 
 def __get_testjob_results__(device, job_id):
@@ -417,82 +737,35 @@ def __get_testjob_results__(device, job_id):
     current_target = device.get_current_target()
     target_name = current_target.get('target-name')
     lava_job_results = {}
-    authentication = {
-        "Authorization": "Token %s" % device.project.lava_backend.lava_api_token,
-    }
-    # get job definition
-    definition_resp = requests.get(
-        urljoin(device.project.lava_backend.lava_url, f"jobs/{job_id}/"),
-        headers=authentication,
-        timeout=DEFAULT_TIMEOUT
-    )
-    job_definition = None
+    client = device.project.lava_backend.client
+    # expected tests are stored when the job is submitted
     expected_test_list = []
-    if definition_resp.status_code == 200:
-        job_json = definition_resp.json()
-        job_definition = yaml.load(job_json["definition"], Loader=yaml.SafeLoader)
-        # todo: check if tests exist and they come with definitions
-        # this is only correct for some test jobs
-        for action in job_definition['actions']:
-            if 'test' in action.keys() and 'definitions' in action['test'].keys():
-                for expected_test in action['test']['definitions']:
-                    expected_test_list.append(expected_test['name'])
+    lava_job = LAVAJob.objects.filter(job_id=job_id, project=device.project).first()
+    if lava_job is not None:
+        expected_test_list = lava_job.get_expected_tests()
 
     # compare job definition with results (any missing)?
-    suites_resp = requests.get(
-        urljoin(device.project.lava_backend.lava_url, f"jobs/{job_id}/suites/"),
-        headers=authentication,
-        timeout=DEFAULT_TIMEOUT
-    )
-    while suites_resp.status_code == 200:
-        suites_content = suites_resp.json()
-        for suite in suites_content['results']:
-            if suite['name'] != 'lava':
-                index, suite_name = suite['name'].split("_", 1)
-                try:
-                    expected_test_list.remove(suite_name)
-                except ValueError:
-                    logger.error(f"Suite {suite_name} not found in expected list")
-                lava_job_results[suite_name] = {
-                    "name": suite_name,
-                    "status": "PASSED",
-                    "target-name": target_name,
-                    "results": []
-                }
-                tests_resp = requests.get(
-                    urljoin(device.project.lava_backend.lava_url, f"jobs/{job_id}/suites/{suite['id']}/tests"),
-                    headers=authentication,
-                    timeout=DEFAULT_TIMEOUT
-                )
-                while tests_resp.status_code == 200:
-                    tests_content = tests_resp.json()
-                    for test_result in tests_content['results']:
-                        #metadata = yaml.load(test_result['metadata'], Loader=yaml.SafeLoader)
-                        lava_job_results[suite_name]['results'].append(
-                            {
-                                "name": test_result['name'],
-                                "status": translate_result[test_result['result']],
-                                "local_ts": 0
-                            }
-                        )
-
-                    #lava_job_results[suite_name]['tests'] = lava_job_results[suite_name]['tests'] + tests_content['results']
-                    if tests_content['next']:
-                        tests_resp = requests.get(
-                            tests_content['next'],
-                            headers=authentication,
-                            timeout=DEFAULT_TIMEOUT
-                        )
-                    else:
-                        break
-        if suites_content['next']:
-            suites_resp = requests.get(
-                suites_content['next'],
-                headers=authentication,
-                timeout=DEFAULT_TIMEOUT
-            )
-        else:
-            break
+    backend = device.project.lava_backend
+    suites = None
+    if backend.results_format != LAVABackend.RESULTS_PAGED:
+        suites = __get_exported_results__(client, backend.lava_url, job_id, backend.results_format)
+        if suites is None:
+            logger.warning(f"Results export for job {job_id} failed. Using paged results")
+    if suites is None:
+        suites = __get_paged_results__(client, backend.lava_url, job_id)
+
+    for lava_suite_name, suite_tests in suites.items():
+        index, suite_name = lava_suite_name.split("_", 1)
+        try:
+            expected_test_list.remove(suite_name)
+        except ValueError:
+            logger.error(f"Suite {suite_name} not found in expected list")
+        lava_job_results[suite_name] = {
+            "name": suite_name,
+            "status": "PASSED",
+            "target-name": target_name,
+            "results": suite_tests
+        }
 
     return lava_job_results
 
@@ -514,10 +787,26 @@ def retrieve_lava_results(device_id, job_id):
 
 
 @celery.task
-def process_testjob_notification(event_data):
+def process_testjob_notification(event_data, backend_id=None):
+    # job IDs are unique only within a LAVA backend
     job_id = event_data.get("job")
+    lava_jobs = LAVAJob.objects.filter(job_id=job_id)
+    if backend_id is not None:
+        lava_jobs = lava_jobs.filter(project__lava_backend_id=backend_id)
     try:
-        lava_job = LAVAJob.objects.get(job_id=job_id)
+        lava_job = lava_jobs.get()
+        state = event_data.get("state")
+        if state:
+            # the state might be already processed when it
+            # was reported by both listener and notify callback
+            # or replayed by the listener catch up
+            processed = [state]
+            if state in LAVAJob.STATES:
+                processed = LAVAJob.STATES[LAVAJob.STATES.index(state):]
+            claimed = LAVAJob.objects.filter(pk=lava_job.pk).exclude(state__in=processed).update(state=state)
+            if not claimed:
+                logger.debug(f"Job {job_id} state {state} already processed")
+                return
         device_name = event_data.get("device")
         lava_db_device = None
         logger.debug(f"Processing job: {job_id}")
@@ -525,7 +814,7 @@ def process_testjob_notification(event_data):
         if device_name:
             lava_db_device = LAVADevice.objects.get(name=device_name, project=lava_job.project)
             lava_job.device = lava_db_device
-            lava_job.save()
+            lava_job.save(update_fields=["device"])
             logger.debug(f"LAVA device is: {lava_db_device.id}")
         if lava_job.job_type == LAVAJob.JOB_OTA and \
                 event_data.get("state") == "Running" and \
@@ -551,37 +840,49 @@ def process_testjob_notification(event_data):
         if lava_job.job_type == LAVAJob.JOB_LAVA and \
                 event_data.get("state") == "Finished" and \
                 lava_db_device:
-            retrieve_lava_results(lava_db_device.id, job_id)
+            # results of large jobs take long to retrieve,
+            # other events of the batch don't wait for them
+            retrieve_lava_results.delay(lava_db_device.id, job_id)
 
     except LAVAJob.DoesNotExist:
         logger.debug(f"Job {job_id} not found")
         return
+    except LAVAJob.MultipleObjectsReturned:
+        logger.error(f"Job {job_id} exists in multiple LAVA backends")
+        return
     except LAVADevice.DoesNotExist:
         logger.debug(f"Device from job {job_id} not found")
         return
 
 
+@celery.task
+def process_testjob_notifications(events, backend_id=None):
+    # events of a single backend are batched by the listener. Failing
+    # event doesn't prevent processing of the remaining ones
+    for event_data in events:
+        try:
+            process_testjob_notification(event_data, backend_id)
+        except Exception:
+            logger.exception(f"Processing of event {event_data} failed")
+
+
 @celery.task
 def process_device_notification(event_data):
     pass
 
 
 def __report_test_result(device, result):
-    token = getattr(settings, "FIO_API_TOKEN", None)
-    authentication = {
-        "OSF-TOKEN": token,
-    }
-
+    client = fio_client()
     url = f"https://api.foundries.io/ota/devices/{device.project.name}-{device.name}/tests/"
     test_dict = result.copy()
     test_dict.pop("status")
-    new_test_request = requests.post(url, json=test_dict, headers=authentication)
+    new_test_request = client.post(url, json=test_dict)
     logger.info(f"Reporting test {result['name']} for {device.name}")
     if new_test_request.status_code == 201:
         test_details = new_test_request.json()
         result.update(test_details)
         details_url = f"{url}{test_details['test-id']}"
-        update_details_request = requests.put(details_url, json=result, headers=authentication)
+        update_details_request = client.put(details_url, json=result)
         if update_details_request.status_code == 200:
             logger.debug(f"Successfully reported details for {test_details['test-id']}")
         else:
@@ -12,13 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import celery
+import http.server
 import os
+import shutil
+import tempfile
+import threading
+import unittest
+import yaml
+import zmq
+from io import BytesIO, StringIO
+from celery.exceptions import Retry
 from datetime import datetime, timedelta
 from django.conf import settings
-from django.test import TestCase
-from git import Repo
-from unittest.mock import patch, MagicMock, PropertyMock
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from git import GitCommandError, Repo
+from unittest.mock import ANY, call, patch, MagicMock, PropertyMock
 
 from conductor.core.models import (
     Project,
@@ -29,15 +40,29 @@ from conductor.core.models import (
     LAVADeviceType,
     LAVADevice,
     LAVAJob,
+    ManifestCommit,
     PDUAgent,
-    DEFAULT_TIMEOUT
+    PDUAgentCommand,
+    PendingRun,
+    expected_test_names
 )
+from conductor.core import http_client
+from conductor.core.http_client import DEFAULT_TIMEOUT, get_session, lava_client
+from conductor.core.signals import MessageSender
+from conductor.core import repository as git_repository
+from conductor.core.management.commands.benchmark_queries import hot_queries, is_indexed, seed
+from conductor.pduserver.management.commands.pduserver import update_agents
 from conductor.core.tasks import (
     create_build_run,
+    release_pending_runs,
+    retrieve_lava_results,
     device_pdu_action,
     check_ota_completed,
     create_project_repository,
     create_upgrade_commit,
+    merge_lmp_manifest,
+    process_testjob_notification,
+    process_testjob_notifications,
     update_build_reason,
     update_build_commit_id,
 )
@@ -479,7 +504,7 @@ class ProjectTest(TestCase):
             build_id="1"
         )
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_submit_lava_job(self, post_mock):
         definition = "lava test definition"
         response_mock = MagicMock()
@@ -491,7 +516,7 @@ class ProjectTest(TestCase):
         post_mock.assert_called()
         self.assertEqual(ret_list, ['123'])
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_squad_watch_job(self, post_mock):
         test_job_id = "123"
         environment = "environment"
@@ -505,13 +530,16 @@ class ProjectTest(TestCase):
         self.assertEqual(squad_watch_job_response.status_code, 201)
         post_mock.assert_called_with(
             f"{self.squadbackend1.squad_url}api/watchjob/{self.project.squad_group}/{self.project.name}/{self.build.build_id}/{environment}",
-            headers={'Auth-Token': self.squadbackend1.squad_token},
+            headers={
+                'Auth-Token': self.squadbackend1.squad_token,
+                'Authorization': f"Token {self.squadbackend1.squad_token}"
+            },
             data={'testjob_id': test_job_id, 'backend': self.squadbackend1.name},
             timeout=DEFAULT_TIMEOUT
         )
 
-    @patch('requests.put')
-    @patch('requests.get')
+    @patch('requests.Session.put')
+    @patch('requests.Session.get')
     def test_squad_update_job(self, get_mock, put_mock):
         squad_job_id = "123"
         squad_job_name = "foobar"
@@ -526,18 +554,67 @@ class ProjectTest(TestCase):
         put_mock.return_value = response_mock
 
         squad_watch_job_response = self.project.squad_backend.update_testjob(squad_job_id, squad_job_name, squad_job_definition)
+        headers = {
+            'Auth-Token': self.squadbackend1.squad_token,
+            'Authorization': f"Token {self.squadbackend1.squad_token}"
+        }
         get_mock.assert_called_with(
             f"{self.squadbackend1.squad_url}api/testjobs/{squad_job_id}",
-            headers={'Authorization': f"Token {self.squadbackend1.squad_token}"}
+            headers=headers,
+            timeout=DEFAULT_TIMEOUT
         )
         self.assertEqual(squad_watch_job_response.text, "321")
         self.assertEqual(squad_watch_job_response.status_code, 200)
         put_mock.assert_called_with(
             f"{self.squadbackend1.squad_url}api/testjobs/{squad_job_id}",
-            headers={'Authorization': f"Token {self.squadbackend1.squad_token}"},
-            data={'definition': squad_job_definition, 'name': squad_job_name}
+            headers=headers,
+            data={'definition': squad_job_definition, 'name': squad_job_name},
+            timeout=DEFAULT_TIMEOUT
+        )
+
+    @patch("conductor.core.signals.send_message")
+    def test_lavabackend_change_notifies_listener(self, send_message_mock):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lavabackend1.websocket_url = "ws://lava.example.com/ws/"
+            self.lavabackend1.save()
+        send_message_mock.assert_called_once_with(
+            ".lavabackend",
+            {"backend": self.lavabackend1.id},
+            settings.LISTENER_ZMQ_SOCKET
+        )
+        send_message_mock.reset_mock()
+        backend_id = self.lavabackend1.id
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lavabackend1.delete()
+        send_message_mock.assert_called_once_with(
+            ".lavabackend",
+            {"backend": backend_id},
+            settings.LISTENER_ZMQ_SOCKET
         )
 
+    @patch("conductor.core.signals.send_message")
+    def test_lavabackend_unrelated_change(self, send_message_mock):
+        lavabackend = LAVABackend.objects.get(pk=self.lavabackend1.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            lavabackend.results_format = LAVABackend.RESULTS_CSV
+            lavabackend.save()
+        send_message_mock.assert_not_called()
+
+    @patch("conductor.core.signals.create_project_repository.delay")
+    def test_project_save_changed_fields(self, create_project_repository_mock):
+        project = Project.objects.get(pk=self.project.pk)
+        self.assertEqual([], project.get_changed_fields())
+        project.squad_group = "othergroup"
+        project.save()
+        create_project_repository_mock.assert_not_called()
+        project.secret = "othersecret"
+        self.assertEqual(["secret"], project.get_changed_fields())
+        project.save()
+        create_project_repository_mock.assert_called_once_with(project.id)
+        # saved values are tracked after save
+        self.assertEqual([], project.get_changed_fields())
+
+
 class LAVADeviceTest(TestCase):
     def setUp(self):
         self.lavabackend1 = LAVABackend.objects.create(
@@ -569,8 +646,8 @@ class LAVADeviceTest(TestCase):
             pduagent=self.pduagent1
         )
 
-    @patch("requests.put")
-    @patch("requests.get")
+    @patch("requests.Session.put")
+    @patch("requests.Session.get")
     def test_request_maintenance(self, get_mock, put_mock):
         response_mock = MagicMock()
         response_mock.status_code = 200
@@ -587,8 +664,8 @@ class LAVADeviceTest(TestCase):
         get_mock.assert_called()
         put_mock.assert_called()
 
-    @patch("requests.put")
-    @patch("requests.get")
+    @patch("requests.Session.put")
+    @patch("requests.Session.get")
     def test_request_online(self, get_mock, put_mock):
         response_mock = MagicMock()
         response_mock.status_code = 200
@@ -604,7 +681,7 @@ class LAVADeviceTest(TestCase):
         get_mock.assert_called()
         put_mock.assert_called()
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_get_current_target(self, get_mock):
         response_mock = MagicMock()
         response_mock.status_code = 200
@@ -614,7 +691,7 @@ class LAVADeviceTest(TestCase):
         get_mock.assert_called()
         self.assertEqual(target, TARGET_DICT)
 
-    @patch("requests.delete")
+    @patch("requests.Session.delete")
     def test_remove_from_factory(self, delete_mock):
         response_mock = MagicMock()
         response_mock.status_code = 200
@@ -623,6 +700,198 @@ class LAVADeviceTest(TestCase):
         delete_mock.assert_called()
 
 
+class QueryPlanTest(TestCase):
+    def test_hot_queries_indexed(self):
+        projects = seed(projects=2, builds=200, devices=20, jobs=500)
+        project = projects[-1]
+        build = Build.objects.filter(project=project).order_by("-build_id").first()
+        device = LAVADevice.objects.filter(project=project).last()
+        for name, queryset in hot_queries(project, build, device, 250):
+            plan = queryset.explain()
+            self.assertTrue(is_indexed(plan), f"{name}: {plan}")
+
+    def test_benchmark_default_database_refused(self):
+        with self.assertRaises(CommandError):
+            call_command("benchmark_queries", database="default", stdout=StringIO())
+        self.assertFalse(Project.objects.exists())
+
+
+# django TestCase doesn't allow connections to databases
+# registered at runtime
+class BenchmarkTemporaryDatabaseTest(unittest.TestCase):
+    def test_benchmark_temporary_database(self):
+        output = StringIO()
+        call_command("benchmark_queries", projects=2, builds=20, devices=10, jobs=50, repeat=1, stdout=output)
+        self.assertIn("Seeded 20 builds and 50 jobs", output.getvalue())
+        self.assertFalse(Project.objects.filter(name__startswith="benchmark-").exists())
+
+
+class HttpClientTest(TestCase):
+    def setUp(self):
+        self.lavabackend1 = LAVABackend.objects.create(
+            name="testLavaBackend1",
+            lava_url="http://lava.example.com/api/v0.2/",
+            lava_api_token="lavatoken",
+        )
+
+    def test_shared_session(self):
+        self.assertIs(get_session(), get_session())
+
+    @patch("requests.Session.get")
+    def test_lava_client_headers(self, get_mock):
+        lava_client(self.lavabackend1).get("http://lava.example.com/", headers={"Accept": "application/json"})
+        get_mock.assert_called_with(
+            "http://lava.example.com/",
+            headers={"Authorization": "Token lavatoken", "Accept": "application/json"},
+            timeout=DEFAULT_TIMEOUT
+        )
+
+
+    @override_settings(HTTP_BACKOFF_FACTOR=0)
+    def test_failed_status_returned(self):
+        requests_count = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_count.append(self.path)
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        http_client.__session__ = None
+        try:
+            response = lava_client(self.lavabackend1).get(f"http://127.0.0.1:{server.server_port}/")
+        finally:
+            server.shutdown()
+            server.server_close()
+            http_client.__session__ = None
+        # retried and the last response is returned to the caller
+        self.assertEqual(503, response.status_code)
+        self.assertEqual(settings.HTTP_RETRIES + 1, len(requests_count))
+
+
+class MessageSenderTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.endpoint = f"ipc://{self.directory}/messages"
+        self.context = zmq.Context()
+        self.pull = self.context.socket(zmq.PULL)
+        self.pull.bind(self.endpoint)
+
+    def tearDown(self):
+        self.pull.close(linger=0)
+        self.context.term()
+        shutil.rmtree(self.directory)
+
+    def test_queued_messages_sent_on_close(self):
+        sender = MessageSender(self.endpoint)
+        for index in range(100):
+            sender.send("test", [b"%d" % index])
+        sender.close(5)
+        self.assertFalse(sender.thread.is_alive())
+        received = []
+        while self.pull.poll(1000):
+            received.append(self.pull.recv_multipart())
+        self.assertEqual([[b"%d" % index] for index in range(100)], received)
+
+
+class RepositoryTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # project and LmP "servers" with a common history
+        self.lmp_url = os.path.join(self.tmpdir, "lmp.git")
+        self.origin_url = os.path.join(self.tmpdir, "origin.git")
+        work = Repo.init(os.path.join(self.tmpdir, "work"))
+        with work.config_writer() as config:
+            config.set_value("user", "email", "test@example.com")
+            config.set_value("user", "name", "Test")
+        work.index.commit("initial commit")
+        work.git.branch("-M", "master")
+        Repo.init(self.lmp_url, bare=True)
+        Repo.init(self.origin_url, bare=True)
+        work.git.push(self.lmp_url, "master")
+        work.git.push(self.origin_url, "master")
+        work.index.commit("LmP update")
+        work.git.push(self.lmp_url, "master")
+        self.path = os.path.join(self.tmpdir, "project")
+
+    def tearDown(self):
+        git_repository.forget_repository(self.path)
+        shutil.rmtree(self.tmpdir)
+
+    def __checkout(self, **kwargs):
+        return git_repository.checkout(
+            self.path, self.origin_url, "token", "origin", "lmp", self.lmp_url, **kwargs
+        )
+
+    def test_checkout(self):
+        result = self.__checkout()
+        self.assertEqual("cloned", result["status"])
+        self.assertEqual("checkout", result["operation"])
+        self.assertEqual("project", result["repository"])
+        repository = git_repository.get_repository(self.path)
+        self.assertEqual("initial commit", repository.head.commit.message)
+        self.assertEqual(self.lmp_url, repository.remote(name="lmp").url)
+        # remotes are configured already
+        self.assertEqual("unchanged", self.__checkout()["status"])
+
+    def test_checkout_reference(self):
+        reference = os.path.join(self.tmpdir, "reference")
+        result = git_repository.update_reference(reference, "lmp", self.lmp_url)
+        self.assertEqual("fetched", result["status"])
+        self.__checkout(reference=reference)
+        alternates = os.path.join(self.path, ".git", "objects", "info", "alternates")
+        with open(alternates) as alternates_file:
+            self.assertEqual(os.path.join(reference, "objects"), alternates_file.read().strip())
+        # existing reference is not fetched again
+        result = git_repository.update_reference(reference, "lmp", self.lmp_url, initial=True)
+        self.assertEqual("skipped", result["status"])
+
+    def test_checkout_failed(self):
+        self.origin_url = os.path.join(self.tmpdir, "missing.git")
+        result = self.__checkout()
+        self.assertEqual("failed", result["status"])
+        self.assertIsNotNone(result["error"])
+
+    def test_merge(self):
+        self.__checkout()
+        result = git_repository.merge(self.path, "origin", "lmp", "update-manifest: merge LmP master")
+        self.assertEqual("merged", result["status"])
+        origin = Repo(self.origin_url)
+        self.assertEqual("LmP update", origin.commit("master").message)
+
+    def test_merge_failed(self):
+        self.__checkout()
+        # LmP history without common commits can't be merged
+        # and there's no merge in progress to abort
+        unrelated = Repo.init(os.path.join(self.tmpdir, "unrelated"))
+        with unrelated.config_writer() as config:
+            config.set_value("user", "email", "test@example.com")
+            config.set_value("user", "name", "Test")
+        unrelated.index.commit("unrelated commit")
+        unrelated.git.branch("-M", "master")
+        unrelated.git.push("--force", self.lmp_url, "master")
+        result = git_repository.merge(self.path, "origin", "lmp", "update-manifest: merge LmP master")
+        self.assertEqual("failed", result["status"])
+        self.assertIn("unrelated histories", result["error"])
+
+    def test_create_empty_commit(self):
+        self.__checkout()
+        result = git_repository.create_empty_commit(self.path, "origin", settings.FIO_UPGRADE_ROLLBACK_MESSAGE)
+        self.assertEqual("committed", result["status"])
+        origin = Repo(self.origin_url)
+        commit = origin.commit("master")
+        self.assertEqual(result["commit"], commit.hexsha)
+        self.assertEqual(settings.FIO_UPGRADE_ROLLBACK_MESSAGE, commit.message)
+        self.assertEqual(commit.tree, commit.parents[0].tree)
+
+
 class TaskTest(TestCase):
     def setUp(self):
         self.lavabackend1 = LAVABackend.objects.create(
@@ -730,8 +999,8 @@ class TaskTest(TestCase):
         watch_qa_reports_mock.assert_called()
         update_testjob_mock.assert_called()
         assert 2 == submit_lava_job_mock.call_count
-        get_hash_mock.assert_called()
-        assert 2 == get_hash_mock.call_count
+        # ostree hashes of both builds are already stored
+        get_hash_mock.assert_not_called()
 
     @patch('conductor.core.tasks._get_os_tree_hash', return_value="someHash1")
     @patch('conductor.core.models.SQUADBackend.watch_lava_job', return_value=None)
@@ -749,8 +1018,8 @@ class TaskTest(TestCase):
         submit_lava_job_mock.assert_called()
         watch_lava_job_mock.assert_not_called()
         assert 2 == submit_lava_job_mock.call_count
-        get_hash_mock.assert_called()
-        assert 2 == get_hash_mock.call_count
+        # ostree hashes of both builds are already stored
+        get_hash_mock.assert_not_called()
 
     @patch('conductor.core.tasks._get_os_tree_hash', return_value="someHash1")
     @patch('conductor.core.models.Project.watch_qa_reports_job', return_value=None)
@@ -766,8 +1035,8 @@ class TaskTest(TestCase):
         submit_lava_job_mock.assert_called()
         watch_qa_reports_mock.assert_called()
         assert 2 == submit_lava_job_mock.call_count
-        get_hash_mock.assert_called()
-        assert 2 == get_hash_mock.call_count
+        # ostree hashes of both builds are already stored
+        get_hash_mock.assert_not_called()
 
     @patch('conductor.core.tasks._get_os_tree_hash', return_value="someHash1")
     @patch('conductor.core.models.Project.watch_qa_reports_job', return_value=None)
@@ -783,8 +1052,8 @@ class TaskTest(TestCase):
         submit_lava_job_mock.assert_called()
         watch_qa_reports_mock.assert_called()
         assert 5 == submit_lava_job_mock.call_count
-        get_hash_mock.assert_called()
-        assert 6 == get_hash_mock.call_count
+        # ostree hashes of both builds are already stored
+        get_hash_mock.assert_not_called()
 
     @patch('conductor.core.tasks._get_os_tree_hash', return_value="someHash1")
     @patch('conductor.core.models.Project.watch_qa_reports_job', return_value=None)
@@ -800,8 +1069,8 @@ class TaskTest(TestCase):
         submit_lava_job_mock.assert_called()
         watch_qa_reports_mock.assert_called()
         assert 4 == submit_lava_job_mock.call_count
-        get_hash_mock.assert_called()
-        assert 5 == get_hash_mock.call_count
+        # ostree hashes of both builds are already stored
+        get_hash_mock.assert_not_called()
 
     @patch('conductor.core.tasks._get_os_tree_hash', return_value="someHash1")
     @patch('conductor.core.models.Project.watch_qa_reports_job', return_value=None)
@@ -809,17 +1078,234 @@ class TaskTest(TestCase):
     @patch('conductor.core.tasks.update_build_reason')
     def test_create_build_run_no_reason(self, update_build_reason_mock, submit_lava_job_mock, watch_qa_reports_mock, get_hash_mock):
         run_name = "imx8mmevk"
-        with self.assertRaises(celery.exceptions.Retry) as context:
+        create_build_run(self.build.id, run_name)
+        update_build_reason_mock.delay.assert_called_with(self.build.id)
+        submit_lava_job_mock.assert_not_called()
+        watch_qa_reports_mock.assert_not_called()
+        # run waits for the build reason
+        self.assertTrue(PendingRun.objects.filter(build=self.build, run_name=run_name).exists())
+
+    @patch.object(Repo, "remote")
+    @patch.object(Repo, "commit")
+    def test_update_build_reason_indexed_commit(self, commit_mock, remote_mock):
+        ManifestCommit.objects.create(
+            project=self.project,
+            sha="aaabbbcccddd",
+            message="indexed message"
+        )
+        self.build.commit_id = "aaabbbcccddd"
+        self.build.save()
+        update_build_reason(self.build.id)
+        commit_mock.assert_not_called()
+        remote_mock.assert_not_called()
+        self.build.refresh_from_db()
+        self.assertEqual(self.build.build_reason, "indexed message")
+
+    @patch.object(Repo, "remote")
+    @patch.object(Repo, "commit")
+    def test_update_build_reason_indexes_commit(self, commit_mock, remote_mock):
+        commit = MagicMock()
+        type(commit).message = PropertyMock(return_value="abc")
+        commit_mock.return_value = commit
+        self.build.commit_id = "aaabbbcccddd"
+        self.build.save()
+        update_build_reason(self.build.id)
+        self.assertEqual(
+            ManifestCommit.objects.get(project=self.project, sha="aaabbbcccddd").message,
+            "abc"
+        )
+
+    @patch("conductor.core.tasks.create_build_run.delay")
+    @patch.object(Repo, "remote")
+    @patch.object(Repo, "commit")
+    def test_update_build_reason_releases_pending_runs(self, commit_mock, remote_mock, create_build_run_mock):
+        commit = MagicMock()
+        type(commit).message = PropertyMock(return_value="abc")
+        commit_mock.return_value = commit
+        PendingRun.objects.create(build=self.build, run_name="imx8mmevk")
+        PendingRun.objects.create(build=self.build, run_name="raspberrypi4-64")
+
+        self.build.commit_id = "aaabbbcccddd"
+        self.build.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            update_build_reason(self.build.id)
+        create_build_run_mock.assert_any_call(self.build.id, "imx8mmevk")
+        create_build_run_mock.assert_any_call(self.build.id, "raspberrypi4-64")
+        self.assertFalse(PendingRun.objects.filter(build=self.build).exists())
+
+    @patch("conductor.core.tasks.create_build_run.delay")
+    def test_update_build_reason_already_set(self, create_build_run_mock):
+        self.build.build_reason = "abc"
+        self.build.save()
+        PendingRun.objects.create(build=self.build, run_name="imx8mmevk")
+        with self.captureOnCommitCallbacks(execute=True):
+            update_build_reason(self.build.id)
+        create_build_run_mock.assert_called_once_with(self.build.id, "imx8mmevk")
+        self.assertFalse(PendingRun.objects.filter(build=self.build).exists())
+
+    @patch("conductor.core.tasks._update_build_reason", side_effect=GitCommandError("fetch", 128))
+    def test_update_build_reason_retried(self, update_mock):
+        self.build.commit_id = "aaabbbcccddd"
+        self.build.save()
+        # task is scheduled again instead of failing
+        with self.assertRaises(Retry):
+            update_build_reason.apply(args=(self.build.id,), throw=True)
+        update_mock.assert_called_once()
+
+    @patch("conductor.core.tasks.update_build_reason.delay")
+    @patch("conductor.core.tasks.create_build_run.delay")
+    def test_release_pending_runs(self, create_build_run_mock, update_build_reason_mock):
+        old = timezone.now() - timedelta(seconds=settings.PENDING_RUN_STALE + 1)
+        expired = timezone.now() - timedelta(seconds=settings.PENDING_RUN_EXPIRE + 1)
+        self.build.build_reason = "abc"
+        self.build.save()
+        self.previous_build.build_reason = None
+        self.previous_build.save()
+        PendingRun.objects.create(build=self.build, run_name="imx8mmevk")
+        PendingRun.objects.create(build=self.previous_build, run_name="imx8mmevk")
+        PendingRun.objects.create(build=self.previous_build, run_name="raspberrypi4-64")
+        # created is set with auto_now_add
+        PendingRun.objects.filter(build=self.build).update(created=old)
+        PendingRun.objects.filter(build=self.previous_build, run_name="imx8mmevk").update(created=old)
+        PendingRun.objects.filter(build=self.previous_build, run_name="raspberrypi4-64").update(created=expired)
+        with self.captureOnCommitCallbacks(execute=True):
+            release_pending_runs()
+        create_build_run_mock.assert_called_once_with(self.build.id, "imx8mmevk")
+        update_build_reason_mock.assert_called_once_with(self.previous_build.id)
+        self.assertEqual(
+            ["imx8mmevk"],
+            [run.run_name for run in PendingRun.objects.all()]
+        )
+
+    @patch('conductor.core.tasks._get_os_tree_hash', return_value="someHash1")
+    @patch('conductor.core.models.Project.watch_qa_reports_job', return_value=None)
+    @patch('conductor.core.models.Project.submit_lava_job', return_value=[123])
+    @patch('conductor.core.tasks.update_build_reason')
+    def test_create_build_run_upgrade_build_fetch_hash(self, update_build_reason_mock, submit_lava_job_mock, watch_qa_reports_mock, get_hash_mock):
+        run_name = "imx8mmevk"
+        Run.objects.filter(run_name=run_name).delete()
+        self.build.build_reason = settings.FIO_UPGRADE_ROLLBACK_MESSAGE
+        self.build.schedule_tests = False
+        self.build.save()
+        create_build_run(self.build.id, run_name)
+        assert 5 == submit_lava_job_mock.call_count
+        # hash is retrieved once per build and reused by all templates
+        assert 2 == get_hash_mock.call_count
+        self.assertEqual(self.build.run_set.get(run_name=run_name).ostree_hash, "someHash1")
+        self.assertEqual(self.previous_build.run_set.get(run_name=run_name).ostree_hash, "someHash1")
+        # retried task doesn't fetch the hash again
+        create_build_run(self.build.id, run_name)
+        assert 2 == get_hash_mock.call_count
+
+    @patch("conductor.core.signals.send_message")
+    @patch('conductor.core.tasks._get_os_tree_hash', return_value="someHash1")
+    @patch('conductor.core.models.Project.watch_qa_reports_job', return_value=None)
+    @patch('conductor.core.models.Project.submit_lava_job', side_effect=[[123], [124], [125], [126], [127]])
+    @patch('conductor.core.tasks.update_build_reason')
+    def test_create_build_run_lava_jobs(self, update_build_reason_mock, submit_lava_job_mock, watch_qa_reports_mock, get_hash_mock, send_message_mock):
+        run_name = "imx8mmevk"
+        self.build.build_reason = settings.FIO_UPGRADE_ROLLBACK_MESSAGE
+        self.build.schedule_tests = False
+        self.build.save()
+        with self.captureOnCommitCallbacks(execute=True):
             create_build_run(self.build.id, run_name)
-            update_build_reason_mock.assert_called()
-            submit_lava_job_mock.assert_not_called()
-            watch_qa_reports_mock.assert_not_called()
+        self.assertEqual(5, LAVAJob.objects.filter(project=self.project).count())
+        # listener learns about the new jobs
+        send_message_mock.assert_called_once_with(
+            ".lavajob",
+            {"backend": self.lavabackend1.id, "jobs": ["123", "124", "125", "126", "127"]},
+            settings.LISTENER_ZMQ_SOCKET
+        )
+        self.assertEqual(1, LAVAJob.objects.filter(job_type=LAVAJob.JOB_OTA).count())
+        # only LAVA jobs are watched in SQUAD
+        assert 4 == watch_qa_reports_mock.call_count
+        for lava_job in LAVAJob.objects.all():
+            self.assertEqual(lava_job.get_expected_tests(), expected_test_names(yaml.safe_load(lava_job.definition)))
+
+    @override_settings(LAVA_CALLBACK_BASE_URL="https://conductor.example.com/api/")
+    @patch('conductor.core.tasks._get_os_tree_hash', return_value="someHash1")
+    @patch('conductor.core.models.Project.watch_qa_reports_job', return_value=None)
+    @patch('conductor.core.models.Project.submit_lava_job', return_value=[123])
+    @patch('conductor.core.tasks.update_build_reason')
+    def test_create_build_run_notify_callback(self, update_build_reason_mock, submit_lava_job_mock, watch_qa_reports_mock, get_hash_mock):
+        self.lavabackend1.callback_token = "callbacktoken"
+        self.lavabackend1.save()
+        self.build.build_reason = "Hello world"
+        self.build.save()
+        create_build_run(self.build.id, "imx8mmevk")
+        definition = yaml.safe_load(LAVAJob.objects.first().definition)
+        self.assertEqual(
+            "https://conductor.example.com/api/lavajob/{ID}/",
+            definition["notify"]["callback"]["url"]
+        )
+        self.assertEqual(settings.LAVA_CALLBACK_TOKEN_NAME, definition["notify"]["callback"]["token"])
+
+    @patch("conductor.core.tasks.retrieve_lava_results")
+    def test_process_testjob_notification_duplicate(self, retrieve_lava_results_mock):
+        LAVAJob.objects.create(
+            job_id=123,
+            definition="",
+            project=self.project,
+            job_type=LAVAJob.JOB_LAVA
+        )
+        event_data = {"job": "123", "device": self.lava_device1.name, "state": "Finished", "health": "Complete"}
+        process_testjob_notification(event_data)
+        # the same state reported by the notify callback
+        process_testjob_notification(event_data)
+        retrieve_lava_results_mock.delay.assert_called_once_with(self.lava_device1.id, "123")
+
+    @patch("conductor.core.tasks.device_pdu_action")
+    @patch("conductor.core.models.LAVADevice.remove_from_factory")
+    @patch("conductor.core.models.LAVADevice.request_maintenance")
+    def test_process_testjob_notification_stale(self, request_maintenance_mock, remove_from_factory_mock, device_pdu_action_mock):
+        LAVAJob.objects.create(
+            job_id=123,
+            definition="",
+            project=self.project,
+            job_type=LAVAJob.JOB_OTA
+        )
+        finished = {"job": "123", "device": self.lava_device1.name, "state": "Finished", "health": "Complete"}
+        process_testjob_notification(finished)
+        # listener catch up replays earlier events of the job
+        process_testjob_notification({"job": "123", "device": self.lava_device1.name, "state": "Running", "health": "Unknown"})
+        process_testjob_notification(finished)
+        request_maintenance_mock.assert_not_called()
+        remove_from_factory_mock.assert_called_once()
+        device_pdu_action_mock.assert_called_once_with(self.lava_device1.id, power_on=True)
+
+    @patch("conductor.core.tasks.process_testjob_notification", side_effect=[ValueError("invalid"), None])
+    def test_process_testjob_notifications_failed_event(self, process_mock):
+        events = [{"job": "123", "state": "Running"}, {"job": "124", "state": "Running"}]
+        process_testjob_notifications(events, self.lavabackend1.id)
+        process_mock.assert_has_calls([call(events[0], self.lavabackend1.id), call(events[1], self.lavabackend1.id)])
+
+    @patch("conductor.core.signals.create_project_repository.delay")
+    def test_process_testjob_notification_backend(self, create_repository_mock):
+        lavabackend2 = LAVABackend.objects.create(
+            name="testLavaBackend2",
+            lava_url="http://lava2.example.com/api/v0.2/",
+            lava_api_token="lavatoken",
+        )
+        project2 = Project.objects.create(
+            name="testProject2",
+            secret="webhooksecret",
+            lava_backend=lavabackend2,
+        )
+        # the same job ID in both backends
+        lava_job1 = LAVAJob.objects.create(job_id=123, definition="", project=self.project)
+        lava_job2 = LAVAJob.objects.create(job_id=123, definition="", project=project2)
+        process_testjob_notification({"job": "123", "state": "Running"}, lavabackend2.id)
+        lava_job1.refresh_from_db()
+        lava_job2.refresh_from_db()
+        self.assertNotEqual("Running", lava_job1.state)
+        self.assertEqual("Running", lava_job2.state)
 
     @patch('conductor.core.tasks._get_os_tree_hash', return_value=None)
     @patch('conductor.core.models.Project.watch_qa_reports_job', return_value=None)
     @patch('conductor.core.models.Project.submit_lava_job', return_value=[123])
     def test_create_build_run_os_tree_hash_none(self, submit_lava_job_mock, watch_qa_reports_mock, get_hash_mock):
         run_name = "imx8mmevk"
+        Run.objects.filter(run_name=run_name).delete()
         self.build.build_reason = "Hello world"
         self.build.schedule_tests = True
         self.build.save()
@@ -829,25 +1315,243 @@ class TaskTest(TestCase):
         get_hash_mock.assert_called()
         assert 2 == get_hash_mock.call_count
 
-    @patch("requests.get")
-    @patch("conductor.core.models.PDUAgent.save")
-    def test_device_pdu_action_on(self, save_mock, get_mock):
+    @patch("conductor.core.tasks.__report_test_result")
+    @patch("conductor.core.models.LAVADevice.get_current_target", return_value=TARGET_DICT)
+    @patch("requests.Session.get")
+    def test_retrieve_lava_results(self, get_mock, get_current_target_mock, report_mock):
+        LAVAJob.objects.create(
+            job_id=123,
+            definition="",
+            project=self.project,
+            expected_tests="smoke\nboot"
+        )
+        lava_url = self.lavabackend1.lava_url
+        responses = {
+            f"{lava_url}jobs/123/suites/": {
+                "results": [{"id": 1, "name": "lava"}, {"id": 2, "name": "1_smoke"}],
+                "next": f"{lava_url}jobs/123/suites/?offset=2"
+            },
+            f"{lava_url}jobs/123/suites/?offset=2": {
+                "results": [{"id": 3, "name": "2_boot"}],
+                "next": None
+            },
+            f"{lava_url}jobs/123/suites/2/tests": {
+                "results": [{"name": "ls", "result": "pass"}],
+                "next": f"{lava_url}jobs/123/suites/2/tests?offset=1"
+            },
+            f"{lava_url}jobs/123/suites/2/tests?offset=1": {
+                "results": [{"name": "uname", "result": "fail"}],
+                "next": None
+            },
+            f"{lava_url}jobs/123/suites/3/tests": {
+                "results": [{"name": "boot", "result": "skip"}],
+                "next": None
+            },
+        }
+
+        def get_response(url, **kwargs):
+            response = MagicMock()
+            response.status_code = 200
+            response.json.return_value = responses[url]
+            return response
+        get_mock.side_effect = get_response
+
+        retrieve_lava_results(self.lava_device1.id, 123)
+        self.assertEqual(2, report_mock.call_count)
+        reported = [call.args[1] for call in report_mock.call_args_list]
+        self.assertEqual(["smoke", "boot"], [result["name"] for result in reported])
+        self.assertEqual(
+            [{"name": "ls", "status": "PASSED", "local_ts": 0},
+             {"name": "uname", "status": "FAILED", "local_ts": 0}],
+            reported[0]["results"]
+        )
+        self.assertEqual(TARGET_DICT["target-name"], reported[1]["target-name"])
+        self.assertEqual("SKIPPED", reported[1]["results"][0]["status"])
+        # job definition is not retrieved from LAVA
+        self.assertNotIn(f"{lava_url}jobs/123/", [call.args[0] for call in get_mock.call_args_list])
+
+    @patch("conductor.core.tasks.__report_test_result")
+    @patch("conductor.core.models.LAVADevice.get_current_target", return_value=TARGET_DICT)
+    @patch("requests.Session.get")
+    def test_retrieve_lava_results_csv_export(self, get_mock, get_current_target_mock, report_mock):
+        self.lavabackend1.results_format = LAVABackend.RESULTS_CSV
+        self.lavabackend1.save()
+        export_response = MagicMock()
+        export_response.status_code = 200
+        export_response.__enter__.return_value = export_response
+        export_response.iter_lines.return_value = iter([
+            "job,suite,result,measurement,unit,name",
+            "123,lava,pass,,,job",
+            "123,1_smoke,pass,,,ls",
+            "123,1_smoke,fail,,,uname",
+            "123,2_boot,skip,,,boot",
+        ])
+        get_mock.side_effect = [export_response]
+
+        retrieve_lava_results(self.lava_device1.id, 123)
+        get_mock.assert_called_once_with(f"{self.lavabackend1.lava_url}jobs/123/csv/", stream=True, headers=ANY, timeout=ANY)
+        reported = [call.args[1] for call in report_mock.call_args_list]
+        self.assertEqual(["smoke", "boot"], [result["name"] for result in reported])
+        self.assertEqual(["PASSED", "FAILED"], [test["status"] for test in reported[0]["results"]])
+
+    @patch("conductor.core.tasks.__report_test_result")
+    @patch("conductor.core.models.LAVADevice.get_current_target", return_value=TARGET_DICT)
+    @patch("requests.Session.get")
+    def test_retrieve_lava_results_yaml_export(self, get_mock, get_current_target_mock, report_mock):
+        self.lavabackend1.results_format = LAVABackend.RESULTS_YAML
+        self.lavabackend1.save()
+        export_response = MagicMock()
+        export_response.status_code = 200
+        export_response.__enter__.return_value = export_response
+        export_response.raw = BytesIO(
+            b"- {job: '123', suite: lava, result: pass, name: job}\n"
+            b"- job: '123'\n"
+            b"  suite: 1_smoke\n"
+            b"  result: pass\n"
+            b"  name: ls\n"
+            b"  metadata: {path: smoke.yaml}\n"
+            b"- {job: '123', suite: 1_smoke, result: fail, name: uname}\n"
+            b"- {job: '123', suite: 2_boot, result: skip, name: boot}\n"
+        )
+        get_mock.side_effect = [export_response]
+
+        retrieve_lava_results(self.lava_device1.id, 123)
+        get_mock.assert_called_once_with(f"{self.lavabackend1.lava_url}jobs/123/yaml/", stream=True, headers=ANY, timeout=ANY)
+        reported = [call.args[1] for call in report_mock.call_args_list]
+        self.assertEqual(["smoke", "boot"], [result["name"] for result in reported])
+        self.assertEqual(["PASSED", "FAILED"], [test["status"] for test in reported[0]["results"]])
+
+    @patch("conductor.core.tasks.__report_test_result")
+    @patch("conductor.core.models.LAVADevice.get_current_target", return_value=TARGET_DICT)
+    @patch("requests.Session.get")
+    def test_retrieve_lava_results_yaml_export_invalid(self, get_mock, get_current_target_mock, report_mock):
+        self.lavabackend1.results_format = LAVABackend.RESULTS_YAML
+        self.lavabackend1.save()
+        export_response = MagicMock()
+        export_response.status_code = 200
+        export_response.__enter__.return_value = export_response
+        export_response.raw = BytesIO(b"- {suite: 1_smoke, result: pass, name: ls}\n- [unclosed\n")
+        suites_response = MagicMock()
+        suites_response.status_code = 200
+        suites_response.json.return_value = {"results": [], "next": None}
+        get_mock.side_effect = [export_response, suites_response]
+
+        retrieve_lava_results(self.lava_device1.id, 123)
+        # partially parsed export isn't reported
+        get_mock.assert_called_with(f"{self.lavabackend1.lava_url}jobs/123/suites/", headers=ANY, timeout=ANY)
+        report_mock.assert_not_called()
+
+    @patch("conductor.core.tasks.__report_test_result")
+    @patch("conductor.core.models.LAVADevice.get_current_target", return_value=TARGET_DICT)
+    @patch("requests.Session.get")
+    def test_retrieve_lava_results_export_fallback(self, get_mock, get_current_target_mock, report_mock):
+        self.lavabackend1.results_format = LAVABackend.RESULTS_YAML
+        self.lavabackend1.save()
+        export_response = MagicMock()
+        export_response.status_code = 404
+        export_response.__enter__.return_value = export_response
+        suites_response = MagicMock()
+        suites_response.status_code = 200
+        suites_response.json.return_value = {"results": [], "next": None}
+        get_mock.side_effect = [export_response, suites_response]
+
+        retrieve_lava_results(self.lava_device1.id, 123)
+        get_mock.assert_called_with(f"{self.lavabackend1.lava_url}jobs/123/suites/", headers=ANY, timeout=ANY)
+        report_mock.assert_not_called()
+
+    @patch("conductor.core.signals.send_message")
+    @patch("requests.Session.get")
+    def test_device_pdu_action_on(self, get_mock, send_message_mock):
         response_mock = MagicMock()
         response_mock.status_code = 200
         response_mock.text = DEVICE_DICT
         get_mock.return_value = response_mock
-        device_pdu_action(self.lava_device1.pk)
-        save_mock.assert_called()
-
-    @patch("requests.get")
-    @patch("conductor.core.models.PDUAgent.save")
-    def test_device_pdu_action_off(self, save_mock, get_mock):
+        PDUAgent.objects.filter(pk=self.pduagent1.pk).update(endpoint="ipc:///tmp/pduserver1")
+        with self.captureOnCommitCallbacks(execute=True):
+            device_pdu_action(self.lava_device1.pk)
+        commands = PDUAgentCommand.objects.filter(agent=self.pduagent1)
+        self.assertEqual(["/usr/local/bin/eth008_control -r 1 -s on"], [command.command for command in commands])
+        # each command is sent with its sequence number
+        send_message_mock.assert_has_calls([
+            call(".pduagent", {"agent": self.pduagent1.name, "cmd": command.command, "seq": command.id}, "ipc:///tmp/pduserver1")
+            for command in commands
+        ])
+
+    @patch("conductor.core.signals.send_message")
+    @patch("requests.Session.get")
+    def test_device_pdu_action_off(self, get_mock, send_message_mock):
         response_mock = MagicMock()
         response_mock.status_code = 200
         response_mock.text = DEVICE_DICT
         get_mock.return_value = response_mock
-        device_pdu_action(self.lava_device1.pk, power_on=False)
-        save_mock.assert_called()
+        PDUAgent.objects.filter(pk=self.pduagent1.pk).update(endpoint="ipc:///tmp/pduserver1")
+        with self.captureOnCommitCallbacks(execute=True):
+            device_pdu_action(self.lava_device1.pk, power_on=False)
+        commands = PDUAgentCommand.objects.filter(agent=self.pduagent1)
+        self.assertEqual([
+            "/usr/local/bin/eth008_control -a 192.168.0.21 -r 1 -s off",
+            "/usr/local/bin/eth008_control -a 192.168.0.21 -r 2 -s off",
+            "/usr/local/bin/eth008_control -a 192.168.0.21 -r 3 -s off",
+        ], [command.command for command in commands])
+        # each command is sent with its sequence number
+        send_message_mock.assert_has_calls([
+            call(".pduagent", {"agent": self.pduagent1.name, "cmd": command.command, "seq": command.id}, "ipc:///tmp/pduserver1")
+            for command in commands
+        ])
+
+    @patch("conductor.core.signals.send_message")
+    def test_pduagent_message_queued(self, send_message_mock):
+        self.pduagent1.message = "reboot"
+        self.pduagent1.endpoint = "ipc:///tmp/pduserver1"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pduagent1.save()
+        self.pduagent1.refresh_from_db()
+        self.assertIsNone(self.pduagent1.message)
+        command = PDUAgentCommand.objects.get(agent=self.pduagent1)
+        self.assertEqual("reboot", command.command)
+        send_message_mock.assert_called_once_with(
+            ".pduagent",
+            {"agent": self.pduagent1.name, "cmd": "reboot", "seq": command.id},
+            "ipc:///tmp/pduserver1"
+        )
+
+    @patch("conductor.core.signals.send_message")
+    def test_pduagent_save_without_message(self, send_message_mock):
+        agent = PDUAgent.objects.get(pk=self.pduagent1.pk)
+        agent.message = "reboot"
+        agent.save()
+        self.assertEqual(1, PDUAgentCommand.objects.filter(agent=agent).count())
+        # message isn't queued again on unrelated save
+        agent.version = "2"
+        agent.save()
+        self.assertEqual(1, PDUAgentCommand.objects.filter(agent=agent).count())
+
+    def test_pduagent_ack_own_commands(self):
+        pduagent2 = PDUAgent.objects.create(name="pduagent2", version="1.0", token="token2")
+        command1 = PDUAgentCommand.objects.create(agent=self.pduagent1, command="reboot")
+        command2 = PDUAgentCommand.objects.create(agent=pduagent2, command="reboot")
+        # pduagent2 acks command of pduagent1
+        update_agents("ipc:///tmp/pduserver1", [], [], {(pduagent2.pk, command1.pk), (pduagent2.pk, command2.pk)})
+        command1.refresh_from_db()
+        command2.refresh_from_db()
+        self.assertIsNone(command1.acked)
+        self.assertIsNotNone(command2.acked)
+
+    @patch("conductor.core.signals.send_message")
+    def test_pduagent_offline_command(self, send_message_mock):
+        # command waits for the agent to connect
+        with self.captureOnCommitCallbacks(execute=True):
+            PDUAgentCommand.objects.create(agent=self.pduagent1, command="reboot")
+        send_message_mock.assert_not_called()
+
+    def test_pduagent_is_alive(self):
+        self.assertFalse(self.pduagent1.is_alive())
+        self.pduagent1.state = PDUAgent.STATE_ONLINE
+        self.pduagent1.last_ping = timezone.now() - timedelta(seconds=10)
+        self.assertTrue(self.pduagent1.is_alive())
+        # last ping wasn't written for too long
+        self.pduagent1.last_ping = timezone.now() - timedelta(seconds=settings.PDUAGENT_PING_TIMEOUT + 1)
+        self.assertFalse(self.pduagent1.is_alive())
 
     @patch("conductor.core.tasks.report_test_results")
     @patch("conductor.core.tasks.device_pdu_action")
@@ -870,39 +1574,90 @@ class TaskTest(TestCase):
         device_pdu_action_mock.assert_called()
         report_test_results_mock.assert_called()
 
-    @patch("subprocess.run")
-    @patch("os.makedirs")
-    def test_create_project_repository(self, makedirs_mock, run_mock):
+    @patch("conductor.core.repository.checkout")
+    def test_create_project_repository(self, checkout_mock):
         repository_path = os.path.join(settings.FIO_REPOSITORY_HOME, self.project.name)
-        cmd = [os.path.join(settings.FIO_REPOSITORY_SCRIPT_PATH_PREFIX, "checkout_repository.sh"),
-               "-d", repository_path,
-               "-r", settings.FIO_REPOSITORY_REMOTE_NAME,
-               "-u", "%s/%s/lmp-manifest.git" % (settings.FIO_REPOSITORY_BASE, self.project.name),
-               "-l", settings.FIO_BASE_REMOTE_NAME,
-               "-w", settings.FIO_BASE_MANIFEST,
-               "-t", settings.FIO_REPOSITORY_TOKEN]
+        checkout_mock.return_value = {"status": "unchanged", "duration": 0.0}
         create_project_repository(self.project.id)
-        # at this stage repository should already exist
-        # it is created when creating project
-        makedirs_mock.assert_not_called()
-        run_mock.assert_called_with(cmd, check=True)
+        checkout_mock.assert_called_with(
+            repository_path,
+            "%s/%s/lmp-manifest.git" % (settings.FIO_REPOSITORY_BASE, self.project.name),
+            settings.FIO_REPOSITORY_TOKEN,
+            settings.FIO_REPOSITORY_REMOTE_NAME,
+            settings.FIO_BASE_REMOTE_NAME,
+            settings.FIO_BASE_MANIFEST,
+            reference=settings.FIO_REPOSITORY_REFERENCE,
+            partial_filter=settings.FIO_REPOSITORY_FILTER
+        )
 
-    @patch("subprocess.run")
-    def test_create_upgrade_commit(self, run_mock):
+    @patch("conductor.core.repository.create_empty_commit")
+    def test_create_upgrade_commit(self, commit_mock):
         repository_path = os.path.join(settings.FIO_REPOSITORY_HOME, self.project.name)
-        cmd = [os.path.join(settings.FIO_REPOSITORY_SCRIPT_PATH_PREFIX, "upgrade_commit.sh"),
-               "-d", repository_path,
-               "-r", settings.FIO_REPOSITORY_REMOTE_NAME,
-               "-m", settings.FIO_UPGRADE_ROLLBACK_MESSAGE]
-
+        commit_mock.return_value = {"status": "committed", "duration": 0.0}
         create_upgrade_commit(self.build.id)
-        run_mock.assert_called_with(cmd, check=True)
+        commit_mock.assert_called_with(
+            repository_path,
+            settings.FIO_REPOSITORY_REMOTE_NAME,
+            settings.FIO_UPGRADE_ROLLBACK_MESSAGE
+        )
+
+    @patch("conductor.core.tasks._update_reference_repository")
+    @patch("conductor.core.repository.merge")
+    def test_merge_lmp_manifest(self, merge_mock, update_reference_mock):
+        project2 = Project.objects.create(
+            name="testProject2",
+            secret="webhooksecret",
+        )
+        Project.objects.create(
+            name="lmp",
+            secret="webhooksecret",
+        )
+        update_reference_mock.reset_mock()
+        merge_mock.side_effect = [
+            {"status": "merged", "duration": 0.1},
+            {"status": "failed", "duration": 0.1},
+        ]
+        summary = merge_lmp_manifest()
+        update_reference_mock.assert_called_once_with()
+        self.assertEqual(2, merge_mock.call_count)
+        self.assertEqual(
+            ["testProject1", "testProject2"],
+            sorted([result["project"] for result in summary])
+        )
+        self.assertEqual(
+            ["failed", "merged"],
+            sorted([result["status"] for result in summary])
+        )
+
+    @patch("conductor.core.tasks._update_reference_repository")
+    @patch("conductor.core.repository.merge")
+    def test_merge_lmp_manifest_project_error(self, merge_mock, update_reference_mock):
+        Project.objects.create(
+            name="testProject2",
+            secret="webhooksecret",
+        )
+        merge_mock.side_effect = [
+            OSError("No space left on device"),
+            {"status": "merged", "duration": 0.1},
+        ]
+        summary = merge_lmp_manifest()
+        self.assertEqual(2, merge_mock.call_count)
+        self.assertEqual(
+            ["testProject1", "testProject2"],
+            sorted([result["project"] for result in summary])
+        )
+        self.assertEqual(
+            ["failed", "merged"],
+            sorted([result["status"] for result in summary])
+        )
+        failed = [result for result in summary if result["status"] == "failed"][0]
+        self.assertEqual("No space left on device", failed["error"])
 
     @patch.object(Repo, "remote")
     @patch.object(Repo, "commit")
     def test_update_build_reason(self, commit_mock, remote_mock):
         remote = MagicMock()
-        remote.pull = MagicMock()
+        remote.fetch = MagicMock()
         remote_mock.return_value = remote
         commit = MagicMock()
         commit_message = PropertyMock(return_value="abc")
@@ -912,8 +1667,9 @@ class TaskTest(TestCase):
         self.build.commit_id = "aaabbbcccddd"
         self.build.save()
         update_build_reason(self.build.id)
-        remote_mock.assert_called()
-        remote.pull.assert_called()
+        # commit is present in the local repository
+        remote_mock.assert_not_called()
+        remote.fetch.assert_not_called()
         commit_mock.assert_called()
         commit_message.assert_called()
         self.build.refresh_from_db()
@@ -924,7 +1680,7 @@ class TaskTest(TestCase):
     @patch.object(Repo, "commit")
     def test_update_build_reason_upgrade(self, commit_mock, remote_mock):
         remote = MagicMock()
-        remote.pull = MagicMock()
+        remote.fetch = MagicMock()
         remote_mock.return_value = remote
         commit = MagicMock()
         commit_message = PropertyMock(return_value=settings.FIO_UPGRADE_ROLLBACK_MESSAGE)
@@ -934,8 +1690,9 @@ class TaskTest(TestCase):
         self.build.commit_id = "aaabbbcccddd"
         self.build.save()
         update_build_reason(self.build.id)
-        remote_mock.assert_called()
-        remote.pull.assert_called()
+        # commit is present in the local repository
+        remote_mock.assert_not_called()
+        remote.fetch.assert_not_called()
         commit_mock.assert_called()
         commit_message.assert_called()
         self.build.refresh_from_db()
@@ -946,7 +1703,7 @@ class TaskTest(TestCase):
     @patch.object(Repo, "commit", side_effect=ValueError)
     def test_update_build_reason_missing_commit(self, commit_mock, remote_mock):
         remote = MagicMock()
-        remote.pull = MagicMock()
+        remote.fetch = MagicMock()
         remote_mock.return_value = remote
         commit = MagicMock()
         commit_message = PropertyMock(return_value=settings.FIO_UPGRADE_ROLLBACK_MESSAGE)
@@ -956,8 +1713,9 @@ class TaskTest(TestCase):
         self.build.commit_id = "aaabbbcccddd"
         self.build.save()
         update_build_reason(self.build.id)
+        # unknown commit is fetched from remote
         remote_mock.assert_called()
-        remote.pull.assert_called()
+        remote.fetch.assert_called_once()
         commit_mock.assert_called()
         commit_message.assert_not_called()
         self.build.refresh_from_db()
@@ -965,12 +1723,12 @@ class TaskTest(TestCase):
         self.assertEqual(self.build.schedule_tests, True)
 
     @patch("conductor.core.tasks.create_upgrade_commit.delay")
-    @patch("requests.get")
+    @patch("requests.Session.get")
     @patch.object(Repo, "remote")
     @patch.object(Repo, "commit")
     def test_update_commit_id(self, commit_mock, remote_mock, get_mock, upgrade_mock):
         remote = MagicMock()
-        remote.pull = MagicMock()
+        remote.fetch = MagicMock()
         remote_mock.return_value = remote
         commit = MagicMock()
         commit_message = PropertyMock(return_value="abc")
@@ -983,8 +1741,9 @@ class TaskTest(TestCase):
         get_mock.return_value=request
 
         update_build_commit_id(self.build.id, "https://foo.bar.com")
-        remote_mock.assert_called()
-        remote.pull.assert_called()
+        # commit is present in the local repository
+        remote_mock.assert_not_called()
+        remote.fetch.assert_not_called()
         commit_mock.assert_called()
         commit_message.assert_called()
         self.build.refresh_from_db()
@@ -994,12 +1753,12 @@ class TaskTest(TestCase):
         upgrade_mock.assert_called()
 
     @patch("conductor.core.tasks.create_upgrade_commit.delay")
-    @patch("requests.get")
+    @patch("requests.Session.get")
     @patch.object(Repo, "remote")
     @patch.object(Repo, "commit")
     def test_update_commit_id_no_access(self, commit_mock, remote_mock, get_mock, upgrade_mock):
         remote = MagicMock()
-        remote.pull = MagicMock()
+        remote.fetch = MagicMock()
         remote_mock.return_value = remote
         commit = MagicMock()
         commit_message = PropertyMock(return_value="abc")
@@ -1013,7 +1772,7 @@ class TaskTest(TestCase):
 
         update_build_commit_id(self.build.id, "https://foo.bar.com")
         remote_mock.assert_not_called()
-        remote.pull.assert_not_called()
+        remote.fetch.assert_not_called()
         commit_mock.assert_not_called()
         commit_message.assert_not_called()
         self.build.refresh_from_db()
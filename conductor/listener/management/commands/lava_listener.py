@@ -17,96 +17,297 @@ import contextlib
 import json
 import logging
 import signal
-import subprocess
 import sys
 import time
+import zmq
+import zmq.asyncio
 
 from asgiref.sync import sync_to_async
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db.models import Field
 from django.db.utils import OperationalError
+from django.utils.dateparse import parse_datetime
+from urllib.parse import urljoin
 
-from conductor.core.models import LAVABackend
-from conductor.core.tasks import process_testjob_notification, process_device_notification
+from conductor.core.models import LAVABackend, LAVAJob
+from conductor.core.tasks import process_testjob_notifications, process_device_notification
 
 
 logger = logging.getLogger()
 
 
-async def listener_main(backend):
-
-    event = asyncio.Event()
-    await asyncio.gather(
-        listen_for_events(event, backend)
+def reconnect_delays():
+    # exponential backoff: minimum, 2*minimum, ... maximum
+    delay = getattr(settings, "LISTENER_BACKOFF_MIN", 1)
+    while True:
+        yield delay
+        delay = min(delay * 2, getattr(settings, "LISTENER_BACKOFF_MAX", 60))
+
+
+def submitted_jobs(backend):
+    # most recent jobs submitted by conductor to the backend, oldest
+    # first. Older jobs are finished and don't produce events anymore.
+    job_ids = list(LAVAJob.objects.filter(
+        project__lava_backend=backend
+    ).order_by("-id").values_list("job_id", flat=True)[:getattr(settings, "LISTENER_KNOWN_JOBS", 10000)])
+    job_ids.reverse()
+    return job_ids
+
+
+def saved_jobs(job_ids):
+    # jobs saved without the listener being notified, i.e. when
+    # the .lavajob message was lost. Returns (backend ID, job ID) pairs
+    return set(
+        (backend_id, str(job_id))
+        for (job_id, backend_id) in LAVAJob.objects.filter(
+            job_id__in=job_ids
+        ).values_list("job_id", "project__lava_backend_id")
     )
 
-async def listen_for_events(event: asyncio.Event, backend) -> None:
-    logger.info("Starting event listener")
-    while True:
-        with contextlib.suppress(aiohttp.ClientError):
-            async with aiohttp.ClientSession() as session:
-                async with session.ws_connect(backend.websocket_url) as ws:
-                    logger.info("Session connected")
-                    async for msg in ws:
-                        if msg.type != aiohttp.WSMsgType.TEXT:
-                            continue
-                        try:
-                            data = json.loads(msg.data)
-                            logger.info(data)
-                            (topic, _, dt, username, data) = data
-                            data = json.loads(data)
-                            if topic.endswith(".testjob"):
-                                logger.info(f"dispatching testjob {data['job']}")
-                                #await sync_to_async(process_testjob_notification.delay, thread_sensitive=True)(data)
-                                process_testjob_notification.delay(data)
-                            if topic.endswith(".device"):
-                                await sync_to_async(process_device_notification.delay, thread_sensitive=True)(data)
-                        except ValueError:
-                            logger.error("Invalid message: %s", msg)
-                            continue
-        await asyncio.sleep(1)
-
-
-class Listener(object):
-
-    def __init__(self, backend):
-        self.backend = backend
 
-    def run(self):
-        backend = self.backend
-        if not backend.websocket_url:
-            logger.info("Websocket URL missing. Exiting")
-            sys.exit()
+class EventDispatcher(object):
+    """
+    Drops testjob events of jobs that weren't submitted by conductor
+    and sends the remaining ones to the workers in batches.
+    """
 
-        logger.info("Backend %s starting" % backend.name)
-        signal.signal(signal.SIGINT, self.stop)
-        signal.signal(signal.SIGTERM, self.stop)
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+    def __init__(self):
+        # backend ID -> IDs of the most recent jobs submitted by
+        # conductor (at most LISTENER_KNOWN_JOBS), oldest first
+        self.__known_jobs__ = {}
+        # backend ID -> events of jobs that are not known yet
+        self.__unknown_events__ = {}
+        # backend ID -> time of the last received event
+        self.__high_water__ = {}
+        # backend ID -> events waiting for the next batch. Job IDs are
+        # unique per backend only, batches are sent for each backend
+        self.__batch__ = {}
+
+    def high_water(self, backend_id):
+        return self.__high_water__.get(backend_id)
+
+    def update_high_water(self, backend_id, dt):
+        if dt is None:
+            return
+        if dt.tzinfo is None:
+            # LAVA sends UTC time without timezone
+            dt = dt.replace(tzinfo=timezone.utc)
+        current = self.__high_water__.get(backend_id)
+        if current is None or dt > current:
+            self.__high_water__[backend_id] = dt
+
+    def add_jobs(self, backend_id, job_ids):
+        known_jobs = self.__known_jobs__.setdefault(backend_id, OrderedDict())
+        for job_id in job_ids:
+            known_jobs[str(job_id)] = None
+            known_jobs.move_to_end(str(job_id))
+        limit = getattr(settings, "LISTENER_KNOWN_JOBS", 10000)
+        while len(known_jobs) > limit:
+            known_jobs.popitem(last=False)
+        unknown_events = self.__unknown_events__.get(backend_id)
+        if not unknown_events:
+            return
+        # events received before the job was saved by conductor
+        remaining = []
+        for (received, data) in unknown_events:
+            if str(data.get("job")) in known_jobs:
+                self.__batch__.setdefault(backend_id, []).append(data)
+            else:
+                remaining.append((received, data))
+        unknown_events.clear()
+        unknown_events.extend(remaining)
+
+    def forget(self, backend_id):
+        self.__known_jobs__.pop(backend_id, None)
+        self.__unknown_events__.pop(backend_id, None)
+
+    def dispatch_testjob(self, backend, data):
+        job_id = str(data.get("job"))
+        if job_id in self.__known_jobs__.get(backend.id, ()):
+            logger.debug(f"Queueing testjob {job_id} from {backend.name}")
+            self.__batch__.setdefault(backend.id, []).append(data)
+        else:
+            # job might be submitted by conductor and not saved yet
+            unknown_events = self.__unknown_events__.setdefault(backend.id, deque())
+            unknown_events.append((time.monotonic(), data))
+
+    async def dispatch(self, backend, data):
+        (topic, _, dt, username, data) = data
+        data = json.loads(data)
+        self.update_high_water(backend.id, parse_datetime(dt))
+        if topic.endswith(".testjob"):
+            self.dispatch_testjob(backend, data)
+        if topic.endswith(".device"):
+            await sync_to_async(process_device_notification.delay, thread_sensitive=True)(data)
+
+    def __expired_events(self):
+        deadline = time.monotonic() - getattr(settings, "LISTENER_UNKNOWN_EVENT_TTL", 10)
+        limit = getattr(settings, "LISTENER_UNKNOWN_EVENTS", 1000)
+        expired = []
+        for backend_id, unknown_events in self.__unknown_events__.items():
+            while unknown_events and (unknown_events[0][0] < deadline or len(unknown_events) > limit):
+                expired.append((backend_id, unknown_events.popleft()[1]))
+        return expired
+
+    async def expire(self):
+        expired = self.__expired_events()
+        if not expired:
+            return
+        job_ids = set()
+        for (_, data) in expired:
+            with contextlib.suppress(TypeError, ValueError):
+                job_ids.add(int(data.get("job")))
+        # single query for all events about to be dropped
+        saved = await sync_to_async(saved_jobs, thread_sensitive=True)(job_ids)
+        found = {}
+        dropped = 0
+        for (backend_id, data) in expired:
+            job_id = str(data.get("job"))
+            if (backend_id, job_id) in saved:
+                found.setdefault(backend_id, set()).add(job_id)
+                self.__batch__.setdefault(backend_id, []).append(data)
+            else:
+                dropped += 1
+        for (backend_id, job_ids) in found.items():
+            # later events of the same jobs are released too
+            self.add_jobs(backend_id, job_ids)
+        logger.debug(f"Dropped {dropped} events of unknown jobs")
+
+    async def flush(self):
+        await self.expire()
+        for backend_id in list(self.__batch__.keys()):
+            batch = self.__batch__.pop(backend_id)
+            logger.info(f"Dispatching {len(batch)} testjob events of backend {backend_id}")
+            try:
+                await sync_to_async(process_testjob_notifications.delay, thread_sensitive=True)(batch, backend_id)
+            except Exception:
+                # sent again with the next batch
+                self.__batch__[backend_id] = batch + self.__batch__.get(backend_id, [])
+                raise
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(getattr(settings, "LISTENER_BATCH_INTERVAL", 0.3))
+                try:
+                    await self.flush()
+                except Exception:
+                    logger.exception("Dispatching testjob events failed")
+        finally:
+            await self.flush()
+
+
+async def get_changed_jobs(session: aiohttp.ClientSession, backend, field, since, until):
+    # jobs with start_time or end_time in (since, until).
+    # Raises aiohttp.ClientResponseError when any page can't be retrieved
+    headers = {"Authorization": f"Token {backend.lava_api_token}"}
+    url = urljoin(backend.lava_url, "jobs/")
+    params = {
+        f"{field}__gt": since.isoformat(),
+        f"{field}__lt": until.isoformat(),
+        "ordering": "id",
+    }
+    jobs = []
+    while url:
+        async with session.get(url, params=params, headers=headers) as response:
+            if response.status != 200:
+                logger.warning(f"Unable to list jobs of {backend.name}: {response.status}")
+            response.raise_for_status()
+            page = await response.json()
+        jobs += page.get("results", [])
+        # next page URL contains the filters already
+        url = page.get("next")
+        params = None
+    return jobs
+
+
+async def catch_up(session: aiohttp.ClientSession, backend, dispatcher, since, until):
+    # events lost while disconnected are rebuilt from the jobs API
+    # and go through the same path as websocket events.
+    # since comes from LAVA event timestamps and until from the local
+    # clock, the window is widened to cover the skew between them.
+    # Events seen twice are ignored as the job state only moves forward.
+    # The high water mark is kept when the jobs can't be listed,
+    # next reconnect retries the catch up from the same time
+    margin = timedelta(seconds=getattr(settings, "LISTENER_CATCH_UP_MARGIN", 60))
+    started = await get_changed_jobs(session, backend, "start_time", since - margin, until + margin)
+    finished = await get_changed_jobs(session, backend, "end_time", since - margin, until + margin)
+    events = {}
+    for job in started:
+        events.setdefault(job["id"], []).append(
+            {"job": str(job["id"]), "device": job.get("actual_device"), "state": "Running"}
+        )
+    for job in finished:
+        events.setdefault(job["id"], []).append(
+            {"job": str(job["id"]), "device": job.get("actual_device"),
+             "state": job.get("state"), "health": job.get("health")}
+        )
+    logger.info(f"Backend {backend.name} catch up since {since.isoformat()}: {len(events)} jobs")
+    for job_id in sorted(events.keys()):
+        for data in events[job_id]:
+            dispatcher.dispatch_testjob(backend, data)
+    dispatcher.update_high_water(backend.id, until)
 
-        loop.run_until_complete(listener_main(backend))
-        loop.close()
-        logger.info("Backend %s exited on its own" % backend.name)
 
-    def stop(self, signal, stack_frame):
-        logger.info("Backend %s finishing ..." % self.backend.name)
-        sys.exit()
+async def listen_for_events(session: aiohttp.ClientSession, backend, dispatcher) -> None:
+    logger.info(f"Starting event listener for {backend.name}")
+    delays = reconnect_delays()
+    while True:
+        try:
+            job_ids = await sync_to_async(submitted_jobs, thread_sensitive=True)(backend)
+            dispatcher.add_jobs(backend.id, job_ids)
+            async with session.ws_connect(backend.websocket_url, heartbeat=30) as ws:
+                logger.info(f"Session connected to {backend.name}")
+                # connection is healthy, start backoff from the beginning
+                delays = reconnect_delays()
+                connected = datetime.now(timezone.utc)
+                since = dispatcher.high_water(backend.id)
+                if since is None:
+                    # first connection, nothing was missed
+                    dispatcher.update_high_water(backend.id, connected)
+                elif backend.lava_url:
+                    # messages received in the meantime wait in the websocket
+                    await catch_up(session, backend, dispatcher, since, connected)
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    try:
+                        data = json.loads(msg.data)
+                        logger.debug(data)
+                        await dispatcher.dispatch(backend, data)
+                    except (TypeError, ValueError):
+                        logger.error("Invalid message: %s", msg)
+                        continue
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        except Exception:
+            # i.e. database or broker not available, the listener
+            # must not stop until the next reconciliation
+            logger.exception(f"Event listener for {backend.name} failed")
+        delay = next(delays)
+        logger.info(f"Backend {backend.name} disconnected, reconnecting in {delay}s")
+        await asyncio.sleep(delay)
 
 
 class ListenerManager(object):
-
-    def __init__(self):
-        self.__processes__ = {}
+    """
+    Keeps websocket connections to all LAVA backends as tasks
+    of a single event loop. All connections share one HTTP session.
+    """
+
+    def __init__(self, backend_name=None):
+        self.backend_name = backend_name
+        self.__listeners__ = {}
+        # backends changed since the last reconciliation
+        self.__changed__ = set()
+        self.dispatcher = EventDispatcher()
 
     def run(self):
-        self.setup_signals()
         self.wait_for_setup()
-        self.loop()
-        self.cleanup()
-
-    def setup_signals(self):
-        # make SIGTERM equivalent to SIGINT (e.g. control-c)
-        signal.signal(signal.SIGTERM, signal.getsignal(signal.SIGINT))
+        asyncio.run(self.main())
+        logger.info("listener manager finished")
 
     def wait_for_setup(self):
         n = 0
@@ -122,47 +323,109 @@ class ListenerManager(object):
         logger.error("Timed out waiting for database to be up")
         sys.exit(1)
 
-    def keep_listeners_running(self):
-        ids = list(self.__processes__.keys())
-
-        for backend in LAVABackend.objects.all():
-            process = self.__processes__.get(backend.id)
-            if not process:
-                self.start(backend)
-            if backend.id in ids:
+    async def main(self):
+        stop = asyncio.Event()
+        wake = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def shutdown():
+            stop.set()
+            wake.set()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, shutdown)
+        receiver = asyncio.create_task(self.receive_changes(wake))
+        flusher = asyncio.create_task(self.dispatcher.run())
+        async with aiohttp.ClientSession() as session:
+            self.session = session
+            try:
+                while not stop.is_set():
+                    wake.clear()
+                    changed, self.__changed__ = self.__changed__, set()
+                    await self.keep_listeners_running(changed)
+                    # backend changes are pushed by conductor.core.signals.
+                    # Periodic check only covers lost notifications.
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(
+                            wake.wait(),
+                            getattr(settings, "LISTENER_RECONCILE_INTERVAL", 600)
+                        )
+            finally:
+                receiver.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await receiver
+                await self.cleanup()
+                flusher.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await flusher
+
+    async def receive_changes(self, wake):
+        context = zmq.asyncio.Context.instance()
+        logger.info("Create pull socket at %r", settings.LISTENER_ZMQ_SOCKET)
+        pull = context.socket(zmq.PULL)
+        pull.bind(settings.LISTENER_ZMQ_SOCKET)
+        try:
+            while True:
+                try:
+                    msg = await pull.recv_multipart()
+                    message = json.loads(msg[2].decode("utf-8"))
+                    if "jobs" in message:
+                        # jobs submitted by conductor
+                        self.dispatcher.add_jobs(message["backend"], message["jobs"])
+                        continue
+                    logger.debug(f"Backend {message['backend']} changed")
+                    self.__changed__.add(message["backend"])
+                    wake.set()
+                except zmq.error.ZMQError as exc:
+                    logger.error("Received a ZMQ error: %s", exc)
+                except (IndexError, KeyError, ValueError):
+                    logger.error("Invalid message: %s", msg)
+        finally:
+            pull.close(linger=0)
+
+    def get_backends(self):
+        backends = LAVABackend.objects.exclude(websocket_url__isnull=True).exclude(websocket_url="")
+        if self.backend_name:
+            backends = backends.filter(name=self.backend_name)
+        return list(backends)
+
+    async def keep_listeners_running(self, changed=()):
+        backends = await sync_to_async(self.get_backends, thread_sensitive=True)()
+        ids = list(self.__listeners__.keys())
+
+        for backend in backends:
+            listener = self.__listeners__.get(backend.id)
+            if listener is not None:
                 ids.remove(backend.id)
+                (task, websocket_url) = listener
+                if backend.id not in changed and \
+                        websocket_url == backend.websocket_url and \
+                        not task.done():
+                    continue
+                # backend was reconfigured, reconnect
+                await self.stop(backend.id)
+            self.start(backend)
 
         # remaining backends were removed from the database, stop them
         for backend_id in ids:
-            self.stop(backend_id)
+            await self.stop(backend_id)
 
     def start(self, backend):
-        argv = [sys.executable, '-m', 'conductor.manage', 'lava_listener', backend.name]
-        listener = subprocess.Popen(argv)
-        self.__processes__[backend.id] = listener
+        logger.info("Backend %s starting" % backend.name)
+        task = asyncio.create_task(listen_for_events(self.session, backend, self.dispatcher))
+        self.__listeners__[backend.id] = (task, backend.websocket_url)
+
+    async def stop(self, backend_id):
+        (task, _) = self.__listeners__.pop(backend_id)
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        self.dispatcher.forget(backend_id)
+
+    async def cleanup(self):
+        for backend_id in list(self.__listeners__.keys()):
+            await self.stop(backend_id)
 
-    def loop(self):
-        try:
-            while True:
-                self.keep_listeners_running()
-                # FIXME: ideally we should have a blocking call here that waits
-                # for a change to happen in the database, but we didn't find a
-                # simple/portable way of doing that yet. Let's just sleep for a
-                # few seconds instead, for now.
-                time.sleep(60)
-        except KeyboardInterrupt:
-            pass  # cleanup() will terminate sub-processes
-
-    def cleanup(self):
-        for backend_id in list(self.__processes__.keys()):
-            self.stop(backend_id)
-
-    def stop(self, backend_id):
-        process = self.__processes__[backend_id]
-        if not process.poll():
-            process.terminate()
-            process.wait()
-        self.__processes__.pop(backend_id)
 
 class Command(BaseCommand):
     help = "Listen to LAVA websocket events"
@@ -172,7 +435,7 @@ class Command(BaseCommand):
             'BACKEND',
             nargs='?',
             type=str,
-            help='LAVA Backend name to listen to. If ommited, start the master process.',
+            help='LAVA Backend name to listen to. If ommited, listen to all backends.',
         )
 
     def handle(self, *args, **options):
@@ -185,10 +448,5 @@ class Command(BaseCommand):
             handler.setLevel(logging.INFO)
         logger.addHandler(handler)
         logger.info("Starting lava_listener command")
-        backend_name = options.get("BACKEND")
-        if backend_name:
-            backend = LAVABackend.objects.get(name=backend_name)
-            Listener(backend).run()
-        else:
-            ListenerManager().run()
+        ListenerManager(options.get("BACKEND")).run()
 
@@ -0,0 +1,256 @@
+# Copyright 2021 Foundries.io
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import aiohttp
+import asyncio
+from datetime import datetime, timezone
+from django.db.utils import OperationalError
+from django.test import TestCase, override_settings
+from unittest.mock import MagicMock, patch
+
+from conductor.core.models import LAVABackend, LAVAJob, Project
+from conductor.listener.management.commands.lava_listener import (
+    EventDispatcher,
+    catch_up,
+    listen_for_events,
+)
+
+
+class FakeResponse(object):
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(MagicMock(), (), status=self.status)
+
+
+class FakeSession(object):
+    """
+    Serves jobs API pages: (URL, filtered field) -> (status, page).
+    Field is None for the next page URLs.
+    """
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+
+    def get(self, url, params=None, headers=None):
+        self.requests.append((url, params))
+        field = None
+        if params:
+            field = [key for key in params if key.endswith("__gt")][0][:-len("__gt")]
+        status, page = self.pages[(url, field)]
+        return FakeResponse(status, page)
+
+
+class EventDispatcherTest(TestCase):
+    def setUp(self):
+        self.lavabackend1 = LAVABackend.objects.create(
+            name="testLavaBackend1",
+            lava_url="http://lava.example.com/api/v0.2/",
+            lava_api_token="lavatoken",
+        )
+        with patch("conductor.core.signals.create_project_repository.delay"):
+            self.project = Project.objects.create(
+                name="testProject1",
+                secret="webhooksecret",
+                lava_backend=self.lavabackend1
+            )
+        self.dispatcher = EventDispatcher()
+
+    @patch("conductor.listener.management.commands.lava_listener.process_testjob_notifications")
+    async def test_unknown_jobs_filtered(self, process_mock):
+        self.dispatcher.add_jobs(self.lavabackend1.id, [1])
+        self.dispatcher.dispatch_testjob(self.lavabackend1, {"job": "1", "state": "Running"})
+        self.dispatcher.dispatch_testjob(self.lavabackend1, {"job": "2", "state": "Running"})
+        await self.dispatcher.flush()
+        process_mock.delay.assert_called_once_with([{"job": "1", "state": "Running"}], self.lavabackend1.id)
+
+    @patch("conductor.listener.management.commands.lava_listener.process_testjob_notifications")
+    async def test_held_events_replayed(self, process_mock):
+        # events received before the submitted job was saved
+        self.dispatcher.dispatch_testjob(self.lavabackend1, {"job": "3", "state": "Running"})
+        self.dispatcher.dispatch_testjob(self.lavabackend1, {"job": "3", "state": "Finished"})
+        await self.dispatcher.flush()
+        process_mock.delay.assert_not_called()
+        self.dispatcher.add_jobs(self.lavabackend1.id, ["3"])
+        await self.dispatcher.flush()
+        process_mock.delay.assert_called_once_with([
+            {"job": "3", "state": "Running"},
+            {"job": "3", "state": "Finished"},
+        ], self.lavabackend1.id)
+
+    @patch("conductor.listener.management.commands.lava_listener.process_testjob_notifications")
+    async def test_events_batched(self, process_mock):
+        self.dispatcher.add_jobs(self.lavabackend1.id, ["4", "5"])
+        for job_id in ["4", "5", "4"]:
+            self.dispatcher.dispatch_testjob(self.lavabackend1, {"job": job_id})
+        await self.dispatcher.flush()
+        await self.dispatcher.flush()
+        process_mock.delay.assert_called_once_with([{"job": "4"}, {"job": "5"}, {"job": "4"}], self.lavabackend1.id)
+
+    @override_settings(LISTENER_UNKNOWN_EVENT_TTL=0)
+    @patch("conductor.listener.management.commands.lava_listener.process_testjob_notifications")
+    async def test_expired_events_of_saved_jobs(self, process_mock):
+        # .lavajob message about the job was lost
+        await LAVAJob.objects.acreate(job_id=6, definition="", project=self.project)
+        self.dispatcher.dispatch_testjob(self.lavabackend1, {"job": "6", "state": "Running"})
+        self.dispatcher.dispatch_testjob(self.lavabackend1, {"job": "7", "state": "Running"})
+        await self.dispatcher.flush()
+        process_mock.delay.assert_called_once_with([{"job": "6", "state": "Running"}], self.lavabackend1.id)
+        # the job is known from now on
+        process_mock.reset_mock()
+        self.dispatcher.dispatch_testjob(self.lavabackend1, {"job": "6", "state": "Finished"})
+        await self.dispatcher.flush()
+        process_mock.delay.assert_called_once_with([{"job": "6", "state": "Finished"}], self.lavabackend1.id)
+
+    @override_settings(LISTENER_UNKNOWN_EVENTS=2)
+    @patch("conductor.listener.management.commands.lava_listener.process_testjob_notifications")
+    async def test_unknown_events_limit(self, process_mock):
+        await LAVAJob.objects.acreate(job_id=8, definition="", project=self.project)
+        for job_id in ["8", "9", "10"]:
+            self.dispatcher.dispatch_testjob(self.lavabackend1, {"job": job_id})
+        # the oldest event over the limit is looked up
+        await self.dispatcher.flush()
+        process_mock.delay.assert_called_once_with([{"job": "8"}], self.lavabackend1.id)
+        process_mock.reset_mock()
+        self.dispatcher.add_jobs(self.lavabackend1.id, ["9", "10"])
+        await self.dispatcher.flush()
+        process_mock.delay.assert_called_once_with([{"job": "9"}, {"job": "10"}], self.lavabackend1.id)
+
+    @override_settings(LISTENER_KNOWN_JOBS=2)
+    @patch("conductor.listener.management.commands.lava_listener.process_testjob_notifications")
+    async def test_known_jobs_limit(self, process_mock):
+        self.dispatcher.add_jobs(self.lavabackend1.id, ["11", "12"])
+        # job seen again is the most recent one
+        self.dispatcher.add_jobs(self.lavabackend1.id, ["11", "13"])
+        for job_id in ["11", "12", "13"]:
+            self.dispatcher.dispatch_testjob(self.lavabackend1, {"job": job_id})
+        await self.dispatcher.flush()
+        process_mock.delay.assert_called_once_with([{"job": "11"}, {"job": "13"}], self.lavabackend1.id)
+
+    @patch("conductor.listener.management.commands.lava_listener.process_testjob_notifications")
+    async def test_failed_batch_sent_again(self, process_mock):
+        process_mock.delay.side_effect = [OSError("broker not available"), None]
+        self.dispatcher.add_jobs(self.lavabackend1.id, ["15", "16"])
+        self.dispatcher.dispatch_testjob(self.lavabackend1, {"job": "15"})
+        with self.assertRaises(OSError):
+            await self.dispatcher.flush()
+        self.dispatcher.dispatch_testjob(self.lavabackend1, {"job": "16"})
+        await self.dispatcher.flush()
+        process_mock.delay.assert_called_with([{"job": "15"}, {"job": "16"}], self.lavabackend1.id)
+
+
+class ListenForEventsTest(TestCase):
+    def setUp(self):
+        self.lavabackend1 = LAVABackend.objects.create(
+            name="testLavaBackend1",
+            lava_url="http://lava.example.com/api/v0.2/",
+            websocket_url="ws://lava.example.com/ws/",
+            lava_api_token="lavatoken",
+        )
+
+    @override_settings(LISTENER_BACKOFF_MIN=0)
+    @patch("conductor.listener.management.commands.lava_listener.submitted_jobs")
+    async def test_reconnect_after_error(self, submitted_jobs_mock):
+        # the task ends only when cancelled
+        submitted_jobs_mock.side_effect = [OperationalError("database is locked"), asyncio.CancelledError()]
+        with self.assertRaises(asyncio.CancelledError):
+            await listen_for_events(MagicMock(), self.lavabackend1, EventDispatcher())
+        self.assertEqual(2, submitted_jobs_mock.call_count)
+
+
+class CatchUpTest(TestCase):
+    def setUp(self):
+        self.lavabackend1 = LAVABackend.objects.create(
+            name="testLavaBackend1",
+            lava_url="http://lava.example.com/api/v0.2/",
+            lava_api_token="lavatoken",
+        )
+        self.dispatcher = EventDispatcher()
+        self.dispatcher.add_jobs(self.lavabackend1.id, ["11", "12", "13"])
+        self.since = datetime(2021, 5, 1, 10, 0, 0, tzinfo=timezone.utc)
+        self.until = datetime(2021, 5, 1, 10, 5, 0, tzinfo=timezone.utc)
+        jobs_url = "http://lava.example.com/api/v0.2/jobs/"
+        next_url = "http://lava.example.com/api/v0.2/jobs/?offset=2"
+        self.session = FakeSession({
+            (jobs_url, "start_time"): (200, {
+                "next": next_url,
+                "results": [
+                    {"id": 12, "actual_device": "device-2"},
+                    {"id": 13, "actual_device": "device-3"},
+                ],
+            }),
+            (next_url, None): (200, {
+                "next": None,
+                "results": [{"id": 14, "actual_device": "device-4"}],
+            }),
+            (jobs_url, "end_time"): (200, {
+                "next": None,
+                "results": [
+                    {"id": 11, "actual_device": "device-1", "state": "Finished", "health": "Complete"},
+                    {"id": 12, "actual_device": "device-2", "state": "Finished", "health": "Incomplete"},
+                ],
+            }),
+        })
+
+    @override_settings(LISTENER_CATCH_UP_MARGIN=60)
+    @patch("conductor.listener.management.commands.lava_listener.process_testjob_notifications")
+    async def test_catch_up(self, process_mock):
+        await catch_up(self.session, self.lavabackend1, self.dispatcher, self.since, self.until)
+        await self.dispatcher.flush()
+
+        # window is widened by the margin on both sides
+        self.assertEqual(3, len(self.session.requests))
+        url, params = self.session.requests[0]
+        self.assertEqual("2021-05-01T09:59:00+00:00", params["start_time__gt"])
+        self.assertEqual("2021-05-01T10:06:00+00:00", params["start_time__lt"])
+        # next page URL already contains the filters
+        self.assertEqual(("http://lava.example.com/api/v0.2/jobs/?offset=2", None), self.session.requests[1])
+        url, params = self.session.requests[2]
+        self.assertEqual("2021-05-01T09:59:00+00:00", params["end_time__gt"])
+        self.assertEqual("2021-05-01T10:06:00+00:00", params["end_time__lt"])
+
+        # job 14 wasn't submitted by conductor
+        process_mock.delay.assert_called_once_with([
+            {"job": "11", "device": "device-1", "state": "Finished", "health": "Complete"},
+            {"job": "12", "device": "device-2", "state": "Running"},
+            {"job": "12", "device": "device-2", "state": "Finished", "health": "Incomplete"},
+            {"job": "13", "device": "device-3", "state": "Running"},
+        ], self.lavabackend1.id)
+        # high water isn't moved by the margin
+        self.assertEqual(self.until, self.dispatcher.high_water(self.lavabackend1.id))
+
+    @patch("conductor.listener.management.commands.lava_listener.process_testjob_notifications")
+    async def test_catch_up_failed_request(self, process_mock):
+        self.dispatcher.update_high_water(self.lavabackend1.id, self.since)
+        next_url = "http://lava.example.com/api/v0.2/jobs/?offset=2"
+        self.session.pages[(next_url, None)] = (502, {})
+        with self.assertRaises(aiohttp.ClientResponseError):
+            await catch_up(self.session, self.lavabackend1, self.dispatcher, self.since, self.until)
+        await self.dispatcher.flush()
+        # no partial results, the catch up is retried from the same time
+        self.assertEqual(2, len(self.session.requests))
+        process_mock.delay.assert_not_called()
+        self.assertEqual(self.since, self.dispatcher.high_water(self.lavabackend1.id))
@@ -15,45 +15,258 @@
 import aiohttp
 import asyncio
 import contextlib
+import functools
 import json
 import logging
 import signal
+import time
 import zmq
 import zmq.asyncio
 from aiohttp import web
-from asgiref.sync import sync_to_async
-from conductor.core.models import PDUAgent
+from concurrent.futures import ThreadPoolExecutor
+from conductor.core.models import PDUAgent, PDUAgentCommand
+from datetime import timedelta
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, close_old_connections
+from django.utils import timezone
 from zmq.utils.strtypes import u
 
 
-async def zmq_message_forward(app):
-    logger = app["logger"]
-    context = zmq.asyncio.Context()
-    logger.info("Create pull  socket at %r", settings.INTERNAL_ZMQ_SOCKET)
-    pull = context.socket(zmq.PULL)
-    pull.bind(settings.INTERNAL_ZMQ_SOCKET)
+def __db_call(function, *args, **kwargs):
+    # connections of the executor threads are reused between
+    # calls, broken or expired ones are replaced
+    close_old_connections()
+    return function(*args, **kwargs)
+
+
+async def run_db(app, function, *args, **kwargs):
+    # runs blocking ORM calls in the bounded executor of the
+    # application instead of the single thread_sensitive thread
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        app["db"],
+        functools.partial(__db_call, function, *args, **kwargs)
+    )
+
+
+def unacked_commands(agent_id):
+    # commands older than the replay window are not executed anymore
+    since = timezone.now() - timedelta(seconds=settings.PDU_COMMAND_REPLAY_WINDOW)
+    return list(PDUAgentCommand.objects.filter(agent_id=agent_id, acked__isnull=True, created__gte=since))
+
+
+def update_agents(endpoint, online, offline, acked):
+    if online:
+        # commands for the agents are routed to this instance
+        PDUAgent.objects.filter(pk__in=online).update(
+            state=PDUAgent.STATE_ONLINE,
+            endpoint=endpoint,
+            last_ping=timezone.now()
+        )
+    if offline:
+        # agent might be connected to another pduserver instance already
+        PDUAgent.objects.filter(pk__in=offline, endpoint=endpoint).update(
+            state=PDUAgent.STATE_OFFLINE,
+            endpoint=None
+        )
+    # acks are (agent ID, sequence number) pairs. Agent can
+    # only acknowledge its own commands
+    commands = {}
+    for agent_id, seq in acked:
+        commands.setdefault(agent_id, []).append(seq)
+    now = timezone.now()
+    for agent_id, seqs in commands.items():
+        PDUAgentCommand.objects.filter(agent_id=agent_id, pk__in=seqs).update(acked=now)
+
+
+def update_pings(pings):
+    PDUAgent.objects.bulk_update(
+        [PDUAgent(pk=pk, last_ping=last_ping) for pk, last_ping in pings.items()],
+        ["last_ping"]
+    )
+
+
+def release_agents(endpoint, names=None):
+    agents = PDUAgent.objects.filter(endpoint=endpoint)
+    if names is not None:
+        agents = agents.filter(name__in=names)
+    agents.update(state=PDUAgent.STATE_OFFLINE, endpoint=None)
+
+
+def set_agent_state(app, agent, state):
+    # last transition before the next flush wins
+    app["states"][agent.pk] = (agent.name, state)
+
+
+async def flush_updates(app):
+    if not app["states"] and not app["acks"]:
+        return
+    states, app["states"] = app["states"], {}
+    acks, app["acks"] = app["acks"], set()
+    online = [pk for pk, (name, state) in states.items() if state == PDUAgent.STATE_ONLINE]
+    offline = [pk for pk, (name, state) in states.items() if state == PDUAgent.STATE_OFFLINE]
+    try:
+        await run_db(app, update_agents, app["endpoint"], online, offline, acks)
+    except Exception as e:
+        app["logger"].error(f"Updating {len(states)} agents failed: {e}")
+        # retried with the next flush unless changed in the meantime
+        for pk, value in states.items():
+            app["states"].setdefault(pk, value)
+        if isinstance(e, DatabaseError):
+            app["acks"].update(acks)
+        return
+    app["logger"].debug(f"Updated {len(online)} online, {len(offline)} offline agents, {len(acks)} acks")
+    for pk in online:
+        # commands created before the endpoint was stored were
+        # not routed to this instance
+        name = states[pk][0]
+        if name not in app["agents"]:
+            continue
+        try:
+            await deliver_commands(app, pk, name)
+        except Exception as e:
+            # agent is sent the commands again when it reconnects
+            app["logger"].warning(f"Delivering commands to {name} failed: {e!r}")
+
+
+def record_ping(app, agent):
+    # agent answered a ping or sent a message
+    now = timezone.now()
+    app["seen"][agent.name] = now
+    app["pings"][agent.pk] = now
+
+
+async def flush_pings(app):
+    if not app["pings"]:
+        return
+    pings, app["pings"] = app["pings"], {}
+    try:
+        await run_db(app, update_pings, pings)
+    except Exception as e:
+        app["logger"].error(f"Updating last ping of {len(pings)} agents failed: {e}")
+        for pk, last_ping in pings.items():
+            app["pings"].setdefault(pk, last_ping)
+
+
+async def __flush(app, flush):
+    # a failed flush must not stop the writer
+    try:
+        await flush(app)
+    except Exception:
+        app["logger"].exception(f"{flush.__name__} failed")
+
+
+async def periodic_writer(app, flush, interval):
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await __flush(app, flush)
+    finally:
+        await __flush(app, flush)
+
 
-    async def forward_message(msg):
+def queue_command(app, message, age=0):
+    # in-memory mirror of unacked commands of each agent:
+    # seq -> [expires, message, connection the command was sent to]
+    expires = time.monotonic() + settings.PDU_COMMAND_REPLAY_WINDOW - age
+    return app["commands"].setdefault(message["agent"], {}).setdefault(
+        message["seq"], [expires, message, None]
+    )
+
+
+def mark_sent(entry, ws):
+    # command is sent once on each connection of the agent, no
+    # matter if it's forwarded, replayed or delivered after flush.
+    # Marked before sending, concurrent deliveries skip it
+    if entry[2] is ws:
+        return False
+    entry[2] = ws
+    return True
+
+
+async def deliver_commands(app, agent_id, agent_name):
+    commands = app["commands"].setdefault(agent_name, {})
+    # commands queued while the agent was connected elsewhere
+    # or this process wasn't running
+    now = timezone.now()
+    queued = set(commands.keys())
+    unacked = await run_db(app, unacked_commands, agent_id)
+    unacked = [command for command in unacked if (agent_id, command.id) not in app["acks"]]
+    for seq in queued - set(command.id for command in unacked):
+        # acknowledged through another pduserver instance. Commands
+        # forwarded during the query are not in its result
+        commands.pop(seq, None)
+    for command in unacked:
+        if command.id not in commands:
+            queue_command(
+                app,
+                {"agent": agent_name, "cmd": command.command, "seq": command.id},
+                (now - command.created).total_seconds()
+            )
+    ws = app["agents"].get(agent_name)
+    for seq in sorted(commands.keys()):
+        # acknowledged while sending the previous one
+        entry = commands.get(seq)
+        if entry is None:
+            continue
+        if entry[0] < time.monotonic():
+            app["logger"].warning(f"Dropping expired command {seq} for {agent_name}")
+            commands.pop(seq)
+            continue
+        if ws is None or not mark_sent(entry, ws):
+            continue
+        app["logger"].debug(f"Sending command {seq} to {agent_name}")
+        await ws.send_json(entry[1])
+
+
+async def forward_message(app, msg):
+    # errors are handled per message, one broken message or
+    # closing agent connection doesn't stop the forwarding
+    try:
         data = [s.decode("utf-8") for s in msg]
         app["logger"].debug("Forwarding: %s", data[0])
         message = json.loads(data[2])
         agent_name = message["agent"]
-        agent_ws = app["agents"].get(agent_name)
-        if agent_ws is not None:
+    except (IndexError, KeyError, TypeError, ValueError) as e:
+        app["logger"].error(f"Invalid message {msg!r}: {e!r}")
+        return
+    entry = None
+    if "seq" in message:
+        # kept until the agent acknowledges the command
+        entry = queue_command(app, message)
+    agent_ws = app["agents"].get(agent_name)
+    if agent_ws is not None:
+        if entry is not None and not mark_sent(entry, agent_ws):
+            # replayed after the agent connected
+            return
+        try:
             await agent_ws.send_json(message)
-            app["logger"].debug("Message: %s sent", data[0])
-            app["logger"].debug("%s", message)
+        except (ConnectionError, RuntimeError) as e:
+            # commands are sent again when the agent reconnects
+            app["logger"].warning(f"Sending message to {agent_name} failed: {e!r}")
+            return
+        app["logger"].debug("Message: %s sent", data[0])
+        app["logger"].debug("%s", message)
+
+
+async def zmq_message_forward(app):
+    logger = app["logger"]
+    context = zmq.asyncio.Context()
+    logger.info("Create pull  socket at %r", app["endpoint"])
+    pull = context.socket(zmq.PULL)
+    pull.bind(app["endpoint"])
 
     with contextlib.suppress(asyncio.CancelledError):
         logger.info("waiting for events")
         while True:
             try:
                 msg = await pull.recv_multipart()
-                await forward_message(msg)
+                await forward_message(app, msg)
             except zmq.error.ZMQError as exc:
                 logger.error("Received a ZMQ error: %s", exc)
+            except Exception:
+                logger.exception("Forwarding message failed")
 
     endpoint = u(pull.getsockopt(zmq.LAST_ENDPOINT))
     pull.unbind(endpoint)
@@ -68,12 +281,14 @@ async def zmq_message_forward(app):
     while True:
         try:
             msg = await asyncio.wait_for(pull.recv_multipart(), settings.INTERNAL_ZMQ_TIMEOUT)
-            await forward_message(msg)
+            await forward_message(app, msg)
         except zmq.error.ZMQError as exc:
             logger.error("Received a ZMQ error: %s", exc)
         except asyncio.TimeoutError:
             logger.info("Timing out")
             break
+        except Exception:
+            logger.exception("Forwarding message failed")
 
     pull.close(linger=1)
     context.term()
@@ -83,7 +298,8 @@ async def websocket_handler(request):
     logger = request.app["logger"]
     logger.info(f"connection from {request.remote}")
 
-    ws = web.WebSocketResponse(autoping=True, heartbeat=59)
+    # pings are answered by the handler to keep track of the agents
+    ws = web.WebSocketResponse(autoping=False, heartbeat=settings.PDUSERVER_HEARTBEAT)
     logger.info("Prepare ws")
     await ws.prepare(request)
     logger.info("After prepare")
@@ -93,63 +309,138 @@ async def websocket_handler(request):
         logger.debug("Received request with Authorization")
         token = auth.split(":")[1].strip()
         try:
-            agent = await sync_to_async(PDUAgent.objects.get, thread_sensitive=True)(token=token)
-            logger.info(f"Agent {agent.name} connected")
-            if agent.name in request.app["agents"].keys():
-                await ws.send_json({"error": "already logged in"})
-            request.app["agents"][agent.name] = ws
-            agent.state = PDUAgent.STATE_ONLINE
-            await sync_to_async(agent.save, thread_sensitive=True)()
-            if agent.message:
-                logger.debug(f"Sending msg {agent.message} to {agent.name}")
-                await ws.send_json({"msg": agent.message})
-                agent.message = None
-                await sync_to_async(agent.save, thread_sensitive=True)()
-            try:
-                async for msg in ws:
-                    logger.debug(f"Received websocket message from {agent.name}")
-                    if msg.type == aiohttp.WSMsgType.ERROR:
-                        logger.exception(ws.exception())
-                    if msg.type == aiohttp.WSMsgType.CLOSE:
-                        request.app["agents"].pop(agent.name)
-                        logger.info(f"Removed {agent.name}")
-            except asyncio.exceptions.CancelledError:
-                if agent.name in request.app["agents"].keys():
-                    request.app["agents"].pop(agent.name)
-                logger.info(f"Removed {agent.name} on exception")
-
+            agent = await run_db(request.app, PDUAgent.objects.get, token=token)
         except PDUAgent.DoesNotExist:
             # ignore unathorized request
-            pass
+            return ws
+        logger.info(f"Agent {agent.name} connected")
+        if agent.name in request.app["agents"].keys():
+            await ws.send_json({"error": "already logged in"})
+        request.app["agents"][agent.name] = ws
+        # stored with the next bulk update
+        set_agent_state(request.app, agent, PDUAgent.STATE_ONLINE)
+        record_ping(request.app, agent)
+        try:
+            # commands not acknowledged before the agent disconnected
+            await deliver_commands(request.app, agent.pk, agent.name)
+            async for msg in ws:
+                logger.debug(f"Received websocket message from {agent.name}")
+                record_ping(request.app, agent)
+                if msg.type == aiohttp.WSMsgType.PING:
+                    await ws.pong(msg.data)
+                    continue
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    try:
+                        data = json.loads(msg.data)
+                    except ValueError:
+                        logger.warning(f"Invalid message from {agent.name}: {msg.data}")
+                        continue
+                    if isinstance(data, dict) and "ack" in data:
+                        seq = data["ack"]
+                        commands = request.app["commands"].get(agent.name, {})
+                        # only commands sent to this agent can be acknowledged
+                        if isinstance(seq, bool) or not isinstance(seq, int) or seq not in commands:
+                            logger.warning(f"Ignoring ack {seq!r} from {agent.name}")
+                            continue
+                        logger.debug(f"Agent {agent.name} acknowledged {seq}")
+                        commands.pop(seq)
+                        request.app["acks"].add((agent.pk, seq))
+                if msg.type == aiohttp.WSMsgType.ERROR:
+                    logger.exception(ws.exception())
+        except asyncio.exceptions.CancelledError:
+            logger.info(f"Removed {agent.name} on exception")
         finally:
+            # newer connection of the same agent replaces this one
+            if request.app["agents"].get(agent.name) is ws:
+                request.app["agents"].pop(agent.name)
+                request.app["seen"].pop(agent.name, None)
+                logger.info(f"Removed {agent.name}")
+                if not request.app["in_shutdown"]:
+                    set_agent_state(request.app, agent, PDUAgent.STATE_OFFLINE)
             if not request.app["in_shutdown"]:
                 await ws.close()
                 logger.info(f"connection closed from {request.remote}({agent.name})")
-                if agent.name in request.app["agents"].keys():
-                    request.app["agents"].pop(agent.name)
-                agent.state = PDUAgent.STATE_OFFLINE
-                await sync_to_async(agent.save, thread_sensitive=True)()
 
     return ws
 
 
+async def agents_handler(request):
+    # liveness of the agents connected to this instance
+    # without waiting for last_ping to be written
+    now = timezone.now()
+    return web.json_response({
+        name: {
+            "last_ping": last_ping.isoformat(),
+            "idle": round((now - last_ping).total_seconds(), 1),
+        }
+        for name, last_ping in request.app["seen"].items()
+    })
+
+
 async def on_shutdown(app):
     logger = app["logger"]
     app["in_shutdown"] = True
-    for name, ws in app["agents"].items():
+    names = list(app["agents"].keys())
+    for name, ws in list(app["agents"].items()):
         logger.debug(name)
         await ws.close(code=aiohttp.WSCloseCode.GOING_AWAY, message="Server shutdown")
-        try:
-            agent = await sync_to_async(PDUAgent.objects.get, thread_sensitive=True)(name=name)
-            agent.state = PDUAgent.STATE_OFFLINE
-            await sync_to_async(agent.save, thread_sensitive=True)()
-            logger.debug("Turning %s offline" % name)
-        except PDUAgent.DoesNotExist:
-            pass
+    # pending updates are flushed before agents are turned offline
+    for writer in ("writer", "ping_writer"):
+        app[writer].cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await app[writer]
+    await run_db(app, release_agents, app["endpoint"], names)
+    logger.debug("Turned %d agents offline" % len(names))
 
 
 async def on_startup(app):
+    app["db"] = ThreadPoolExecutor(
+        max_workers=settings.PDUSERVER_DB_WORKERS,
+        thread_name_prefix="pduserver-db"
+    )
+    # agents left online by previous run of this instance
+    await run_db(app, release_agents, app["endpoint"])
     app["zmq"] = asyncio.create_task(zmq_message_forward(app))
+    app["writer"] = asyncio.create_task(
+        periodic_writer(app, flush_updates, settings.PDUSERVER_FLUSH_INTERVAL)
+    )
+    app["ping_writer"] = asyncio.create_task(
+        periodic_writer(app, flush_pings, settings.PDUSERVER_PING_FLUSH_INTERVAL)
+    )
+
+
+async def on_cleanup(app):
+    app["db"].shutdown(wait=True)
+
+
+def create_app(logger, endpoint):
+    # Create the aiohttp application
+    app = web.Application()
+
+    # Variables
+    app["logger"] = logger
+    app["agents"] = {}
+    app["commands"] = {}
+    # agent state changes and acks waiting for the next bulk update
+    app["states"] = {}
+    app["acks"] = set()
+    # last ping of connected agents and pings waiting to be written
+    app["seen"] = {}
+    app["pings"] = {}
+    app["endpoint"] = endpoint
+    app["in_shutdown"] = False
+
+    # Routes
+    app.add_routes([
+        web.get("/ws/", websocket_handler),
+        web.get("/agents/", agents_handler),
+    ])
+
+    # signals
+    app.on_shutdown.append(on_shutdown)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
 
 
 class Command(BaseCommand):
@@ -160,6 +451,13 @@ class Command(BaseCommand):
         parser.add_argument("--host", default="*", help="Hostname")
         parser.add_argument("--port", default=8001, type=int, help="Port")
         parser.add_argument("--logfile", default="-", help="Path to logfile")
+        parser.add_argument(
+            "--zmq-socket",
+            default=None,
+            help="ZMQ endpoint receiving commands for agents connected to this "
+                 "instance. Has to be reachable from workers and unique when "
+                 "running multiple instances. Defaults to INTERNAL_ZMQ_SOCKET"
+        )
 
     def handle(self, *args, **options):
         self.logger = logging.getLogger("pduserver")
@@ -177,20 +475,7 @@ class Command(BaseCommand):
 
         self.logger.info("Starting pduserver")
         self.logger.debug("Debug enabled")
-        # Create the aiohttp application
-        app = web.Application()
-
-        # Variables
-        app["logger"] = self.logger
-        app["agents"] = {}
-        app["in_shutdown"] = False
-
-        # Routes
-        app.add_routes([web.get("/ws/", websocket_handler)])
-
-        # signals
-        app.on_shutdown.append(on_shutdown)
-        app.on_startup.append(on_startup)
+        app = create_app(self.logger, options["zmq_socket"] or settings.INTERNAL_ZMQ_SOCKET)
 
         # Run the application
         self.logger.info(
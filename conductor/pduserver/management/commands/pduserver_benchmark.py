@@ -0,0 +1,322 @@
+# Copyright 2021 Foundries.io
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import aiohttp
+import asyncio
+import json
+import os
+import random
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from conductor.core.models import PDUAgent, PDUAgentCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+
+AGENT_PREFIX = "bench-"
+
+
+def agent_prefix():
+    # unique for every run, agents of other runs
+    # or other PDUAgents are never touched
+    return f"{AGENT_PREFIX}{uuid.uuid4().hex[:8]}-"
+
+
+def create_agents(prefix, count):
+    PDUAgent.objects.bulk_create([
+        PDUAgent(name=f"{prefix}{index}", token=uuid.uuid4().hex, version="benchmark")
+        for index in range(count)
+    ])
+    return list(PDUAgent.objects.filter(name__startswith=prefix).order_by("id"))
+
+
+def delete_agents(prefix):
+    PDUAgent.objects.filter(name__startswith=prefix).delete()
+
+
+def count_online(prefix, endpoint=None):
+    close_old_connections()
+    agents = PDUAgent.objects.filter(name__startswith=prefix, state=PDUAgent.STATE_ONLINE)
+    if endpoint is not None:
+        agents = agents.filter(endpoint=endpoint)
+    return agents.count()
+
+
+def create_command(agent, command):
+    # same path as device_pdu_action, the post_save signal
+    # sends the command to the pduserver holding the agent
+    close_old_connections()
+    PDUAgentCommand.objects.create(agent=agent, command=command)
+
+
+def memory_usage(pid):
+    # resident set size in kB
+    if pid is None:
+        return None
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return None
+
+
+def percentiles(values):
+    if len(values) < 2:
+        return {}
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "p50": quantiles[49],
+        "p90": quantiles[89],
+        "p99": quantiles[98],
+        "max": max(values),
+    }
+
+
+class SimulatedAgent(object):
+    def __init__(self, benchmark, agent):
+        self.benchmark = benchmark
+        self.agent = agent
+        self.ws = None
+        self.connected = asyncio.Event()
+        self.task = None
+
+    async def connect(self):
+        self.connected.clear()
+        self.ws = await self.benchmark.session.ws_connect(
+            self.benchmark.url,
+            headers={"Authorization": f"Token: {self.agent.token}"}
+        )
+        self.connected.set()
+        self.task = asyncio.create_task(self.receive(self.ws))
+
+    async def receive(self, ws):
+        # client answers pings while waiting for messages
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            message = json.loads(msg.data)
+            if "seq" not in message:
+                continue
+            self.benchmark.command_received(message["cmd"])
+            await ws.send_json({"ack": message["seq"]})
+
+    async def disconnect(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.task is not None:
+            await self.task
+
+
+class Benchmark(object):
+    def __init__(self, stdout, options, prefix):
+        self.stdout = stdout
+        self.options = options
+        self.prefix = prefix
+        self.url = None
+        self.session = None
+        self.pid = None
+        # ZMQ endpoint of the started pduserver. Agents connected
+        # to an already running instance are counted on any endpoint
+        self.endpoint = None
+        self.sent = {}
+        self.latencies = []
+        self.all_received = asyncio.Event()
+
+    def report(self, message):
+        self.stdout.write(message)
+
+    def command_received(self, command):
+        started = self.sent.pop(command, None)
+        if started is None:
+            # replayed after reconnect
+            return
+        self.latencies.append((time.monotonic() - started) * 1000)
+        if not self.sent:
+            self.all_received.set()
+
+    async def wait_online(self, count, timeout):
+        start = time.monotonic()
+        online = 0
+        while time.monotonic() - start < timeout:
+            online = await asyncio.to_thread(count_online, self.prefix, self.endpoint)
+            if online >= count:
+                return time.monotonic() - start
+            await asyncio.sleep(0.2)
+        self.report(f"  only {online} of {count} agents online after {timeout}s")
+        return None
+
+    async def connect_all(self, agents):
+        semaphore = asyncio.Semaphore(self.options["concurrency"])
+        failed = []
+
+        async def connect(agent):
+            async with semaphore:
+                try:
+                    await agent.connect()
+                except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+                    failed.append(e)
+
+        start = time.monotonic()
+        await asyncio.gather(*[connect(agent) for agent in agents])
+        return time.monotonic() - start, failed
+
+    async def send_commands(self, agents):
+        count = self.options["commands"]
+        interval = 1 / self.options["rate"]
+        self.all_received.clear()
+        for index in range(count):
+            agent = random.choice(agents).agent
+            command = f"benchmark {uuid.uuid4().hex}"
+            self.sent[command] = time.monotonic()
+            await asyncio.to_thread(create_command, agent, command)
+            await asyncio.sleep(interval)
+        try:
+            await asyncio.wait_for(self.all_received.wait(), self.options["timeout"])
+        except asyncio.TimeoutError:
+            self.report(f"  {len(self.sent)} of {count} commands not received")
+            self.sent.clear()
+
+    def report_latency(self):
+        values = percentiles(self.latencies)
+        if values:
+            self.report("  command latency (ms): " + ", ".join(f"{key} {value:.1f}" for key, value in values.items()))
+        self.latencies = []
+
+    async def run(self, agents):
+        simulated = [SimulatedAgent(self, agent) for agent in agents]
+        count = len(simulated)
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as self.session:
+            memory_before = memory_usage(self.pid)
+
+            self.report(f"Connecting {count} agents")
+            duration, failed = await self.connect_all(simulated)
+            self.report(f"  connected in {duration:.2f}s ({(count - len(failed)) / duration:.0f} agents/s), {len(failed)} failed")
+            online = await self.wait_online(count - len(failed), self.options["timeout"])
+            if online is not None:
+                self.report(f"  all agents online in database after {online:.2f}s")
+
+            memory_after = memory_usage(self.pid)
+            if memory_before is not None and memory_after is not None:
+                self.report(
+                    f"  pduserver memory {memory_before} kB -> {memory_after} kB "
+                    f"({(memory_after - memory_before) / count:.1f} kB per agent)"
+                )
+
+            connected = [agent for agent in simulated if agent.connected.is_set()]
+            if not connected:
+                raise CommandError("No agent connected")
+
+            self.report(f"Sending {self.options['commands']} commands at {self.options['rate']}/s")
+            await self.send_commands(connected)
+            self.report_latency()
+
+            if self.options["storm"]:
+                self.report(f"Reconnect storm of {len(connected)} agents")
+                await asyncio.gather(*[agent.disconnect() for agent in connected])
+                duration, failed = await self.connect_all(connected)
+                self.report(f"  reconnected in {duration:.2f}s, {len(failed)} failed")
+                online = await self.wait_online(len(connected) - len(failed), self.options["timeout"])
+                if online is not None:
+                    self.report(f"  all agents online in database after {online:.2f}s")
+                self.report(f"Sending {self.options['commands']} commands after reconnect")
+                await self.send_commands([agent for agent in connected if agent.connected.is_set()])
+                self.report_latency()
+
+            await asyncio.gather(*[agent.disconnect() for agent in simulated if agent.connected.is_set()])
+
+
+class Command(BaseCommand):
+    help = "Measures how many agents a single pduserver instance can handle"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--agents", default=1000, type=int, help="Number of simulated agents")
+        parser.add_argument("--commands", default=1000, type=int, help="Number of commands sent to the agents")
+        parser.add_argument("--rate", default=100, type=float, help="Commands sent per second")
+        parser.add_argument("--concurrency", default=200, type=int, help="Agents connecting at the same time")
+        parser.add_argument("--timeout", default=60, type=int, help="Seconds to wait for agents and commands")
+        parser.add_argument("--port", default=8901, type=int, help="Port of the benchmarked pduserver")
+        parser.add_argument(
+            "--zmq-socket",
+            default="ipc:///tmp/conductor.pduserver-benchmark",
+            help="ZMQ endpoint of the started pduserver"
+        )
+        parser.add_argument(
+            "--url",
+            default=None,
+            help="Websocket URL of already running pduserver. "
+                 "New instance is started when omitted"
+        )
+        parser.add_argument("--no-storm", dest="storm", action="store_false", help="Skip reconnect storm")
+
+    def start_pduserver(self, options):
+        command = [
+            sys.executable, "-m", "conductor.manage", "pduserver",
+            "--host", "127.0.0.1",
+            "--port", str(options["port"]),
+            "--zmq-socket", options["zmq_socket"],
+            "--verbosity", "0",
+        ]
+        # access log of thousands of connections hides the results
+        output = None if options["verbosity"] > 1 else subprocess.DEVNULL
+        process = subprocess.Popen(command, env=os.environ.copy(), stdout=output, stderr=output)
+        start = time.monotonic()
+        while time.monotonic() - start < options["timeout"]:
+            if process.poll() is not None:
+                raise CommandError(f"pduserver exited with {process.returncode}")
+            try:
+                with socket.create_connection(("127.0.0.1", options["port"]), timeout=1):
+                    return process
+            except OSError:
+                time.sleep(0.2)
+        process.terminate()
+        raise CommandError("pduserver didn't start")
+
+    def handle(self, *args, **options):
+        # every agent uses a socket on both ends
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        if options["agents"] * 2 + 100 > hard:
+            self.stderr.write(f"Open file limit {hard} is too low for {options['agents']} agents")
+
+        prefix = agent_prefix()
+        agents = create_agents(prefix, options["agents"])
+        self.stdout.write(f"Created {len(agents)} agents {prefix}* in {settings.DATABASES['default']['NAME']}")
+        process = None
+        try:
+            benchmark = Benchmark(self.stdout, options, prefix)
+            if options["url"]:
+                benchmark.url = options["url"]
+            else:
+                process = self.start_pduserver(options)
+                benchmark.pid = process.pid
+                benchmark.url = f"http://127.0.0.1:{options['port']}/ws/"
+                benchmark.endpoint = options["zmq_socket"]
+            asyncio.run(benchmark.run(agents))
+        finally:
+            if process is not None:
+                process.send_signal(signal.SIGINT)
+                try:
+                    process.wait(options["timeout"])
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            delete_agents(prefix)
@@ -0,0 +1,193 @@
+# Copyright 2021 Foundries.io
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+from aiohttp.test_utils import TestClient, TestServer
+from asgiref.sync import sync_to_async
+from django.db import OperationalError
+from django.test import TestCase
+from unittest.mock import patch
+
+from conductor.core.models import PDUAgent, PDUAgentCommand
+from conductor.pduserver.management.commands.pduserver import (
+    create_app,
+    deliver_commands,
+    flush_updates,
+    forward_message,
+)
+
+
+async def run_db(app, function, *args, **kwargs):
+    # test transaction is visible in the main thread only
+    return await sync_to_async(function, thread_sensitive=True)(*args, **kwargs)
+
+
+class FakeWebSocket(object):
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = []
+
+    async def send_json(self, data):
+        if self.error is not None:
+            raise self.error
+        self.sent.append(data)
+
+
+def zmq_message(data):
+    return [b"id", b"2021-05-01T10:00:00", json.dumps(data).encode("utf-8")]
+
+
+class ForwardMessageTest(TestCase):
+    def setUp(self):
+        self.app = create_app(logging.getLogger("pduserver"), "ipc:///tmp/pduserver-test")
+
+    async def test_forward_command(self):
+        ws = FakeWebSocket()
+        self.app["agents"]["agent1"] = ws
+        await forward_message(self.app, zmq_message({"agent": "agent1", "cmd": "on", "seq": 1}))
+        self.assertEqual([{"agent": "agent1", "cmd": "on", "seq": 1}], ws.sent)
+        # kept until acknowledged
+        self.assertIn(1, self.app["commands"]["agent1"])
+
+    async def test_invalid_messages_skipped(self):
+        ws = FakeWebSocket()
+        self.app["agents"]["agent1"] = ws
+        for msg in [[b"id"], [b"id", b"date", b"\xff"], zmq_message(["agent1"]), zmq_message({"cmd": "on"})]:
+            await forward_message(self.app, msg)
+        await forward_message(self.app, zmq_message({"agent": "agent1", "cmd": "off", "seq": 2}))
+        self.assertEqual([{"agent": "agent1", "cmd": "off", "seq": 2}], ws.sent)
+
+    async def test_closing_agent_connection(self):
+        self.app["agents"]["agent1"] = FakeWebSocket(ConnectionResetError("Cannot write to closing transport"))
+        ws = FakeWebSocket()
+        self.app["agents"]["agent2"] = ws
+        await forward_message(self.app, zmq_message({"agent": "agent1", "cmd": "on", "seq": 1}))
+        await forward_message(self.app, zmq_message({"agent": "agent2", "cmd": "on", "seq": 2}))
+        self.assertEqual([{"agent": "agent2", "cmd": "on", "seq": 2}], ws.sent)
+        # sent again when the agent reconnects
+        self.assertIn(1, self.app["commands"]["agent1"])
+
+
+@patch("conductor.pduserver.management.commands.pduserver.run_db", run_db)
+class DeliverCommandsTest(TestCase):
+    def setUp(self):
+        self.app = create_app(logging.getLogger("pduserver"), "ipc:///tmp/pduserver-test")
+        self.agent = PDUAgent.objects.create(name="agent1", token="token1", version="1.0")
+        self.command1 = PDUAgentCommand.objects.create(agent=self.agent, command="on")
+        self.command2 = PDUAgentCommand.objects.create(agent=self.agent, command="off")
+
+    def message(self, command):
+        return {"agent": self.agent.name, "cmd": command.command, "seq": command.id}
+
+    async def test_unacked_commands_sent_once(self):
+        ws = FakeWebSocket()
+        self.app["agents"][self.agent.name] = ws
+        await deliver_commands(self.app, self.agent.pk, self.agent.name)
+        # live forwarded and delivered after flush on the same connection
+        await forward_message(self.app, zmq_message(self.message(self.command1)))
+        await deliver_commands(self.app, self.agent.pk, self.agent.name)
+        self.assertEqual([self.message(self.command1), self.message(self.command2)], ws.sent)
+
+    async def test_commands_sent_again_on_reconnect(self):
+        ws = FakeWebSocket()
+        self.app["agents"][self.agent.name] = ws
+        await deliver_commands(self.app, self.agent.pk, self.agent.name)
+        reconnected = FakeWebSocket()
+        self.app["agents"][self.agent.name] = reconnected
+        await deliver_commands(self.app, self.agent.pk, self.agent.name)
+        self.assertEqual(ws.sent, reconnected.sent)
+
+    async def test_command_forwarded_during_replay(self):
+        ws = FakeWebSocket()
+        self.app["agents"][self.agent.name] = ws
+        command3 = await PDUAgentCommand.objects.acreate(agent=self.agent, command="reboot")
+
+        async def forward_during_query(app, function, *args, **kwargs):
+            # command is forwarded while the unacked commands are retrieved
+            await forward_message(self.app, zmq_message(self.message(command3)))
+            return await run_db(app, function, *args, **kwargs)
+
+        with patch("conductor.pduserver.management.commands.pduserver.run_db", forward_during_query):
+            await deliver_commands(self.app, self.agent.pk, self.agent.name)
+        self.assertEqual(
+            [self.message(command3), self.message(self.command1), self.message(self.command2)],
+            ws.sent
+        )
+
+    async def test_acked_elsewhere_dropped(self):
+        ws = FakeWebSocket()
+        self.app["agents"][self.agent.name] = ws
+        await deliver_commands(self.app, self.agent.pk, self.agent.name)
+        await PDUAgentCommand.objects.filter(pk=self.command1.pk).aupdate(acked=self.command1.created)
+        await deliver_commands(self.app, self.agent.pk, self.agent.name)
+        self.assertEqual([self.command2.id], list(self.app["commands"][self.agent.name].keys()))
+
+    async def test_flush_updates(self):
+        ws = FakeWebSocket()
+        self.app["agents"][self.agent.name] = ws
+        self.app["states"][self.agent.pk] = (self.agent.name, PDUAgent.STATE_ONLINE)
+        await flush_updates(self.app)
+        agent = await PDUAgent.objects.aget(pk=self.agent.pk)
+        self.assertEqual(PDUAgent.STATE_ONLINE, agent.state)
+        self.assertEqual("ipc:///tmp/pduserver-test", agent.endpoint)
+        # commands created before the endpoint was stored
+        self.assertEqual([self.message(self.command1), self.message(self.command2)], ws.sent)
+
+    async def test_flush_updates_failed(self):
+        self.app["states"][self.agent.pk] = (self.agent.name, PDUAgent.STATE_ONLINE)
+        self.app["acks"].add((self.agent.pk, self.command1.id))
+
+        async def locked(app, function, *args, **kwargs):
+            raise OperationalError("database is locked")
+
+        with patch("conductor.pduserver.management.commands.pduserver.run_db", locked):
+            await flush_updates(self.app)
+        # retried with the next flush
+        self.assertEqual({self.agent.pk: (self.agent.name, PDUAgent.STATE_ONLINE)}, self.app["states"])
+        self.assertEqual({(self.agent.pk, self.command1.id)}, self.app["acks"])
+
+
+@patch("conductor.pduserver.management.commands.pduserver.run_db", run_db)
+class WebsocketHandlerTest(TestCase):
+    def setUp(self):
+        self.agent = PDUAgent.objects.create(name="agent1", token="token1", version="1.0")
+        self.other_agent = PDUAgent.objects.create(name="agent2", token="token2", version="1.0")
+        self.command = PDUAgentCommand.objects.create(agent=self.agent, command="on")
+        self.other_command = PDUAgentCommand.objects.create(agent=self.other_agent, command="on")
+        self.app = create_app(logging.getLogger("pduserver"), "ipc:///tmp/pduserver-test")
+        # no ZMQ socket and periodic writers
+        self.app.on_startup.clear()
+        self.app.on_shutdown.clear()
+        self.app.on_cleanup.clear()
+
+    async def test_ack(self):
+        async with TestClient(TestServer(self.app)) as client:
+            ws = await client.ws_connect("/ws/", headers={"Authorization": "Token: token1"})
+            message = await ws.receive_json()
+            self.assertEqual({"agent": "agent1", "cmd": "on", "seq": self.command.id}, message)
+            # only own commands can be acknowledged
+            for seq in [self.other_command.id, True, str(self.command.id), self.command.id]:
+                await ws.send_json({"ack": seq})
+            await ws.close()
+        self.assertEqual({(self.agent.pk, self.command.id)}, self.app["acks"])
+        self.assertEqual({}, self.app["commands"]["agent1"])
+
+        await flush_updates(self.app)
+        command = await PDUAgentCommand.objects.aget(pk=self.command.pk)
+        self.assertIsNotNone(command.acked)
+        other_command = await PDUAgentCommand.objects.aget(pk=self.other_command.pk)
+        self.assertIsNone(other_command.acked)
+        agent = await PDUAgent.objects.aget(pk=self.agent.pk)
+        self.assertEqual(PDUAgent.STATE_OFFLINE, agent.state)
@@ -12,24 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from conductor.settings import CELERY_TASK_DEFAULT_QUEUE
+from conductor.settings import CELERY_TASK_DEFAULT_QUEUE, CELERY_TASK_ROUTES
 import os
 import sys
 
 def main():
-    queues = set()
-    queues.add(CELERY_TASK_DEFAULT_QUEUE)
+    # by default worker consumes from all queues and runs the
+    # periodic tasks scheduler. Workers started for selected
+    # queues only (i.e. --queues=git) don't run the scheduler.
+    args = sys.argv[1:]
+    default_args = []
+    if not any(arg.startswith('--queues') or arg.startswith('-Q') for arg in args):
+        queues = set([route['queue'] for route in CELERY_TASK_ROUTES.values()])
+        queues.add(CELERY_TASK_DEFAULT_QUEUE)
+        default_args = [
+            '-B',
+            '--queues=' + ','.join(queues),
+        ]
     argv = [
         sys.executable, '-m', 'celery',
         # default celery args:
         '-A', 'conductor',
         'worker',
-        '-B',
-        '--queues=' + ','.join(queues),
+    ] + default_args + [
         '--max-tasks-per-child=5000',
         '--max-memory-per-child=1500000',
         '--loglevel=DEBUG'
-    ] + sys.argv[1:]
+    ] + args
     os.execvp(sys.executable, argv)
 
 
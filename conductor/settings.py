@@ -127,17 +127,87 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'conductor.core.tasks.check_ota_completed',
         'schedule': crontab(minute='*/10'),
     },
+    'release_pending_runs': {
+        'task': 'conductor.core.tasks.release_pending_runs',
+        'schedule': crontab(minute='*/10'),
+    },
 }
 
 CELERY_TASK_DEFAULT_QUEUE = 'celery'
+# tasks working on project manifest repositories. Workers started with
+# 'conductor-worker --queues=git' process only these. Operations on a
+# single repository are serialized with a per-project lock.
+CELERY_GIT_QUEUE = 'git'
+CELERY_TASK_ROUTES = {
+    'conductor.core.tasks.create_project_repository': {'queue': CELERY_GIT_QUEUE},
+    'conductor.core.tasks.create_upgrade_commit': {'queue': CELERY_GIT_QUEUE},
+    'conductor.core.tasks.merge_lmp_manifest': {'queue': CELERY_GIT_QUEUE},
+    'conductor.core.tasks.update_build_reason': {'queue': CELERY_GIT_QUEUE},
+    'conductor.core.tasks.update_build_commit_id': {'queue': CELERY_GIT_QUEUE},
+}
 #CELERY_RESULT_BACKEND = 'django-db'
 SILENCED_SYSTEM_CHECKS = ['urls.W002']
 
 INTERNAL_ZMQ_SOCKET = "ipc:///tmp/conductor.msgs"
 INTERNAL_ZMQ_TIMEOUT = 5
+# messages waiting in the sending process and in the ZMQ socket
+INTERNAL_ZMQ_QUEUE_SIZE = 1000
+INTERNAL_ZMQ_HWM = 1000
+# unacknowledged PDU agent commands are sent again on reconnect
+# if they are not older than the window (in seconds)
+PDU_COMMAND_REPLAY_WINDOW = 300
+# threads used by pduserver for database access
+PDUSERVER_DB_WORKERS = 4
+# agent state changes are written in bulk every interval (in seconds)
+PDUSERVER_FLUSH_INTERVAL = 1
+# idle agent connections are pinged every interval (in seconds)
+PDUSERVER_HEARTBEAT = 59
+# last message or pong received from the agents is written
+# to PDUAgent.last_ping every interval (in seconds)
+PDUSERVER_PING_FLUSH_INTERVAL = 15
+# agent without ping for longer than timeout (in seconds) is stale
+PDUAGENT_PING_TIMEOUT = 150
+# listener is notified about LAVABackend changes on this socket
+LISTENER_ZMQ_SOCKET = "ipc:///tmp/conductor.listener"
+# listener compares backends with the database even without notification
+LISTENER_RECONCILE_INTERVAL = 600
+# LAVA websocket reconnect backoff in seconds
+LISTENER_BACKOFF_MIN = 1
+LISTENER_BACKOFF_MAX = 60
+# jobs API is queried with this margin (in seconds) around the time
+# the listener was disconnected to cover clock skew between LAVA and conductor
+LISTENER_CATCH_UP_MARGIN = 60
+# testjob events are sent to workers in batches every LISTENER_BATCH_INTERVAL
+# seconds. Events of jobs not submitted by conductor are dropped. Events
+# received before the job is saved are kept for LISTENER_UNKNOWN_EVENT_TTL
+# (at most LISTENER_UNKNOWN_EVENTS per backend). The jobs are looked up
+# in the database before the events are dropped. The listener keeps
+# LISTENER_KNOWN_JOBS most recent job IDs per backend.
+LISTENER_BATCH_INTERVAL = 0.3
+LISTENER_KNOWN_JOBS = 10000
+LISTENER_UNKNOWN_EVENTS = 1000
+LISTENER_UNKNOWN_EVENT_TTL = 10
+
+# outbound HTTP calls to LAVA, SQUAD and FIO API
+HTTP_TIMEOUT = 60
+HTTP_RETRIES = 3
+# requests timing out are retried only once to keep
+# a single call under 2 * HTTP_TIMEOUT
+HTTP_READ_RETRIES = 1
+HTTP_BACKOFF_FACTOR = 1.0
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 10
+# maximum number of parallel requests sent to a single backend
+BACKEND_MAX_CONCURRENCY = 4
+
+# conductor API URL reachable from LAVA. When set, jobs submitted to
+# backends with callback_token ask LAVA to POST the final job state
+# to this API. LAVA_CALLBACK_TOKEN_NAME is the name of the token in
+# the LAVA submitter's profile holding the callback_token value.
+LAVA_CALLBACK_BASE_URL = os.getenv("LAVA_CALLBACK_BASE_URL")
+LAVA_CALLBACK_TOKEN_NAME = "conductor"
 
 FIO_API_TOKEN = os.getenv("FIO_API_TOKEN")
-FIO_REPOSITORY_SCRIPT_PATH_PREFIX = f"{BASE_DIR}/conductor/scripts/"
 FIO_REPOSITORY_TOKEN = os.getenv("FIO_REPOSITORY_TOKEN")
 FIO_REPOSITORY_BASE = "https://source.foundries.io/factories/"
 FIO_REPOSITORY_HOME = "%s/repositories/" % BASE_DIR
@@ -145,6 +215,18 @@ FIO_REPOSITORY_REMOTE_NAME = "origin"
 FIO_BASE_MANIFEST = "https://github.com/foundriesio/lmp-manifest"
 FIO_BASE_REMOTE_NAME = "lmp"
 FIO_UPGRADE_ROLLBACK_MESSAGE = "upgrade/rollback testing"
+# bare repository keeping LmP objects shared by all project repositories
+FIO_REPOSITORY_REFERENCE = os.path.join(FIO_REPOSITORY_HOME, ".lmp-reference")
+# partial clone filter for project repositories, i.e. "blob:none"
+FIO_REPOSITORY_FILTER = None
+# runs waiting for the build reason longer than PENDING_RUN_STALE
+# (in seconds) are checked again, after PENDING_RUN_EXPIRE dropped
+PENDING_RUN_STALE = 600
+PENDING_RUN_EXPIRE = 24 * 3600
+# number of project repositories merged with LmP in parallel
+FIO_MERGE_CONCURRENCY = 8
+# maximum number of fetched commits added to the commit index at once
+FIO_COMMIT_INDEX_DEPTH = 1000
 
 LOGGING = {
     'version': 1,
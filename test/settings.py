@@ -12,8 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import shutil
+import tempfile
+
 from conductor.settings import *
 
 CELERY_BROKER_URL = None
 CELERY_TASK_ALWAYS_EAGER = True
 CELERY_TASK_EAGER_PROPAGATES = True
+# repositories created by the tests don't end up in the source tree
+FIO_REPOSITORY_HOME = tempfile.mkdtemp(prefix="conductor-repositories-")
+FIO_REPOSITORY_REFERENCE = os.path.join(FIO_REPOSITORY_HOME, ".lmp-reference")
+atexit.register(shutil.rmtree, FIO_REPOSITORY_HOME, ignore_errors=True)